@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""Record and summarise the nucleus's CPU and memory history
+
+With --record this runs as the greengrass-history service: every
+--interval seconds it samples the nucleus JVM and the system from /proc and
+writes one fixed-size record into a ring buffer file in $SNAP_COMMON.  The
+file is allocated once at --capacity records, so it never grows, and each
+sample rewrites only its record and the header.
+
+Without --record it prints percentiles and trends for a time window of the
+recorded history, and can export the window as CSV or JSON.
+"""
+import os
+import sys
+import csv
+import json
+import math
+import time
+import struct
+import signal
+import argparse
+import threading
+from datetime import datetime, timezone
+
+from greengrass_common import (
+    find_nucleus, is_nucleus, parse_time_arg, process_stats, read_env_file,
+)
+
+MAGIC = b'GGRH'
+FORMAT_VERSION = 1
+# magic, format version, record size, capacity, next slot, records written, sample interval
+HEADER = struct.Struct('<4sHHIIIf')
+HEADER_SIZE = 32
+
+# One sample: time, nucleus PID, nucleus CPU (0.1% of one CPU), nucleus RSS (KB),
+# threads, open FDs, system CPU busy (0.1%), memory available (KB), 1-minute load (x100)
+RECORD = struct.Struct('<IIHIHHHIH')
+FIELDS = ['time', 'pid', 'cpuPercent', 'rssKb', 'threads', 'openFds', 'systemCpuPercent',
+          'memAvailableKb', 'load1']
+# Fields stored as integers scaled by these factors
+SCALES = {'cpuPercent': 10, 'systemCpuPercent': 10, 'load1': 100}
+UINT16_MAX = 0xffff
+
+# Summarised by the stats command, with the unit each is shown in
+SUMMARY_FIELDS = [
+    ('cpuPercent', '%'),
+    ('rssKb', 'KB'),
+    ('threads', ''),
+    ('openFds', ''),
+    ('systemCpuPercent', '%'),
+    ('memAvailableKb', 'KB'),
+    ('load1', ''),
+]
+
+def system_stats():
+    """Return busy and total CPU ticks, available memory and the 1-minute load"""
+    with open('/proc/stat', 'r') as f:
+        ticks = [int(value) for value in f.readline().split()[1:]]
+    mem_available = 0
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                mem_available = int(line.split()[1])
+                break
+    with open('/proc/loadavg', 'r') as f:
+        load1 = float(f.read().split()[0])
+    # idle and iowait are the fourth and fifth columns
+    idle = sum(ticks[3:5])
+    return {'busyTicks': sum(ticks) - idle, 'totalTicks': sum(ticks),
+            'memAvailableKb': mem_available, 'load1': load1}
+
+class HistoryFile:
+    """Fixed-capacity ring buffer of RECORD entries behind a small header"""
+
+    def __init__(self, path, capacity=None, interval=0.0):
+        self.path = path
+        self.capacity = capacity
+        self.interval = interval
+        self.next_slot = 0
+        self.written = 0
+
+    def open_for_writing(self):
+        """Open the file, starting a new one if it is missing or laid out differently"""
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) == HEADER.size:
+            magic, version, record_size, capacity, next_slot, written, _ = HEADER.unpack(header)
+            if (magic, version, record_size, capacity) == \
+                    (MAGIC, FORMAT_VERSION, RECORD.size, self.capacity):
+                self.next_slot, self.written = next_slot, written
+                return
+            if magic == MAGIC:
+                print(f"Starting a new history: capacity changed from {capacity} to "
+                      f"{self.capacity} records")
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, HEADER_SIZE + self.capacity * RECORD.size)
+        self.write_header()
+
+    def write_header(self):
+        os.pwrite(self.fd, HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, self.capacity,
+                                       self.next_slot, self.written, self.interval), 0)
+
+    def append(self, values):
+        """Write one record over the oldest slot"""
+        os.pwrite(self.fd, RECORD.pack(*values), HEADER_SIZE + self.next_slot * RECORD.size)
+        self.next_slot = (self.next_slot + 1) % self.capacity
+        self.written += 1
+        self.write_header()
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self):
+        """Return the recorded samples as dicts, oldest first"""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            raise ValueError(f"{self.path} is not a resource history file")
+        magic, version, record_size, capacity, next_slot, written, interval = \
+            HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+            raise ValueError(f"{self.path} is not a version {FORMAT_VERSION} resource history file")
+        self.capacity, self.interval = capacity, interval
+
+        count = min(written, capacity)
+        first = (next_slot - count) % capacity
+        records = data[HEADER_SIZE:HEADER_SIZE + capacity * RECORD.size]
+        # Oldest first: the slots from first to the end, then from the start
+        ordered = records[first * RECORD.size:] + records[:first * RECORD.size] \
+            if count == capacity else records[first * RECORD.size:(first + count) * RECORD.size]
+
+        samples = []
+        for values in RECORD.iter_unpack(ordered[:count * RECORD.size]):
+            sample = dict(zip(FIELDS, values))
+            for field, scale in SCALES.items():
+                sample[field] = sample[field] / scale
+            samples.append(sample)
+        return samples
+
+class Recorder:
+    """Samples the nucleus and the system every interval into a HistoryFile"""
+
+    def __init__(self, history, greengrass_dir, pid_path, interval):
+        self.history = history
+        self.greengrass_dir = greengrass_dir
+        self.pid_path = pid_path
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.pid = None
+        self.previous = None
+
+    def sample(self):
+        """Return one record's values, or None for the first sample (no CPU deltas yet)"""
+        now = time.monotonic()
+        if not self.pid or not is_nucleus(self.pid, self.greengrass_dir):
+            self.pid = find_nucleus(self.pid_path, self.greengrass_dir)
+        process = process_stats(self.pid) if self.pid else None
+        system = system_stats()
+
+        previous, self.previous = self.previous, (now, self.pid, process, system)
+        if not previous:
+            return None
+        previous_time, previous_pid, previous_process, previous_system = previous
+        elapsed = max(now - previous_time, 1e-3)
+
+        cpu = 0.0
+        if process and previous_process and previous_pid == self.pid:
+            cpu = 100 * (process['cpuSeconds'] - previous_process['cpuSeconds']) / elapsed
+        total = system['totalTicks'] - previous_system['totalTicks']
+        busy = system['busyTicks'] - previous_system['busyTicks']
+        system_cpu = 100 * busy / total if total > 0 else 0.0
+
+        process = process or {'residentBytes': 0, 'threads': 0, 'openFds': 0}
+        return (int(time.time()), self.pid or 0,
+                min(UINT16_MAX, round(cpu * SCALES['cpuPercent'])),
+                process['residentBytes'] // 1024,
+                min(UINT16_MAX, process['threads']),
+                min(UINT16_MAX, process['openFds']),
+                min(UINT16_MAX, round(system_cpu * SCALES['systemCpuPercent'])),
+                system['memAvailableKb'],
+                min(UINT16_MAX, round(system['load1'] * SCALES['load1'])))
+
+    def handle_signal(self, signum, frame):
+        self.stopping.set()
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+        self.history.open_for_writing()
+        print(f"Recording nucleus resource history every {self.interval:g}s in "
+              f"{self.history.path} ({self.history.capacity} records)")
+        try:
+            while True:
+                values = self.sample()
+                if values:
+                    self.history.append(values)
+                if self.stopping.wait(self.interval):
+                    return
+        finally:
+            self.history.close()
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    # Rounded first so that 0.9 * 10 ranks as 9, not 9.000000000000002
+    rank = math.ceil(round(fraction * len(sorted_values), 9))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+def trend_per_hour(samples, field):
+    """Least-squares slope of a field against time, in units per hour"""
+    times = [sample['time'] for sample in samples]
+    values = [sample[field] for sample in samples]
+    mean_time = sum(times) / len(times)
+    mean_value = sum(values) / len(values)
+    spread = sum((t - mean_time) ** 2 for t in times)
+    if not spread:
+        return 0.0
+    slope = sum((t - mean_time) * (v - mean_value) for t, v in zip(times, values)) / spread
+    return slope * 3600
+
+def summarize(samples):
+    """Return percentiles, trend and restart count for a window of samples"""
+    running = [sample for sample in samples if sample['pid']]
+    summary = {
+        'samples': len(samples),
+        'from': samples[0]['time'],
+        'to': samples[-1]['time'],
+        'nucleusDownSamples': len(samples) - len(running),
+        'nucleusRestarts': sum(1 for before, after in zip(running, running[1:])
+                               if before['pid'] != after['pid']),
+        'fields': {},
+    }
+    for field, _ in SUMMARY_FIELDS:
+        # Nucleus figures are only meaningful while it runs
+        window = running if field in ('cpuPercent', 'rssKb', 'threads', 'openFds') else samples
+        if not window:
+            continue
+        values = sorted(sample[field] for sample in window)
+        summary['fields'][field] = {
+            'min': values[0],
+            'p50': percentile(values, 0.50),
+            'p90': percentile(values, 0.90),
+            'p99': percentile(values, 0.99),
+            'max': values[-1],
+            'trendPerHour': round(trend_per_hour(window, field), 3),
+        }
+    return summary
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%SZ')
+
+def print_summary(summary):
+    print(f"{summary['samples']} samples from {format_time(summary['from'])} "
+          f"to {format_time(summary['to'])}")
+    print(f"Nucleus restarts: {summary['nucleusRestarts']}, "
+          f"samples without a nucleus: {summary['nucleusDownSamples']}")
+    print(f"\n{'metric':<22}{'min':>11}{'p50':>11}{'p90':>11}{'p99':>11}{'max':>11}"
+          f"{'trend/h':>12}")
+    for field, unit in SUMMARY_FIELDS:
+        stats = summary['fields'].get(field)
+        if not stats:
+            continue
+        label = f"{field} ({unit})" if unit else field
+        print(f"{label:<22}" + "".join(f"{stats[key]:>11.10g}" for key in
+                                         ('min', 'p50', 'p90', 'p99', 'max')) +
+              f"{stats['trendPerHour']:>+12.10g}")
+
+def export_samples(samples, path, as_json):
+    """Write samples as CSV or JSON to path, or to stdout for '-'"""
+    out = sys.stdout if path == '-' else open(path, 'w', newline='')
+    try:
+        if as_json:
+            json.dump(samples, out)
+            out.write("\n")
+        else:
+            writer = csv.DictWriter(out, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(samples)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    snap_common = os.environ.get('SNAP_COMMON', '/tmp')
+    # history.env lets the service's interval and capacity be changed without editing the snap
+    settings = read_env_file(f"{snap_common}/history.env")
+    parser = argparse.ArgumentParser(description="Record and summarise nucleus resource history")
+    parser.add_argument('--record', action='store_true',
+                        help="Sample the nucleus every --interval seconds until stopped")
+    parser.add_argument('--file', default=f"{snap_common}/resource-history.bin",
+                        help="Ring buffer file (default: $SNAP_COMMON/resource-history.bin)")
+    parser.add_argument('--interval', type=float,
+                        default=float(settings.get('HISTORY_INTERVAL') or 60),
+                        help="Seconds between samples when recording (default: 60)")
+    parser.add_argument('--capacity', type=int,
+                        default=int(settings.get('HISTORY_CAPACITY') or 10080),
+                        help="Records kept when recording; older ones are overwritten "
+                             "(default: 10080, a week at 60s)")
+    parser.add_argument('--greengrass-dir', default=f"{snap_common}/greengrass/v2",
+                        help="Greengrass root directory")
+    parser.add_argument('--pid-file', default=f"{snap_common}/greengrass-nucleus.pid",
+                        help="PID file written by greengrass-wrapper.sh")
+    parser.add_argument('--since', type=parse_time_arg,
+                        help="Only samples at or after this time (ISO 8601 or 30m/2h/7d ago)")
+    parser.add_argument('--until', type=parse_time_arg,
+                        help="Only samples at or before this time (ISO 8601 or 30m/2h/7d ago)")
+    parser.add_argument('--csv', metavar='FILE',
+                        help="Export the samples in the window as CSV ('-' for stdout)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="Export the samples in the window as JSON ('-' for stdout)")
+    parser.add_argument('--summary-json', action='store_true',
+                        help="Print the summary as JSON instead of a table")
+    args = parser.parse_args(argv)
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    if args.capacity < 2:
+        parser.error("--capacity must be at least 2")
+    return args
+
+def main():
+    args = parse_args()
+
+    if args.record:
+        # Messages go to the journal through a pipe; show them as they happen
+        sys.stdout.reconfigure(line_buffering=True)
+        history = HistoryFile(args.file, args.capacity, args.interval)
+        Recorder(history, args.greengrass_dir.rstrip('/'), args.pid_file, args.interval).run()
+        return
+
+    try:
+        samples = HistoryFile(args.file).read()
+    except FileNotFoundError:
+        print(f"No resource history at {args.file}; is the greengrass-history service running?")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    since = args.since.timestamp() if args.since else None
+    until = args.until.timestamp() if args.until else None
+    samples = [sample for sample in samples
+               if (since is None or sample['time'] >= since) and
+               (until is None or sample['time'] <= until)]
+    if not samples:
+        print("No samples in the selected window")
+        sys.exit(1)
+
+    try:
+        if args.csv:
+            export_samples(samples, args.csv, as_json=False)
+        if args.json:
+            export_samples(samples, args.json, as_json=True)
+        if '-' in (args.csv, args.json):
+            return
+
+        summary = summarize(samples)
+        if args.summary_json:
+            print(json.dumps(summary, indent=2))
+        else:
+            print_summary(summary)
+    except BrokenPipeError:
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
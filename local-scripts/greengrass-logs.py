@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Query and follow Greengrass logs, including rotated files
+
+Files are read backwards from the end in fixed-size blocks, so memory use
+does not depend on how large the logs have grown.
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import argparse
+from datetime import datetime, timezone
+
+from greengrass_common import parse_time_arg, read_ram_logs_dir
+
+LEVELS = ['TRACE', 'DEBUG', 'INFO', 'WARN', 'ERROR']
+
+# 2024-01-01T12:00:00.000Z [INFO] (main) com.aws.greengrass.Foo: event-name. {key=value, ...}
+TEXT_LINE = re.compile(
+    r"^(?P<timestamp>\d{4}-\d{2}-\d{2}T\S+) \[(?P<level>[A-Z]+)\] \((?P<thread>[^)]*)\) "
+    r"(?P<logger>[^:\s]+): (?P<event>.*?)(?: \{(?P<context>.*)\})?$"
+)
+SERVICE_NAME = re.compile(r"(?:^|, )serviceName=([^,}]+)")
+
+BLOCK_SIZE = 64 * 1024
+MAX_CONTINUATION_LINES = 200
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp or epoch milliseconds into an aware datetime"""
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def parse_line(line, default_component):
+    """Parse a Greengrass text or JSON log line into fields, or None"""
+    if line.startswith('{'):
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return None
+        contexts = data.get('contexts') or {}
+        return {
+            'timestamp': parse_timestamp(data.get('timestamp', '')),
+            'level': data.get('level', ''),
+            'thread': data.get('thread', ''),
+            'logger': data.get('loggerName', ''),
+            'event': data.get('eventType') or data.get('message', ''),
+            'component': contexts.get('serviceName', default_component),
+        }
+
+    match = TEXT_LINE.match(line)
+    if not match:
+        return None
+    service = SERVICE_NAME.search(match.group('context') or '')
+    return {
+        'timestamp': parse_timestamp(match.group('timestamp')),
+        'level': match.group('level'),
+        'thread': match.group('thread'),
+        'logger': match.group('logger'),
+        'event': match.group('event').rstrip('.'),
+        'component': service.group(1) if service else default_component,
+    }
+
+def log_files(logs_dir, name, ram_logs_dir=None):
+    """Return the current log and its rotated siblings, newest first
+
+    With a RAM log directory, a file there is preferred over its copy in
+    logs_dir, which may be up to one flush interval behind.
+    """
+    files = {}
+    for directory in filter(None, (logs_dir, ram_logs_dir)):
+        for path in glob.glob(f"{directory}/{glob.escape(name)}_*.log"):
+            files[os.path.basename(path)] = path
+    rotated = sorted(files.values(), key=os.path.getmtime, reverse=True)
+    current = [f"{directory}/{name}.log" for directory in filter(None, (ram_logs_dir, logs_dir))
+               if os.path.exists(f"{directory}/{name}.log")]
+    return current[:1] + rotated
+
+def read_lines_backwards(path):
+    """Yield the lines of a file from last to first, reading fixed-size blocks"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b''
+        while position > 0:
+            read_size = min(BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size) + remainder
+            lines = block.split(b'\n')
+            # The first piece may be the tail of a line in the previous block
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode('utf-8', 'replace')
+        if remainder:
+            yield remainder.decode('utf-8', 'replace')
+
+def entries_backwards(paths, default_component):
+    """Yield (fields, lines) log entries from newest to oldest
+
+    Lines that don't parse (such as stack traces) are attached to the entry
+    they follow.
+    """
+    for path in paths:
+        continuation = []
+        for line in read_lines_backwards(path):
+            fields = parse_line(line, default_component)
+            if fields is None:
+                if len(continuation) < MAX_CONTINUATION_LINES:
+                    continuation.append(line)
+                continue
+            yield fields, [line] + continuation[::-1]
+            continuation = []
+
+class EntryFilter:
+    """Component, level and time-range filter for parsed entries"""
+
+    def __init__(self, component=None, level=None, since=None, until=None):
+        self.component = component
+        self.min_level = LEVELS.index(level) if level else 0
+        self.since = since
+        self.until = until
+
+    def matches(self, fields):
+        if self.component and fields['component'] != self.component:
+            return False
+        if fields['level'] in LEVELS and LEVELS.index(fields['level']) < self.min_level:
+            return False
+        timestamp = fields['timestamp']
+        if timestamp:
+            if self.since and timestamp < self.since:
+                return False
+            if self.until and timestamp > self.until:
+                return False
+        return True
+
+    def before_range(self, fields):
+        """True if this entry, and so everything older, is before --since"""
+        return bool(self.since and fields['timestamp'] and fields['timestamp'] < self.since)
+
+def format_entry(fields, lines, as_json):
+    if as_json:
+        record = dict(fields)
+        record['timestamp'] = fields['timestamp'].isoformat() if fields['timestamp'] else None
+        record['raw'] = "\n".join(lines)
+        return json.dumps(record)
+    return "\n".join(lines)
+
+def show_recent(paths, entry_filter, count, default_component, as_json):
+    """Print the newest count matching entries in chronological order"""
+    matches = []
+    for fields, lines in entries_backwards(paths, default_component):
+        if entry_filter.before_range(fields):
+            break
+        if entry_filter.matches(fields):
+            matches.append(format_entry(fields, lines, as_json))
+            if len(matches) >= count:
+                break
+    for entry in reversed(matches):
+        print(entry)
+
+def show_all(paths, entry_filter, default_component, as_json):
+    """Stream every matching entry oldest first without buffering the logs"""
+    for path in reversed(paths):
+        if entry_filter.since and os.path.getmtime(path) < entry_filter.since.timestamp():
+            continue
+        with open(path, 'r', errors='replace') as f:
+            matched = False
+            for line in f:
+                line = line.rstrip('\n')
+                fields = parse_line(line, default_component)
+                if fields is None:
+                    # Continuation lines follow the entry they belong to
+                    if matched and not as_json:
+                        print(line)
+                    continue
+                matched = entry_filter.matches(fields)
+                if matched:
+                    print(format_entry(fields, [line], as_json))
+
+def follow(path, entry_filter, default_component, as_json, interval=0.5):
+    """Print matching entries as they are appended, surviving log rotation"""
+    handle = None
+    inode = None
+    # Output already shown is skipped, but a file created later (or the new
+    # file after a rotation) is read from the start
+    skip_existing = os.path.exists(path)
+    partial = b''
+    try:
+        while True:
+            if handle is None and os.path.exists(path):
+                handle = open(path, 'rb')
+                inode = os.fstat(handle.fileno()).st_ino
+                if skip_existing:
+                    handle.seek(0, os.SEEK_END)
+                skip_existing = False
+
+            chunk = handle.readline() if handle else b''
+            if chunk:
+                partial += chunk
+                if not partial.endswith(b'\n'):
+                    continue
+                line = partial.rstrip(b'\n').decode('utf-8', 'replace')
+                partial = b''
+                fields = parse_line(line, default_component)
+                if fields is None or entry_filter.matches(fields):
+                    print(format_entry(fields, [line], as_json) if fields else line, flush=True)
+                continue
+
+            if handle:
+                try:
+                    rotated = os.stat(path).st_ino != inode or os.path.getsize(path) < handle.tell()
+                except OSError:
+                    rotated = True
+                if rotated:
+                    handle.close()
+                    handle = None
+                    partial = b''
+                    continue
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if handle:
+            handle.close()
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    default_logs = f"{os.environ.get('SNAP_COMMON', '/tmp')}/greengrass/v2/logs"
+    parser = argparse.ArgumentParser(description="Query and follow Greengrass logs")
+    parser.add_argument('--logs-dir', default=default_logs,
+                        help=f"Greengrass logs directory (default: {default_logs})")
+    parser.add_argument('--ram-logs-dir',
+                        default=read_ram_logs_dir(f"{os.environ.get('SNAP_COMMON', '/tmp')}/logging.env"),
+                        help="RAM log directory, when logging.ramDirectory is enabled "
+                             "(default: from $SNAP_COMMON/logging.env)")
+    parser.add_argument('--file', default='greengrass',
+                        help="Log to read: 'greengrass' or a component name (default: greengrass)")
+    parser.add_argument('-n', '--lines', type=int, default=50,
+                        help="Number of most recent matching entries to show; 0 shows all "
+                             "(default: 50)")
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help="Keep printing new entries as they are logged")
+    parser.add_argument('--component', help="Only entries for this component (serviceName)")
+    parser.add_argument('--level', type=str.upper, choices=LEVELS,
+                        help="Only entries at this level or above")
+    parser.add_argument('--since', type=parse_time_arg,
+                        help="Only entries at or after this time (ISO 8601 or 30s/10m/2h/1d ago)")
+    parser.add_argument('--until', type=parse_time_arg,
+                        help="Only entries at or before this time (ISO 8601 or 30s/10m/2h/1d ago)")
+    parser.add_argument('--json', action='store_true', help="Print parsed entries as JSON lines")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    paths = log_files(args.logs_dir, args.file, args.ram_logs_dir)
+    if not paths and not args.follow:
+        print(f"No {args.file} logs found in {args.ram_logs_dir or args.logs_dir}")
+        sys.exit(1)
+
+    default_component = None if args.file == 'greengrass' else args.file
+    entry_filter = EntryFilter(args.component, args.level, args.since, args.until)
+
+    try:
+        if args.lines > 0:
+            show_recent(paths, entry_filter, args.lines, default_component, args.json)
+        else:
+            show_all(paths, entry_filter, default_component, args.json)
+    except BrokenPipeError:
+        sys.exit(0)
+
+    if args.follow:
+        follow(f"{args.ram_logs_dir or args.logs_dir}/{args.file}.log", entry_filter,
+               default_component, args.json)
+
+if __name__ == "__main__":
+    main()
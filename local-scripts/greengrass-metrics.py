@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Prometheus metrics for the Greengrass nucleus run by greengrass-daemon
+
+Everything is read from /proc and $SNAP_COMMON when a scrape arrives, so
+nothing runs between scrapes.  Repeated scrapes within --min-interval
+seconds are served from the previous sample.
+"""
+import os
+import sys
+import json
+import time
+import calendar
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from greengrass_common import boot_time, find_nucleus, process_stats, read_ram_logs_dir
+
+LAUNCH_MARKER = b"Launched Nucleus successfully"
+# How much of greengrass.log is searched for the launch marker
+LAUNCH_SEARCH_BYTES = 1024 * 1024
+
+def last_record(history_path):
+    """Return the newest record in a JSON-lines history file, or {}"""
+    try:
+        with open(history_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 4096))
+            lines = f.read().splitlines()
+        return json.loads(lines[-1]) if lines else {}
+    except (OSError, ValueError):
+        return {}
+
+def log_bytes(logs_dir):
+    """Total size of the nucleus and component logs"""
+    total = 0
+    try:
+        with os.scandir(logs_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    total += entry.stat().st_size
+    except OSError:
+        pass
+    return total
+
+def nucleus_launch_time(log_path, started):
+    """Return when the nucleus logged a successful launch after started, or None
+
+    Only the end of greengrass.log is read, and callers ask once per PID.
+    """
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - LAUNCH_SEARCH_BYTES))
+            data = f.read()
+    except OSError:
+        return None
+
+    for line in reversed(data.splitlines()):
+        if LAUNCH_MARKER in line:
+            try:
+                stamp = time.strptime(line.split()[0][:19].decode(), "%Y-%m-%dT%H:%M:%S")
+            except (IndexError, ValueError, UnicodeError):
+                return None
+            launched = calendar.timegm(stamp)
+            return launched if launched >= int(started) else None
+    return None
+
+class NucleusMetrics:
+    """Samples the nucleus and renders Prometheus text exposition format"""
+
+    def __init__(self, greengrass_dir, pid_path, history_path, crash_history_path, min_interval,
+                 logs_dir=None):
+        self.greengrass_dir = greengrass_dir
+        self.logs_dir = logs_dir or f"{greengrass_dir}/logs"
+        self.pid_path = pid_path
+        self.history_path = history_path
+        self.crash_history_path = crash_history_path
+        self.crash_loop_path = f"{os.path.dirname(crash_history_path)}/crash-loop.json"
+        self.min_interval = min_interval
+        self.btime = boot_time()
+        self.sampled = 0.0
+        self.text = ''
+        self.pid = None
+        self.launch_seconds = None
+        self.last_log = None
+        self.log_rate = 0.0
+
+    def sample(self):
+        """Return the metrics text, refreshing it at most every min_interval seconds"""
+        now = time.monotonic()
+        if self.text and now - self.sampled < self.min_interval:
+            return self.text
+
+        pid = find_nucleus(self.pid_path, self.greengrass_dir)
+        stats = process_stats(pid, self.btime) if pid else None
+        if pid != self.pid:
+            self.pid = pid
+            self.launch_seconds = None
+        if stats and self.launch_seconds is None:
+            launched = nucleus_launch_time(f"{self.logs_dir}/greengrass.log",
+                                           stats['startTime'])
+            if launched:
+                self.launch_seconds = max(0.0, launched - stats['startTime'])
+
+        logs = log_bytes(self.logs_dir)
+        if self.last_log:
+            previous_bytes, previous_time = self.last_log
+            # Rotation shrinks the directory; count only growth
+            self.log_rate = max(0, logs - previous_bytes) / max(now - previous_time, 1e-3)
+        self.last_log = (logs, now)
+
+        launch = last_record(self.history_path)
+        crash = last_record(self.crash_history_path)
+        lines = []
+
+        def metric(name, kind, help_text, value):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+
+        metric('greengrass_nucleus_up', 'gauge', "1 if the nucleus JVM is running",
+               1 if stats else 0)
+        if stats:
+            metric('greengrass_nucleus_pid', 'gauge', "Process ID of the nucleus JVM", pid)
+            metric('greengrass_nucleus_start_time_seconds', 'gauge',
+                   "Start time of the nucleus JVM since the epoch", round(stats['startTime'], 2))
+            metric('greengrass_nucleus_cpu_seconds_total', 'counter',
+                   "User and system CPU time of the nucleus JVM", round(stats['cpuSeconds'], 2))
+            metric('greengrass_nucleus_resident_memory_bytes', 'gauge',
+                   "Resident set size of the nucleus JVM", stats['residentBytes'])
+            metric('greengrass_nucleus_threads', 'gauge', "Threads in the nucleus JVM",
+                   stats['threads'])
+            metric('greengrass_nucleus_open_fds', 'gauge',
+                   "Open file descriptors of the nucleus JVM", stats['openFds'])
+        if self.launch_seconds is not None:
+            metric('greengrass_nucleus_launch_seconds', 'gauge',
+                   "Seconds from JVM start until the nucleus logged a successful launch",
+                   round(self.launch_seconds, 3))
+        if launch:
+            metric('greengrass_daemon_launches_total', 'counter',
+                   "Times greengrass-daemon has launched the nucleus", launch.get('launch', 1))
+            metric('greengrass_daemon_restarts_total', 'counter',
+                   "Times greengrass-daemon has relaunched the nucleus",
+                   max(0, launch.get('launch', 1) - 1))
+            metric('greengrass_daemon_time_to_launch_seconds', 'gauge',
+                   "Seconds the last daemon start waited for install, network and clock",
+                   launch.get('timeToLaunchSeconds', 0))
+        if crash:
+            metric('greengrass_nucleus_crashes_total', 'counter',
+                   "Times the supervisor saw the nucleus crash", crash.get('crash', 1))
+            metric('greengrass_nucleus_last_crash_exit_code', 'gauge',
+                   "Exit code of the most recent crash (negative for a signal)",
+                   crash.get('exitCode', 0))
+            metric('greengrass_supervisor_crash_loop', 'gauge',
+                   "1 if the supervisor stopped restarting a crash-looping nucleus",
+                   1 if os.path.exists(self.crash_loop_path) else 0)
+        metric('greengrass_log_bytes', 'gauge', "Total size of the Greengrass logs directory", logs)
+        metric('greengrass_log_growth_bytes_per_second', 'gauge',
+               "Growth rate of the logs directory since the previous scrape",
+               round(self.log_rate, 1))
+
+        self.text = "\n".join(lines) + "\n"
+        self.sampled = now
+        return self.text
+
+def make_handler(metrics):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = metrics.sample().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    snap_common = os.environ.get('SNAP_COMMON', '/tmp')
+    parser = argparse.ArgumentParser(description="Prometheus metrics for the Greengrass nucleus")
+    parser.add_argument('--address', default='127.0.0.1',
+                        help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=9181,
+                        help="Port to listen on (default: 9181)")
+    parser.add_argument('--greengrass-dir', default=f"{snap_common}/greengrass/v2",
+                        help="Greengrass root directory")
+    parser.add_argument('--pid-file', default=f"{snap_common}/greengrass-nucleus.pid",
+                        help="PID file written by greengrass-wrapper.sh")
+    parser.add_argument('--history', default=f"{snap_common}/launch-history.jsonl",
+                        help="Launch history written by greengrass-wait-ready")
+    parser.add_argument('--crash-history', default=f"{snap_common}/crash-history.jsonl",
+                        help="Crash history written by greengrass-supervisor")
+    parser.add_argument('--logs-dir',
+                        default=read_ram_logs_dir(f"{snap_common}/logging.env"),
+                        help="Directory the nucleus logs to (default: the RAM log directory "
+                             "from $SNAP_COMMON/logging.env, else the Greengrass logs directory)")
+    parser.add_argument('--min-interval', type=float, default=5,
+                        help="Seconds a sample is reused for repeated scrapes (default: 5)")
+    parser.add_argument('--once', action='store_true',
+                        help="Print the metrics once and exit")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    metrics = NucleusMetrics(args.greengrass_dir.rstrip('/'), args.pid_file, args.history,
+                             args.crash_history, args.min_interval, args.logs_dir)
+    if args.once:
+        sys.stdout.write(metrics.sample())
+        return
+
+    server = HTTPServer((args.address, args.port), make_handler(metrics))
+    print(f"Serving Greengrass metrics on http://{args.address}:{args.port}/metrics")
+    try:
+        server.serve_forever(poll_interval=3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
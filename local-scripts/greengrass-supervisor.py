@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""Run the nucleus JVM and restart it after crashes without re-running the wrapper
+
+greengrass-wrapper.sh resolves Java, the jar and the JVM options once and
+execs this script with the complete java command line.  The first crash is
+restarted straight away; further consecutive crashes wait with exponential
+backoff up to a cap.  A run longer than --stable-seconds resets the count.
+After --max-crashes consecutive crashes the supervisor gives up, writes
+$SNAP_COMMON/crash-loop.json and stays running without the nucleus until
+the service is stopped, because snapd restarts the daemon whenever it
+exits.  A nucleus that asks for a device reboot is not restarted either.
+Each crash is appended to $SNAP_COMMON/crash-history.jsonl.
+
+With --ram-log-dir the nucleus logs to a RAM directory and the supervisor
+appends what is new in each log to the same file in --log-dir every
+--flush-interval seconds and when the nucleus stops, so the SD card sees a
+few batched writes instead of one per log line.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import datetime
+import argparse
+import threading
+import subprocess
+
+from greengrass_common import append_history
+
+# Exit code the nucleus uses to ask its service manager for a restart,
+# for example after a nucleus update
+NUCLEUS_RESTART_CODE = 100
+# Exit code the nucleus uses to ask for a device reboot
+NUCLEUS_REBOOT_CODE = 101
+
+FLUSH_CHUNK_BYTES = 1024 * 1024
+
+def backoff_delay(consecutive, base, cap):
+    """Seconds to wait before restarting after the given number of consecutive crashes"""
+    if consecutive <= 1:
+        return 0.0
+    return min(cap, base * 2 ** (consecutive - 2))
+
+def count_crash(consecutive, uptime, stable_seconds):
+    """Return the consecutive crash count after a crash following uptime seconds of running"""
+    return 1 if uptime >= stable_seconds else consecutive + 1
+
+def signal_name(code):
+    """Return the name of the signal that ended a process with this exit code"""
+    try:
+        return signal.Signals(-code).name
+    except ValueError:
+        return str(-code)
+
+def read_boot_id():
+    """Return the kernel boot ID; RAM log inodes are only meaningful within one boot"""
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+class LogFlusher:
+    """Copies new log data from the RAM log directory to persistent storage
+
+    Each RAM log is mirrored by a file of the same name in log_dir.  The
+    offset copied so far is tracked per inode in log_dir/.flush-state.json,
+    so a log the nucleus rotates under a new name keeps its mirror and
+    offset, and a new or truncated file is copied from the start.  A mirror
+    left by a previous boot is renamed aside rather than overwritten.  The
+    oldest mirrors not backed by a RAM log are pruned to persistent_kb.
+    """
+
+    def __init__(self, ram_dir, log_dir, interval, persistent_kb):
+        self.ram_dir = ram_dir
+        self.log_dir = log_dir
+        self.interval = interval
+        self.persistent_bytes = persistent_kb * 1024
+        self.state_path = f"{log_dir}/.flush-state.json"
+        self.boot_id = read_boot_id()
+        self.state = self.load_state()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='log-flusher', daemon=True)
+
+    def load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if state.get('bootId') != self.boot_id:
+            return {}
+        return state.get('files', {})
+
+    def save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'bootId': self.boot_id, 'files': self.state}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def set_aside(self, name):
+        """Rename a mirror from an earlier boot out of the way of a new RAM log"""
+        path = f"{self.log_dir}/{name}"
+        stamp = datetime.datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y_%m_%d_%H_%M_%S')
+        os.replace(path, f"{self.log_dir}/{name[:-len('.log')]}_{stamp}_boot.log")
+
+    def copy_new_data(self, name, size, offset):
+        """Append bytes offset..size of a RAM log to its mirror; returns the new offset"""
+        with open(f"{self.ram_dir}/{name}", 'rb') as source, \
+                open(f"{self.log_dir}/{name}", 'ab' if offset else 'wb') as target:
+            source.seek(offset)
+            while offset < size:
+                data = source.read(min(FLUSH_CHUNK_BYTES, size - offset))
+                if not data:
+                    break
+                target.write(data)
+                offset += len(data)
+            target.flush()
+            os.fsync(target.fileno())
+        return offset
+
+    def flush(self):
+        """Copy everything new in the RAM directory; returns the number of bytes copied"""
+        try:
+            current = {entry.name: entry.stat() for entry in os.scandir(self.ram_dir)
+                       if entry.name.endswith('.log') and entry.is_file()}
+        except OSError as e:
+            print(f"Could not read RAM log directory: {e}")
+            return 0
+
+        # Follow rotations first so a rotated mirror is out of the way of the new log
+        names_by_inode = {entry['inode']: name for name, entry in self.state.items()}
+        carried = {}
+        for name, stat in current.items():
+            previous = names_by_inode.get(stat.st_ino)
+            if previous is None:
+                continue
+            carried[name] = self.state[previous]
+            if previous != name and os.path.exists(f"{self.log_dir}/{previous}"):
+                os.replace(f"{self.log_dir}/{previous}", f"{self.log_dir}/{name}")
+
+        copied = 0
+        state = {}
+        for name, stat in sorted(current.items()):
+            entry = carried.get(name)
+            offset = entry['offset'] if entry else 0
+            if stat.st_size < offset:
+                offset = 0
+            try:
+                if not entry and os.path.exists(f"{self.log_dir}/{name}"):
+                    self.set_aside(name)
+                new_offset = self.copy_new_data(name, stat.st_size, offset)
+            except OSError as e:
+                # The nucleus may delete a rotated log between scandir and open
+                print(f"Could not flush {name}: {e}")
+                continue
+            copied += new_offset - offset
+            state[name] = {'inode': stat.st_ino, 'offset': new_offset}
+        self.state = state
+
+        try:
+            self.save_state()
+            self.prune(set(current))
+        except OSError as e:
+            print(f"Could not update persistent logs: {e}")
+        return copied
+
+    def prune(self, active):
+        """Delete the oldest mirrors without a RAM log until the directory fits its cap"""
+        files = []
+        for entry in os.scandir(self.log_dir):
+            if entry.name.endswith('.log') and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        total = sum(size for _, _, size in files)
+        for _, name, size in sorted(files):
+            if total <= self.persistent_bytes:
+                break
+            if name in active:
+                continue
+            os.remove(f"{self.log_dir}/{name}")
+            total -= size
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop the periodic flush and copy what the nucleus wrote last"""
+        self.stopped.set()
+        self.thread.join()
+        print(f"Flushed {self.flush()} bytes of logs to {self.log_dir}")
+
+class Supervisor:
+    """Keeps one nucleus JVM running and forwards stop signals to it"""
+
+    def __init__(self, command, args):
+        self.command = command
+        self.args = args
+        self.child = None
+        self.stopping = threading.Event()
+
+    def handle_signal(self, signum, frame):
+        self.stopping.set()
+        if self.child and self.child.poll() is None:
+            self.child.send_signal(signum)
+
+    def launch(self):
+        self.child = subprocess.Popen(self.command)
+        try:
+            with open(self.args.pid_file, 'w') as f:
+                f.write(f"{self.child.pid}\n")
+        except OSError as e:
+            print(f"Could not write PID file: {e}")
+        return time.monotonic()
+
+    def idle(self):
+        """Wait without a nucleus until the service is stopped"""
+        self.stopping.wait()
+        return 0
+
+    def run(self):
+        """Supervise until stopped; returns the exit code"""
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.handle_signal)
+
+        for path in (self.args.crash_loop_file, self.args.reboot_request_file):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        consecutive = 0
+        while True:
+            started = self.launch()
+            print(f"Nucleus started with PID {self.child.pid}")
+            # wait() is retried across the signal handler, so this returns
+            # only when the JVM has exited
+            code = self.child.wait()
+            uptime = time.monotonic() - started
+
+            if self.stopping.is_set():
+                print(f"Nucleus stopped with exit code {code}")
+                return 0
+            if code == 0:
+                print("Nucleus exited normally")
+                return 0
+
+            if code == NUCLEUS_REBOOT_CODE:
+                print("Nucleus requested a device reboot; not restarting it until the device "
+                      "reboots or 'snap restart aws-iot-greengrass.greengrass-daemon' is run")
+                with open(self.args.reboot_request_file, 'w') as f:
+                    json.dump({'time': time.time()}, f)
+                return self.idle()
+            if code == NUCLEUS_RESTART_CODE:
+                print("Nucleus requested a restart")
+                consecutive = 0
+                delay = 0.0
+            else:
+                consecutive = count_crash(consecutive, uptime, self.args.stable_seconds)
+                giving_up = consecutive >= self.args.max_crashes
+                delay = None if giving_up else backoff_delay(consecutive, self.args.backoff_base,
+                                                             self.args.backoff_cap)
+                append_history(self.args.crash_history, {
+                    'time': time.time(),
+                    'exitCode': code,
+                    'signal': signal_name(code) if code < 0 else None,
+                    'uptimeSeconds': round(uptime, 3),
+                    'consecutive': consecutive,
+                    'restartDelaySeconds': delay,
+                }, 'crash')
+                print(f"Nucleus crashed with exit code {code} after {uptime:.1f}s "
+                      f"({consecutive} in a row)")
+
+                if giving_up:
+                    print(f"Nucleus crashed {consecutive} times in a row; not restarting. "
+                          f"Run 'snap restart aws-iot-greengrass.greengrass-daemon' to try again")
+                    with open(self.args.crash_loop_file, 'w') as f:
+                        json.dump({'time': time.time(), 'crashes': consecutive,
+                                   'lastExitCode': code}, f)
+                    return self.idle()
+
+            if delay:
+                print(f"Restarting nucleus in {delay:.1f}s")
+                if self.stopping.wait(delay):
+                    return 0
+            append_history(self.args.launch_history, {
+                'time': time.time(),
+                'timeToLaunchSeconds': delay,
+                'supervisorRestart': True,
+                'exitCode': code,
+            }, 'launch')
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    snap_common = os.environ.get('SNAP_COMMON', '/tmp')
+    parser = argparse.ArgumentParser(description="Supervise the Greengrass nucleus JVM",
+                                     usage="%(prog)s [options] -- java [java options]")
+    parser.add_argument('--max-crashes', type=int, default=5,
+                        help="Consecutive crashes before giving up (default: 5)")
+    parser.add_argument('--backoff-base', type=float, default=5,
+                        help="Delay before the second restart in a row, doubled for each "
+                             "further crash (default: 5)")
+    parser.add_argument('--backoff-cap', type=float, default=300,
+                        help="Longest delay between restarts (default: 300)")
+    parser.add_argument('--stable-seconds', type=float, default=600,
+                        help="Run time after which a crash no longer counts as part of a "
+                             "crash loop (default: 600)")
+    parser.add_argument('--pid-file', default=f"{snap_common}/greengrass-nucleus.pid",
+                        help="File the nucleus PID is written to")
+    parser.add_argument('--crash-history', default=f"{snap_common}/crash-history.jsonl",
+                        help="File crash records are appended to")
+    parser.add_argument('--launch-history', default=f"{snap_common}/launch-history.jsonl",
+                        help="File restart launch records are appended to")
+    parser.add_argument('--crash-loop-file', default=f"{snap_common}/crash-loop.json",
+                        help="Written when the supervisor gives up")
+    parser.add_argument('--reboot-request-file', default=f"{snap_common}/reboot-requested.json",
+                        help="Written when the nucleus asks for a device reboot")
+    parser.add_argument('--ram-log-dir',
+                        help="RAM directory the nucleus logs to; its logs are copied to "
+                             "--log-dir periodically")
+    parser.add_argument('--log-dir',
+                        help="Persistent log directory the RAM logs are copied to")
+    parser.add_argument('--flush-interval', type=float, default=300,
+                        help="Seconds between copies of the RAM logs (default: 300)")
+    parser.add_argument('--persistent-kb', type=int, default=51200,
+                        help="Most space the copied logs may take in --log-dir (default: 51200)")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="The java command line, after --")
+    args = parser.parse_args(argv)
+    if args.command and args.command[0] == '--':
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error("no command given")
+    if args.max_crashes < 1:
+        parser.error("--max-crashes must be at least 1")
+    if args.ram_log_dir and not args.log_dir:
+        parser.error("--ram-log-dir needs --log-dir")
+    if args.flush_interval <= 0:
+        parser.error("--flush-interval must be positive")
+    return args
+
+def main():
+    args = parse_args()
+    # Messages go to the journal through a pipe; show them as they happen
+    sys.stdout.reconfigure(line_buffering=True)
+
+    flusher = None
+    if args.ram_log_dir:
+        os.makedirs(args.ram_log_dir, exist_ok=True)
+        os.makedirs(args.log_dir, exist_ok=True)
+        flusher = LogFlusher(args.ram_log_dir, args.log_dir, args.flush_interval,
+                             args.persistent_kb)
+        flusher.start()
+    try:
+        code = Supervisor(args.command, args).run()
+    finally:
+        if flusher:
+            flusher.stop()
+    sys.exit(code)
+
+if __name__ == "__main__":
+    main()
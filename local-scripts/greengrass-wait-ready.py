@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Wait until Greengrass is installed, the network is up and the clock is synced
+
+Used by greengrass-wrapper.sh instead of fixed sleeps.  Launch timings are
+appended to $SNAP_COMMON/launch-history.jsonl.
+"""
+import os
+import sys
+import time
+import ctypes
+import select
+import argparse
+
+from greengrass_common import append_history
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+TIME_ERROR = 5
+TIMESYNC_MARKER = "/run/systemd/timesync/synchronized"
+
+class DirectoryWatcher:
+    """Wait for changes in a set of directories using inotify
+
+    Falls back to plain timed waits if inotify is not available, so callers
+    always re-check their condition after wait() returns.
+    """
+
+    def __init__(self):
+        self.fd = -1
+        self.libc = None
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            self.fd = -1
+        if self.fd < 0:
+            print("inotify unavailable, falling back to polling")
+
+    def wait(self, directories, timeout):
+        """Wait until something changes in one of the directories or timeout"""
+        if self.fd < 0:
+            time.sleep(timeout)
+            return
+
+        for directory in directories:
+            if os.path.isdir(directory):
+                # Re-adding an existing watch is a no-op, so newly created
+                # directories are picked up on the next call
+                self.libc.inotify_add_watch(self.fd, directory.encode(), WATCH_MASK)
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def install_complete(greengrass_dir):
+    """Return True once configure/bootstrap finished installing Greengrass
+
+    New installs leave a .install-complete marker; older installs are
+    recognised by the installer's alts/current or effective config.
+    """
+    if not os.path.isfile(f"{greengrass_dir}/lib/Greengrass.jar"):
+        return False
+    return any(os.path.exists(f"{greengrass_dir}/{path}") for path in (
+        ".install-complete",
+        "alts/current",
+        "config/effectiveConfig.yaml",
+    ))
+
+def network_ready():
+    """Return True if the kernel has a default route on an interface that is up"""
+    try:
+        with open("/proc/net/route", 'r') as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                # Destination 0.0.0.0 with the RTF_UP flag set
+                if len(fields) > 3 and fields[1] == "00000000" and int(fields[3], 16) & 0x1:
+                    return True
+    except (OSError, StopIteration, ValueError):
+        pass
+
+    try:
+        with open("/proc/net/ipv6_route", 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 10 and fields[0] == "0" * 32 and fields[1] == "00" \
+                        and fields[9] != "lo" and int(fields[8], 16) & 0x1:
+                    return True
+    except (OSError, ValueError):
+        pass
+
+    return False
+
+def clock_synchronized():
+    """Return True if the system clock is synchronised
+
+    Uses the systemd-timesyncd marker when visible and otherwise asks the
+    kernel with a read-only adjtimex call.  If neither is available the
+    clock is accepted when it is not obviously unset.
+    """
+    if os.path.exists(TIMESYNC_MARKER):
+        return True
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        # struct timex with modes = 0 only reads the kernel clock state;
+        # the buffer is larger than the struct on every architecture
+        timex = ctypes.create_string_buffer(512)
+        state = libc.adjtimex(timex)
+        if state >= 0:
+            return state != TIME_ERROR
+    except (OSError, AttributeError):
+        pass
+
+    return time.gmtime().tm_year >= 2024
+
+def wait_for(name, check, timeout, watcher, watch_dirs=(), interval=2.0):
+    """Wait until check() is true; returns (satisfied, seconds waited)
+
+    A timeout of None waits forever and a timeout of 0 skips the check.
+    """
+    start = time.monotonic()
+    if timeout == 0:
+        return True, 0.0
+
+    reported = False
+    while not check():
+        waited = time.monotonic() - start
+        if timeout is not None and waited >= timeout:
+            print(f"{name} not ready after {waited:.0f}s, continuing anyway")
+            return False, waited
+        if not reported:
+            print(f"Waiting for {name}...")
+            reported = True
+        remaining = interval if timeout is None else min(interval, timeout - waited)
+        if watch_dirs:
+            watcher.wait(watch_dirs, max(remaining, 0.1))
+        else:
+            time.sleep(max(remaining, 0.1))
+
+    waited = time.monotonic() - start
+    print(f"{name} ready after {waited:.1f}s")
+    return True, waited
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    snap_common = os.environ.get('SNAP_COMMON', '/tmp')
+    parser = argparse.ArgumentParser(description="Wait until Greengrass can be launched")
+    parser.add_argument('--greengrass-dir', default=f"{snap_common}/greengrass/v2",
+                        help="Greengrass root directory")
+    parser.add_argument('--network-timeout', type=float, default=120,
+                        help="Seconds to wait for a default route; 0 skips the check (default: 120)")
+    parser.add_argument('--clock-timeout', type=float, default=120,
+                        help="Seconds to wait for clock synchronisation; 0 skips the check "
+                             "(default: 120)")
+    parser.add_argument('--history', default=f"{snap_common}/launch-history.jsonl",
+                        help="File that launch timings are appended to")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    start = time.monotonic()
+    greengrass_dir = args.greengrass_dir.rstrip('/')
+    watcher = DirectoryWatcher()
+
+    # Watch every level that may not exist yet so each creation wakes us up
+    parent = os.path.dirname(greengrass_dir)
+    watch_dirs = [os.path.dirname(parent), parent, greengrass_dir,
+                  f"{greengrass_dir}/lib", f"{greengrass_dir}/alts", f"{greengrass_dir}/config"]
+
+    try:
+        _, install_wait = wait_for("Greengrass installation", lambda: install_complete(greengrass_dir),
+                                   None, watcher, watch_dirs, interval=30)
+        network_ok, network_wait = wait_for("network", network_ready, args.network_timeout, watcher)
+        clock_ok, clock_wait = wait_for("clock synchronisation", clock_synchronized,
+                                        args.clock_timeout, watcher,
+                                        [os.path.dirname(TIMESYNC_MARKER)])
+    finally:
+        watcher.close()
+
+    total = time.monotonic() - start
+    print(f"Ready to launch Greengrass after {total:.1f}s")
+    append_history(args.history, {
+        'time': time.time(),
+        'installWaitSeconds': round(install_wait, 3),
+        'networkWaitSeconds': round(network_wait, 3),
+        'networkReady': network_ok,
+        'clockWaitSeconds': round(clock_wait, 3),
+        'clockSynchronized': clock_ok,
+        'timeToLaunchSeconds': round(total, 3),
+    }, 'launch')
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
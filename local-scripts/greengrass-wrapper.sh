@@ -6,60 +6,75 @@ echo "SNAP_DATA: $SNAP_DATA"
 echo "SNAP_COMMON: $SNAP_COMMON"
 echo "SNAP: $SNAP"
 
-# Wait for system to fully boot
-sleep 30
-
 # Use SNAP_COMMON for Greengrass location
 GREENGRASS_DIR="$SNAP_COMMON/greengrass/v2"
 echo "Looking for Greengrass at: $GREENGRASS_DIR"
 
-if [ ! -d "$GREENGRASS_DIR" ]; then
-    echo "Greengrass not configured yet. Waiting..."
-    while [ ! -d "$GREENGRASS_DIR" ]; do
-        echo "Still waiting for Greengrass configuration at $GREENGRASS_DIR..."
-        sleep 60
-    done
+# Wait for a completed install, network and clock sync instead of fixed sleeps
+if ! "$SNAP/bin/python3" "$SNAP/bin/greengrass-wait-ready.pyc" --greengrass-dir "$GREENGRASS_DIR"; then
+    echo "ERROR: Readiness check failed"
+    exit 1
 fi
 
-echo "Found Greengrass directory, attempting to start..."
-
-# Determine architecture and set JAVA_HOME
-case "$(uname -m)" in
-    x86_64)
-        ARCH="amd64"
-        ;;
-    aarch64)
-        ARCH="arm64"
-        ;;
-    *)
-        echo "ERROR: Unsupported architecture: $(uname -m)"
-        exit 1
-        ;;
-esac
-
-# Try architecture-agnostic symlink first, fall back to architecture-specific path
-if [ -d "$SNAP/usr/lib/jvm/java-11-openjdk" ]; then
-    export JAVA_HOME="$SNAP/usr/lib/jvm/java-11-openjdk"
-elif [ -d "$SNAP/usr/lib/jvm/java-11-openjdk-${ARCH}" ]; then
-    export JAVA_HOME="$SNAP/usr/lib/jvm/java-11-openjdk-${ARCH}"
+echo "Found Greengrass installation, attempting to start..."
+
+# Java discovery is cached per snap revision in a file shared with configure/bootstrap
+RUNTIME_ENV="$SNAP_COMMON/java-runtime.env"
+RUNTIME_REVISION=""
+if [ -f "$RUNTIME_ENV" ]; then
+    . "$RUNTIME_ENV"
+fi
+
+if [ "$RUNTIME_REVISION" = "$SNAP_REVISION" ] && [ -f "$JAVA_BIN" ]; then
+    echo "Using cached Java runtime from $RUNTIME_ENV"
 else
-    echo "ERROR: No Java installation found"
-    find "$SNAP/usr/lib/jvm" -maxdepth 1 -type d 2>/dev/null || echo "No JVM directory found"
-    exit 1
+    # Determine architecture and set JAVA_HOME
+    case "$(uname -m)" in
+        x86_64)
+            ARCH="amd64"
+            ;;
+        aarch64)
+            ARCH="arm64"
+            ;;
+        *)
+            echo "ERROR: Unsupported architecture: $(uname -m)"
+            exit 1
+            ;;
+    esac
+
+    # Try architecture-agnostic symlink first, fall back to architecture-specific path
+    if [ -d "$SNAP/usr/lib/jvm/java-11-openjdk" ]; then
+        JAVA_HOME="$SNAP/usr/lib/jvm/java-11-openjdk"
+    elif [ -d "$SNAP/usr/lib/jvm/java-11-openjdk-${ARCH}" ]; then
+        JAVA_HOME="$SNAP/usr/lib/jvm/java-11-openjdk-${ARCH}"
+    else
+        echo "ERROR: No Java installation found"
+        find "$SNAP/usr/lib/jvm" -maxdepth 1 -type d 2>/dev/null || echo "No JVM directory found"
+        exit 1
+    fi
+
+    JAVA_BIN="$JAVA_HOME/bin/java"
+
+    # Check if Java binary exists
+    if [ ! -f "$JAVA_BIN" ]; then
+        echo "ERROR: Java binary not found at $JAVA_BIN"
+        find "$SNAP" -name "java" -type f 2>/dev/null || echo "No Java binary found in snap"
+        exit 1
+    fi
+
+    # The version is filled in by configure, which already runs java -version
+    {
+        echo "# Java runtime discovery, refreshed when the snap revision changes"
+        printf 'RUNTIME_REVISION=%q\nARCH=%q\nJAVA_HOME=%q\nJAVA_BIN=%q\nJAVA_VERSION=\n' \
+            "$SNAP_REVISION" "$ARCH" "$JAVA_HOME" "$JAVA_BIN"
+    } > "$RUNTIME_ENV.tmp" && mv "$RUNTIME_ENV.tmp" "$RUNTIME_ENV"
 fi
 
-JAVA_BIN="$JAVA_HOME/bin/java"
+export JAVA_HOME
 echo "Detected architecture: $ARCH"
 echo "Using JAVA_HOME: $JAVA_HOME"
 echo "Using Java binary: $JAVA_BIN"
 
-# Check if Java binary exists
-if [ ! -f "$JAVA_BIN" ]; then
-    echo "ERROR: Java binary not found at $JAVA_BIN"
-    find "$SNAP" -name "java" -type f 2>/dev/null || echo "No Java binary found in snap"
-    exit 1
-fi
-
 # Check if Greengrass JAR exists
 JAR_FILE="$GREENGRASS_DIR/lib/Greengrass.jar"
 if [ ! -f "$JAR_FILE" ]; then
@@ -68,19 +83,96 @@ if [ ! -f "$JAR_FILE" ]; then
     exit 1
 fi
 
+# Use an AppCDS archive when enabled (configure/bootstrap --appcds create the cds directory).
+# Archives are keyed like the Python scripts key them: resolved jar path, size and mtime.
+CDS_DIR="$GREENGRASS_DIR/cds"
+CDS_OPTS=()
+if [ -d "$CDS_DIR" ]; then
+    JAR_FILE="$(readlink -f "$JAR_FILE")"
+    CDS_KEY=$(printf '%s|%s' "$JAR_FILE" "$(stat -c '%s|%Y' "$JAR_FILE")" | sha256sum | cut -c1-16)
+    CDS_LIST="$CDS_DIR/$CDS_KEY.classlist"
+    CDS_ARCHIVE="$CDS_DIR/$CDS_KEY.jsa"
+
+    if [ -f "$CDS_DIR/$CDS_KEY.failed" ]; then
+        echo "AppCDS archive generation failed previously, starting without it"
+    elif [ -f "$CDS_ARCHIVE" ]; then
+        echo "Using AppCDS archive: $CDS_ARCHIVE"
+        CDS_OPTS=(-XX:SharedArchiveFile="$CDS_ARCHIVE" -Xshare:auto)
+    elif [ -f "$CDS_LIST" ]; then
+        echo "Generating AppCDS archive: $CDS_ARCHIVE"
+        if "$JAVA_BIN" -Xshare:dump -XX:SharedClassListFile="$CDS_LIST" \
+               -XX:SharedArchiveFile="$CDS_ARCHIVE" -cp "$JAR_FILE"; then
+            CDS_OPTS=(-XX:SharedArchiveFile="$CDS_ARCHIVE" -Xshare:auto)
+        else
+            echo "AppCDS archive generation failed, starting without it"
+            touch "$CDS_DIR/$CDS_KEY.failed"
+        fi
+    else
+        echo "Recording AppCDS class list: $CDS_LIST"
+        CDS_OPTS=(-XX:DumpLoadedClassList="$CDS_LIST")
+    fi
+fi
+
+# JVM sizing chosen by configure/bootstrap for this device's RAM and CPU count
+JVM_OPTS=()
+if [ -f "$SNAP_COMMON/jvm-options.env" ]; then
+    . "$SNAP_COMMON/jvm-options.env"
+    read -r -a JVM_OPTS <<< "$JVM_OPTIONS"
+    echo "Using JVM profile $JVM_PROFILE: $JVM_OPTIONS"
+fi
+
 # Start Greengrass with the snap's Java binary
 cd "$GREENGRASS_DIR"
 echo "Starting Greengrass from directory: $(pwd)"
 
 # Use the configuration file if available
 CONFIG_FILE="$GREENGRASS_DIR/config/effectiveConfig.yaml"
+NUCLEUS_CMD=("$JAVA_BIN" -Droot="$GREENGRASS_DIR" -Dlog.store=FILE "${JVM_OPTS[@]}" "${CDS_OPTS[@]}"
+             -jar "$JAR_FILE")
 if [ -f "$CONFIG_FILE" ]; then
     echo "Using config file: $CONFIG_FILE"
-    exec "$JAVA_BIN" -Droot="$GREENGRASS_DIR" -Dlog.store=FILE \
-         -jar "$JAR_FILE" \
-         --config "$CONFIG_FILE"
+    NUCLEUS_CMD+=(--config "$CONFIG_FILE")
 else
     echo "Config file not found, starting with basic parameters"
-    exec "$JAVA_BIN" -Droot="$GREENGRASS_DIR" -Dlog.store=FILE \
-         -jar "$JAR_FILE"
 fi
+
+# The supervisor restarts crashed JVMs with the command resolved above, backing
+# off on repeated crashes. Settings can be overridden in supervisor.env.
+# With SUPERVISOR=off, snapd restarts the nucleus every time it exits
+# (restart-condition: always), with no backoff or crash-loop limit
+SUPERVISOR=on
+SUPERVISOR_MAX_CRASHES=5
+SUPERVISOR_BACKOFF_CAP=300
+SUPERVISOR_STABLE_SECONDS=600
+if [ -f "$SNAP_COMMON/supervisor.env" ]; then
+    . "$SNAP_COMMON/supervisor.env"
+fi
+
+# With a RAM log directory the supervisor also copies the logs to disk in batches
+LOG_RAM_DIR=""
+if [ -f "$SNAP_COMMON/logging.env" ]; then
+    . "$SNAP_COMMON/logging.env"
+fi
+LOG_OPTS=()
+if [ -n "$LOG_RAM_DIR" ]; then
+    mkdir -p "$LOG_RAM_DIR" "$LOG_DIR"
+    echo "Logging to RAM directory $LOG_RAM_DIR, flushed to $LOG_DIR every ${LOG_FLUSH_INTERVAL}s"
+    LOG_OPTS=(--ram-log-dir "$LOG_RAM_DIR" --log-dir "$LOG_DIR"
+              --flush-interval "$LOG_FLUSH_INTERVAL" --persistent-kb "$LOG_PERSISTENT_KB")
+    if [ "$SUPERVISOR" = "off" ]; then
+        echo "WARNING: SUPERVISOR=off, logs in $LOG_RAM_DIR are not copied to disk"
+    fi
+fi
+
+if [ "$SUPERVISOR" != "off" ]; then
+    exec "$SNAP/bin/python3" "$SNAP/bin/greengrass-supervisor.pyc" \
+         --max-crashes "$SUPERVISOR_MAX_CRASHES" \
+         --backoff-cap "$SUPERVISOR_BACKOFF_CAP" \
+         --stable-seconds "$SUPERVISOR_STABLE_SECONDS" \
+         "${LOG_OPTS[@]}" \
+         -- "${NUCLEUS_CMD[@]}"
+fi
+
+# exec keeps this PID, so the metrics exporter can find the nucleus without scanning /proc
+echo $$ > "$SNAP_COMMON/greengrass-nucleus.pid"
+exec "${NUCLEUS_CMD[@]}"
@@ -0,0 +1,926 @@
+"""Helpers shared by the snap's scripts
+
+The snap ships this module as bytecode next to its Python scripts, which
+import it from their own directory.  It is kept free of third-party
+imports at module level so that no script pays for them before they are
+needed.
+"""
+import os
+import re
+import glob
+import json
+import time
+import base64
+import argparse
+import hashlib
+import shutil
+import tarfile
+import zipfile
+import platform
+import shlex
+import threading
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Status message prefixes: configure prints symbols, bootstrap calls
+# use_tags() to print [OK]-style tags like the rest of its output
+PREFIXES = {'ok': '✓ ', 'warn': '⚠ ', 'info': '', 'error': 'Error: '}
+
+def use_tags():
+    """Print status messages with [OK]/[WARN]/[INFO]/[ERROR] tags"""
+    PREFIXES.update(ok='[OK] ', warn='[WARN] ', info='[INFO] ', error='[ERROR] ')
+
+def status(kind, message):
+    """Print a message with the prefix for its kind (ok, warn, info or error)"""
+    print(f"{PREFIXES[kind]}{message}")
+
+class RunReport:
+    """Monotonic per-phase timings for one run
+
+    Phases are recorded with their duration, outcome and any details such
+    as bytes written or subprocess exit codes.  When events_path is set each
+    phase start and end is also appended to a JSON-lines stream as it
+    happens; write() saves the whole run as a JSON report to report_path.
+    """
+
+    def __init__(self, command, report_path=None, events_path=None):
+        self.command = command
+        self.report_path = report_path
+        self.events_path = events_path
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.phases = []
+        self.outcome = 'failed'
+        self.details = {}
+        self.event('run_start')
+
+    def event(self, event_type, **fields):
+        """Append one event to the JSON-lines stream"""
+        if not self.events_path:
+            return
+        record = {'time': time.time(), 'command': self.command, 'event': event_type, **fields}
+        with self.lock:
+            with open(self.events_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+
+    def begin(self, name, **details):
+        """Start timing a phase and return its record"""
+        phase = {'name': name, 'start': time.monotonic(), **details}
+        with self.lock:
+            self.phases.append(phase)
+        self.event('phase_start', phase=name)
+        return phase
+
+    def end(self, phase, outcome='ok', **details):
+        """Finish a phase with an outcome and optional details"""
+        phase['durationSeconds'] = round(time.monotonic() - phase['start'], 4)
+        phase['outcome'] = outcome
+        phase.update(details)
+        self.event('phase_end', phase=phase['name'], outcome=outcome,
+                   durationSeconds=phase['durationSeconds'], **details)
+
+    @contextmanager
+    def phase(self, name, **details):
+        """Time a block as a phase; exceptions mark it as an error
+
+        The block may call end() itself to record a different outcome.
+        """
+        phase = self.begin(name, **details)
+        try:
+            yield phase
+        except BaseException as e:
+            if 'durationSeconds' not in phase:
+                self.end(phase, 'error', error=str(e))
+            raise
+        if 'durationSeconds' not in phase:
+            self.end(phase)
+
+    def write(self):
+        """Close any unfinished phases and write the JSON report"""
+        for phase in self.phases:
+            if 'durationSeconds' not in phase:
+                self.end(phase, 'incomplete')
+
+        duration = round(time.monotonic() - self.started, 4)
+        self.event('run_end', outcome=self.outcome, durationSeconds=duration)
+        if not self.report_path:
+            return
+
+        report = {
+            'command': self.command,
+            'startedAt': self.started_at,
+            'durationSeconds': duration,
+            'outcome': self.outcome,
+            'machine': platform.machine(),
+            **self.details,
+            'phases': [
+                {'startOffsetSeconds': round(p['start'] - self.started, 4),
+                 **{k: v for k, v in p.items() if k != 'start'}}
+                for p in self.phases
+            ],
+        }
+        with open(self.report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+COMPONENT_CACHE_DIR = 'component-cache'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def get_component_cache(path=None):
+    """Return the component cache to seed from: path, or $SNAP_COMMON/component-cache if present"""
+    if path:
+        return path
+    default = f"{os.environ.get('SNAP_COMMON', '/tmp')}/{COMPONENT_CACHE_DIR}"
+    return default if os.path.isdir(default) else None
+
+def recipe_field(mapping, key):
+    """Return a recipe value; the nucleus reads recipe keys case-insensitively"""
+    if not isinstance(mapping, dict):
+        return None
+    for name, value in mapping.items():
+        if str(name).lower() == key.lower():
+            return value
+    return None
+
+def recipe_artifacts(recipe):
+    """Return {file name: (digest, algorithm)} for the downloadable artifacts of a recipe"""
+    artifacts = {}
+    for manifest in recipe_field(recipe, 'Manifests') or []:
+        for artifact in recipe_field(manifest, 'Artifacts') or []:
+            uri = str(recipe_field(artifact, 'Uri') or '')
+            # Docker images are pulled by the docker component, not the nucleus
+            if not uri or uri.startswith('docker:'):
+                continue
+            name = uri.rstrip('/').rsplit('/', 1)[-1]
+            artifacts[name] = (recipe_field(artifact, 'Digest'),
+                               str(recipe_field(artifact, 'Algorithm') or 'SHA-256'))
+    return artifacts
+
+def recipe_store_name(component_name, version):
+    """File name of a recipe in packages/recipes, as the nucleus component store names it"""
+    name_hash = base64.urlsafe_b64encode(hashlib.sha256(component_name.encode()).digest())
+    return f"{name_hash.decode().rstrip('=')}@{version}.recipe.yaml"
+
+def new_hash(algorithm):
+    """hashlib object for a recipe Algorithm such as SHA-256"""
+    return hashlib.new(algorithm.replace('-', '').lower())
+
+def file_digest(path, algorithm='SHA-256'):
+    """Return the base64 digest of a file, read in fixed-size blocks"""
+    digest = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode()
+
+def stream_to_file(source, path, algorithm='SHA-256'):
+    """Copy a file object to path, hashing as it goes; returns the base64 digest"""
+    digest = new_hash(algorithm)
+    with open(path, 'wb') as target:
+        for block in iter(lambda: source.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+            target.write(block)
+    return base64.b64encode(digest.digest()).decode()
+
+def archive_key(name):
+    """Path of an archive member relative to the cache root"""
+    return name[2:] if name.startswith('./') else name
+
+def safe_path_part(value):
+    """True if value can be used as one path component under packages/"""
+    return value not in ('', '.', '..') and '/' not in value and '\0' not in value
+
+def read_cached_recipes(cache_path, archive):
+    """Return [(component name, version, recipe bytes, parsed recipe)] from the cache"""
+    sources = []
+    if archive:
+        for member in archive:
+            parts = archive_key(member.name).split('/')
+            if member.isfile() and len(parts) == 2 and parts[0] == 'recipes':
+                sources.append((member.name, archive.extractfile(member).read()))
+    else:
+        for path in sorted(glob.glob(f"{cache_path}/recipes/*")):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    sources.append((path, f.read()))
+
+    import yaml
+
+    recipes = []
+    for source, data in sources:
+        if not source.endswith(('.yaml', '.yml', '.json')):
+            continue
+        try:
+            recipe = yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            status('warn', f"Skipping unreadable recipe {source}: {e}")
+            continue
+        name = recipe_field(recipe, 'ComponentName')
+        version = recipe_field(recipe, 'ComponentVersion')
+        if not name or not version or not safe_path_part(str(name)) or \
+                not safe_path_part(str(version)):
+            status('warn', "Skipping recipe without a usable ComponentName/ComponentVersion: "
+                           f"{source}")
+            continue
+        recipes.append((str(name), str(version), data, recipe))
+    return recipes
+
+def seed_components(cache_path, greengrass_root, report=None):
+    """Copy recipes and artifacts from a local component cache into the nucleus store
+
+    The cache is a directory, or a .tar/.tar.gz archive of one, holding
+    recipes/<any name>.yaml|.json and artifacts/<component>/<version>/<file>,
+    like the recipe and artifact directories of a greengrass-cli local
+    deployment.  Artifacts are hardlinked from a directory cache when
+    possible and copied otherwise.
+    Every artifact with a Digest in its recipe is checked while it is
+    streamed, and one already in packages/ with the right digest is left
+    alone, so seeding again is cheap.  When the first deployment lists a
+    seeded artifact, the nucleus finds it with a matching digest and does
+    not download it.
+    """
+    report = report or RunReport('seed')
+    if not os.path.exists(cache_path):
+        status('warn', f"Component cache not found: {cache_path}")
+        return None
+
+    recipes_dir = f"{greengrass_root}/packages/recipes"
+    artifacts_dir = f"{greengrass_root}/packages/artifacts"
+    counts = {'recipes': 0, 'recipesCurrent': 0, 'artifacts': 0, 'artifactsCurrent': 0,
+              'artifactsMissing': 0, 'artifactsRejected': 0, 'bytesWritten': 0}
+
+    archive = tarfile.open(cache_path, 'r:*') if os.path.isfile(cache_path) else None
+    try:
+        with report.phase('component_seed') as phase:
+            os.makedirs(recipes_dir, exist_ok=True)
+            wanted = {}
+            for name, version, data, recipe in read_cached_recipes(cache_path, archive):
+                recipe_path = f"{recipes_dir}/{recipe_store_name(name, version)}"
+                if os.path.isfile(recipe_path) and \
+                        file_digest(recipe_path) == base64.b64encode(hashlib.sha256(data).digest()).decode():
+                    counts['recipesCurrent'] += 1
+                else:
+                    with open(f"{recipe_path}.tmp", 'wb') as f:
+                        f.write(data)
+                    os.replace(f"{recipe_path}.tmp", recipe_path)
+                    counts['recipes'] += 1
+                for file_name, (digest, algorithm) in recipe_artifacts(recipe).items():
+                    if not safe_path_part(file_name):
+                        continue
+                    wanted[f"artifacts/{name}/{version}/{file_name}"] = (
+                        f"{artifacts_dir}/{name}/{version}/{file_name}", digest, algorithm)
+
+            def seed_artifact(key, cached_path=None, member=None):
+                target, digest, algorithm = wanted.pop(key)
+                if digest and os.path.isfile(target) and file_digest(target, algorithm) == digest:
+                    counts['artifactsCurrent'] += 1
+                    return
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp_path = f"{target}.seed"
+                if cached_path:
+                    actual = file_digest(cached_path, algorithm)
+                else:
+                    actual = stream_to_file(archive.extractfile(member), tmp_path, algorithm)
+
+                current = not digest and os.path.isfile(target) and \
+                    file_digest(target, algorithm) == actual
+                if (digest and actual != digest) or current:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    if current:
+                        counts['artifactsCurrent'] += 1
+                    else:
+                        counts['artifactsRejected'] += 1
+                        status('warn', f"{key} does not match the digest in its recipe; "
+                                       "not seeded")
+                    return
+
+                if cached_path:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    try:
+                        os.link(cached_path, tmp_path)
+                    except OSError:
+                        # Different filesystem, or links not permitted
+                        with open(cached_path, 'rb') as source:
+                            stream_to_file(source, tmp_path, algorithm)
+                        counts['bytesWritten'] += os.path.getsize(tmp_path)
+                else:
+                    counts['bytesWritten'] += os.path.getsize(tmp_path)
+                os.replace(tmp_path, target)
+                counts['artifacts'] += 1
+
+            if archive:
+                for member in archive:
+                    key = archive_key(member.name)
+                    if member.isfile() and key in wanted:
+                        seed_artifact(key, member=member)
+            else:
+                for key in list(wanted):
+                    if os.path.isfile(f"{cache_path}/{key}"):
+                        seed_artifact(key, cached_path=f"{cache_path}/{key}")
+            counts['artifactsMissing'] = len(wanted)
+            phase.update(counts)
+    except (OSError, tarfile.TarError) as e:
+        status('warn', f"Component seeding stopped: {e}")
+        return None
+    finally:
+        if archive:
+            archive.close()
+
+    status('ok', f"Seeded {counts['recipes']} recipes and {counts['artifacts']} artifacts "
+                 f"({counts['bytesWritten'] / 1024 / 1024:.1f} MB written) from {cache_path}")
+    if counts['recipesCurrent'] or counts['artifactsCurrent']:
+        status('info', f"Already present and verified: {counts['recipesCurrent']} recipes, "
+                       f"{counts['artifactsCurrent']} artifacts")
+    if counts['artifactsMissing']:
+        status('info', f"{counts['artifactsMissing']} artifacts are not in the cache; "
+                       "the first deployment downloads them")
+    return counts
+
+def extract_nucleus_zip(zip_path, dest_dir):
+    """Extract the nucleus zip, skipping members already in place
+
+    A manifest of member names, CRCs and sizes is stored next to the
+    extracted tree.  Members whose manifest entry matches and whose file is
+    still present with the right size are left untouched, so re-runs do not
+    rewrite the whole tree on flash storage.  Members are streamed to disk
+    in chunks rather than read into memory.  Returns a dict with the number
+    of members extracted and skipped and the bytes written.
+    """
+    manifest_path = os.path.join(dest_dir, ".nucleus-manifest.json")
+    dest_root = os.path.realpath(dest_dir)
+
+    previous = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as f:
+                previous = json.load(f).get('members', {})
+        except (OSError, ValueError):
+            previous = {}
+
+    stats = {'extracted': 0, 'skipped': 0, 'bytesWritten': 0}
+    members = {}
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            target = os.path.realpath(os.path.join(dest_root, info.filename))
+            if target != dest_root and not target.startswith(dest_root + os.sep):
+                raise ValueError(f"Refusing to extract {info.filename} outside {dest_dir}")
+
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+
+            entry = [info.CRC, info.file_size]
+            members[info.filename] = entry
+
+            if (previous.get(info.filename) == entry and os.path.isfile(target)
+                    and os.path.getsize(target) == info.file_size):
+                stats['skipped'] += 1
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp_target = f"{target}.partial"
+            with zip_ref.open(info) as src, open(tmp_target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(tmp_target, target)
+
+            stats['extracted'] += 1
+            stats['bytesWritten'] += info.file_size
+
+    # Only rewrite the manifest when something changed
+    if stats['extracted'] or set(previous) != set(members):
+        tmp_manifest = f"{manifest_path}.tmp"
+        with open(tmp_manifest, 'w') as f:
+            json.dump({'source': zip_path, 'members': members}, f)
+        os.replace(tmp_manifest, manifest_path)
+
+    return stats
+
+RUNTIME_KEYS = ['RUNTIME_REVISION', 'ARCH', 'JAVA_HOME', 'JAVA_BIN', 'JAVA_VERSION']
+
+def get_runtime_cache_path():
+    """Location of the Java runtime cache, shared with greengrass-wrapper.sh"""
+    return f"{os.environ.get('SNAP_COMMON', '/tmp')}/java-runtime.env"
+
+def read_env_file(path):
+    """Return the KEY='value' settings of a shell-sourceable file, or {} if unusable"""
+    settings = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                key, sep, value = line.strip().partition('=')
+                if sep and not key.startswith('#'):
+                    settings[key] = (shlex.split(value) or [''])[0]
+    except (OSError, ValueError):
+        return {}
+    return settings
+
+def read_runtime_cache(path):
+    """Read the runtime cache written by write_runtime_cache, or {} if unusable"""
+    settings = read_env_file(path)
+    return {key: settings[key] for key in RUNTIME_KEYS if key in settings}
+
+def write_runtime_cache(path, runtime):
+    """Atomically write the runtime cache so the wrapper can source it"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write("# Java runtime discovery, refreshed when the snap revision changes\n")
+        for key in RUNTIME_KEYS:
+            f.write(f"{key}={shlex.quote(runtime.get(key, ''))}\n")
+    os.replace(tmp_path, path)
+
+def get_architecture():
+    """Detect system architecture and return appropriate Java directory suffix"""
+    machine = platform.machine()
+    arch_map = {
+        'x86_64': 'amd64',
+        'aarch64': 'arm64',
+        'armv7l': 'armhf'
+    }
+    return arch_map.get(machine, machine)
+
+def find_java_binary(snap_dir):
+    """Find Java binary, trying architecture-agnostic symlink first, then arch-specific paths"""
+    arch = get_architecture()
+
+    # Ordered list of paths to try
+    java_paths = [
+        # Architecture-agnostic symlink (created in snapcraft.yaml)
+        f"{snap_dir}/usr/lib/jvm/java-11-openjdk/bin/java",
+        # Architecture-specific paths
+        f"{snap_dir}/usr/lib/jvm/java-11-openjdk-{arch}/bin/java",
+        # Glob pattern as fallback
+        f"{snap_dir}/usr/lib/jvm/java-11-openjdk-*/bin/java",
+        # System paths
+        f"{snap_dir}/usr/bin/java",
+        "/usr/bin/java",
+    ]
+
+    for path in java_paths:
+        if '*' in path:
+            matches = glob.glob(path)
+            if matches:
+                status('ok', f"Found Java via glob: {matches[0]}")
+                return matches[0]
+        elif os.path.exists(path):
+            status('ok', f"Found Java: {path}")
+            return path
+
+    # Last resort: java from PATH
+    status('warn', "No Java found in the snap or /usr/bin, falling back to java from PATH")
+    return "java"
+
+def get_java_runtime(snap_dir, probe_version=True):
+    """Return (runtime, cached) for the snap's Java
+
+    Path discovery and the `java -version` probe (a whole JVM start) run only
+    when the cache is missing or was written by another snap revision.
+    """
+    cache_path = get_runtime_cache_path()
+    revision = os.environ.get('SNAP_REVISION', '')
+    runtime = read_runtime_cache(cache_path)
+    if (runtime.get('RUNTIME_REVISION') == revision
+            and os.path.isfile(runtime.get('JAVA_BIN', ''))
+            and (runtime.get('JAVA_VERSION') or not probe_version)):
+        return runtime, True
+
+    java_path = find_java_binary(snap_dir)
+    runtime = {
+        'RUNTIME_REVISION': revision,
+        'ARCH': get_architecture(),
+        'JAVA_HOME': os.path.dirname(os.path.dirname(java_path)),
+        'JAVA_BIN': java_path,
+        'JAVA_VERSION': '',
+    }
+    usable = os.path.isabs(java_path)
+    if probe_version:
+        env = os.environ.copy()
+        env['JAVA_HOME'] = runtime['JAVA_HOME']
+        java_test = subprocess.run([java_path, "-version"],
+                                   capture_output=True, text=True, timeout=10, env=env)
+        runtime['JAVA_VERSION'] = java_test.stderr.split('\n')[0] if java_test.stderr else "Unknown"
+        usable = usable and java_test.returncode == 0
+
+    if usable:
+        try:
+            write_runtime_cache(cache_path, runtime)
+        except OSError as e:
+            status('warn', f"Could not write Java runtime cache: {e}")
+    return runtime, False
+
+
+# Nucleus JVM sizing by total RAM; heap is a share of RAM capped per profile
+JVM_PROFILES = {
+    # Pi Zero 2W class boards: keep the nucleus small enough to stay out of swap
+    'small': {'maxRamMb': 1024, 'heapFraction': 0.25, 'maxHeapMb': 128, 'gc': 'SerialGC',
+              'threadStackSize': '256k', 'maxMetaspace': '64m',
+              'extra': ['-XX:TieredStopAtLevel=1', '-XX:ReservedCodeCacheSize=32m']},
+    'medium': {'maxRamMb': 4096, 'heapFraction': 0.25, 'maxHeapMb': 512, 'gc': 'SerialGC',
+               'threadStackSize': '512k', 'maxMetaspace': '128m', 'extra': []},
+    'large': {'maxRamMb': None, 'heapFraction': 0.25, 'maxHeapMb': 1024, 'gc': 'G1GC',
+              'threadStackSize': '1m', 'maxMetaspace': '256m', 'extra': []},
+}
+
+def read_system_resources():
+    """Return (total RAM in MB or None, usable CPU count) from /proc"""
+    total_mb = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    total_mb = int(line.split()[1]) // 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    return total_mb, cpus
+
+def select_jvm_profile(total_mb, cpus, overrides=None):
+    """Return (profile name, JVM options) for this device
+
+    overrides is the optional `jvm` section of bootstrap-config.yaml: profile
+    (auto, small, medium, large or none), maxHeap, gc, threadStackSize,
+    maxMetaspace and extraOptions.
+    """
+    overrides = overrides or {}
+    name = str(overrides.get('profile') or 'auto')
+    extra_options = overrides.get('extraOptions') or []
+    if isinstance(extra_options, str):
+        extra_options = extra_options.split()
+
+    if name == 'none':
+        return name, list(extra_options)
+    if name not in JVM_PROFILES:
+        if name != 'auto':
+            status('warn', f"Unknown JVM profile '{name}', choosing automatically")
+        name = 'medium'
+        if total_mb is not None:
+            name = next(profile for profile, settings in JVM_PROFILES.items()
+                        if settings['maxRamMb'] is None or total_mb <= settings['maxRamMb'])
+
+    profile = JVM_PROFILES[name]
+    heap_mb = profile['maxHeapMb']
+    if total_mb is not None:
+        heap_mb = max(64, min(heap_mb, int(total_mb * profile['heapFraction'])))
+    # Concurrent collectors only pay off with more than one CPU
+    gc = profile['gc'] if cpus > 1 else 'SerialGC'
+
+    options = [
+        f"-Xmx{overrides.get('maxHeap') or f'{heap_mb}m'}",
+        f"-XX:+Use{overrides.get('gc') or gc}",
+        f"-Xss{overrides.get('threadStackSize') or profile['threadStackSize']}",
+        f"-XX:MaxMetaspaceSize={overrides.get('maxMetaspace') or profile['maxMetaspace']}",
+        *profile['extra'],
+        *extra_options,
+    ]
+    return name, options
+
+def write_jvm_options_file(path, name, options):
+    """Save the JVM options in a shell-sourceable file for greengrass-wrapper.sh"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write("# Nucleus JVM options chosen by configure/bootstrap\n")
+        f.write(f"JVM_PROFILE={shlex.quote(name)}\n")
+        f.write(f"JVM_OPTIONS={shlex.quote(' '.join(options))}\n")
+    os.replace(tmp_path, path)
+
+ROOT_CA_URL = "https://www.amazontrust.com/repository/AmazonRootCA1.pem"
+# SHA-256 of the DER encoding of Amazon Root CA 1
+ROOT_CA_SHA256 = "8ecde6884f3d87b1125ba31ac3fcb13d7016de7f57cc904fe1cb97c6ae98196e"
+
+def root_ca_fingerprint(pem_text):
+    """Return the SHA-256 fingerprint of a single PEM certificate, or None"""
+    import ssl
+
+    try:
+        return hashlib.sha256(ssl.PEM_cert_to_DER_cert(pem_text.strip())).hexdigest()
+    except (ValueError, UnicodeError):
+        return None
+
+def root_ca_candidates(snap_dir):
+    """Local copies of Amazon Root CA 1, most preferred first"""
+    return [
+        # Embedded at build time (snapcraft.yaml)
+        f"{snap_dir}/opt/greengrass/AmazonRootCA1.pem",
+        # The snap's ca-certificates trust store
+        f"{snap_dir}/usr/share/ca-certificates/mozilla/Amazon_Root_CA_1.crt",
+        f"{snap_dir}/etc/ssl/certs/Amazon_Root_CA_1.pem",
+        # Host trust store
+        "/etc/ssl/certs/Amazon_Root_CA_1.pem",
+        "/usr/share/ca-certificates/mozilla/Amazon_Root_CA_1.crt",
+    ]
+
+def download_root_ca():
+    """Install Amazon Root CA 1 in $SNAP_COMMON/certs
+
+    The certificate is taken from the copy embedded in the snap or a local
+    trust store and only downloaded when none is available, so air-gapped
+    stations work.  Every source is checked against the pinned fingerprint
+    before it is written.
+    """
+    certs_dir = f"{os.environ.get('SNAP_COMMON', '/tmp')}/certs"
+    os.makedirs(certs_dir, exist_ok=True)
+    root_ca_path = f"{certs_dir}/AmazonRootCA1.pem"
+
+    if os.path.exists(root_ca_path):
+        status('ok', f"Root CA already exists: {root_ca_path}")
+        return root_ca_path
+
+    pem_text, source = None, None
+    for candidate in root_ca_candidates(os.environ.get('SNAP', '/tmp')):
+        try:
+            with open(candidate, 'r') as f:
+                text = f.read()
+        except OSError:
+            continue
+        if root_ca_fingerprint(text) == ROOT_CA_SHA256:
+            pem_text, source = text, candidate
+            break
+        status('warn', f"Ignoring {candidate}: fingerprint does not match Amazon Root CA 1")
+
+    if pem_text is None:
+        try:
+            import urllib.request
+            status('info', f"Downloading Root CA from {ROOT_CA_URL}...")
+            with urllib.request.urlopen(ROOT_CA_URL, timeout=30) as response:
+                pem_text = response.read().decode('ascii')
+            source = ROOT_CA_URL
+        except Exception as e:
+            status('error', f"Could not download Root CA: {e}")
+            return None
+        if root_ca_fingerprint(pem_text) != ROOT_CA_SHA256:
+            status('error', f"Root CA from {ROOT_CA_URL} does not match the pinned fingerprint")
+            return None
+
+    tmp_path = f"{root_ca_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(pem_text.strip() + "\n")
+    os.replace(tmp_path, root_ca_path)
+
+    status('ok', f"Installed Root CA from {source} to: {root_ca_path}")
+    return root_ca_path
+
+LOG_LEVELS = ['TRACE', 'DEBUG', 'INFO', 'WARN', 'ERROR']
+LOG_FORMATS = ['TEXT', 'JSON']
+
+# Each log rotates at 1 MB and keeps at most 5 MB of rotated files, half
+# the nucleus default, to bound the space logs take on small SD cards
+LOGGING_DEFAULTS = {
+    'level': 'INFO',
+    'format': 'TEXT',
+    'fileSizeKB': 1024,
+    'totalLogsSizeKB': 5120,
+    'ramDirectory': False,
+    'flushIntervalSeconds': 300,
+    'persistentLogsSizeKB': 51200,
+}
+
+def select_logging(overrides=None):
+    """Return logging settings: the defaults updated from the logging section
+
+    Invalid values are reported and replaced by the default.
+    """
+    settings = dict(LOGGING_DEFAULTS)
+    for key, value in (overrides or {}).items():
+        if value is None:
+            continue
+        if key not in settings:
+            status('warn', f"Unknown logging setting '{key}' ignored")
+            continue
+        if key == 'level' and str(value).upper() in LOG_LEVELS:
+            settings[key] = str(value).upper()
+        elif key == 'format' and str(value).upper() in LOG_FORMATS:
+            settings[key] = str(value).upper()
+        elif key == 'ramDirectory' and isinstance(value, bool):
+            settings[key] = value
+        elif key not in ('level', 'format', 'ramDirectory') and str(value).isdigit() and int(value) > 0:
+            settings[key] = int(value)
+        else:
+            status('warn', f"Invalid logging {key} '{value}', using {settings[key]}")
+    return settings
+
+def get_ram_log_dir():
+    """tmpfs directory the nucleus logs to when ramDirectory is enabled"""
+    return f"/dev/shm/snap.{os.environ.get('SNAP_INSTANCE_NAME') or 'aws-iot-greengrass'}.logs"
+
+def build_logging_config(settings):
+    """Return the nucleus `logging` configuration for the settings"""
+    logging_config = {
+        'level': settings['level'],
+        'format': settings['format'],
+        'outputType': 'FILE',
+        'fileSizeKB': settings['fileSizeKB'],
+        'totalLogsSizeKB': settings['totalLogsSizeKB'],
+    }
+    if settings['ramDirectory']:
+        logging_config['outputDirectory'] = get_ram_log_dir()
+    return logging_config
+
+def logging_env_text(settings, greengrass_root):
+    """Return the logging.env contents read by greengrass-wrapper.sh"""
+    ram_dir = get_ram_log_dir() if settings['ramDirectory'] else ''
+    return ("# Nucleus log locations chosen by configure/bootstrap\n"
+            f"LOG_DIR={shlex.quote(f'{greengrass_root}/logs')}\n"
+            f"LOG_RAM_DIR={shlex.quote(ram_dir)}\n"
+            f"LOG_FLUSH_INTERVAL={settings['flushIntervalSeconds']}\n"
+            f"LOG_PERSISTENT_KB={settings['persistentLogsSizeKB']}\n")
+
+def write_logging_file(path, settings, greengrass_root):
+    """Save the log locations in a shell-sourceable file for greengrass-wrapper.sh"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(logging_env_text(settings, greengrass_root))
+    os.replace(tmp_path, path)
+
+def read_ram_logs_dir(env_path):
+    """Return LOG_RAM_DIR from logging.env, or None when logs are not kept in RAM"""
+    return read_env_file(env_path).get('LOG_RAM_DIR') or None
+
+def get_appcds_options(java_path, jar_path, cds_dir, env=None):
+    """Return (jar_path, jvm_options, mode) for launching jar_path with AppCDS
+
+    AppCDS is enabled by the presence of cds_dir.  Archives are keyed by the
+    jar's resolved path, size and mtime, so a new alts/current gets its own
+    archive.  The first launch records the loaded classes, the next one
+    dumps the shared archive from that list, and later launches map it.
+    The resolved jar path is returned because the class path must match
+    the one the archive was dumped with.
+    """
+    if not cds_dir or not os.path.isdir(cds_dir) or not os.path.exists(jar_path):
+        return jar_path, [], 'off'
+
+    real_jar = os.path.realpath(jar_path)
+    stat = os.stat(real_jar)
+    key = hashlib.sha256(f"{real_jar}|{stat.st_size}|{int(stat.st_mtime)}".encode()).hexdigest()[:16]
+    class_list = f"{cds_dir}/{key}.classlist"
+    archive = f"{cds_dir}/{key}.jsa"
+
+    if os.path.exists(f"{cds_dir}/{key}.failed"):
+        return real_jar, [], 'off'
+
+    if not os.path.exists(archive) and os.path.exists(class_list):
+        dump_cmd = [
+            java_path,
+            "-Xshare:dump",
+            f"-XX:SharedClassListFile={class_list}",
+            f"-XX:SharedArchiveFile={archive}",
+            "-cp", real_jar
+        ]
+        try:
+            result = subprocess.run(dump_cmd, capture_output=True, text=True, timeout=300, env=env)
+            dumped = result.returncode == 0 and os.path.exists(archive)
+        except (OSError, subprocess.TimeoutExpired):
+            dumped = False
+        if not dumped:
+            # Don't retry the dump on every launch
+            open(f"{cds_dir}/{key}.failed", 'w').close()
+            return real_jar, [], 'off'
+
+    if os.path.exists(archive):
+        return real_jar, [f"-XX:SharedArchiveFile={archive}", "-Xshare:auto"], 'archive'
+
+    return real_jar, [f"-XX:DumpLoadedClassList={class_list}"], 'training'
+
+def record_appcds_timing(cds_dir, label, mode, seconds):
+    """Append a JVM startup timing to the AppCDS timing history"""
+    if not cds_dir or not os.path.isdir(cds_dir):
+        return
+    timings_path = f"{cds_dir}/timings.json"
+    try:
+        with open(timings_path, 'r') as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        timings = []
+    timings.append({'label': label, 'mode': mode, 'seconds': round(seconds, 3), 'time': time.time()})
+    with open(timings_path, 'w') as f:
+        json.dump(timings[-100:], f, indent=2)
+
+def appcds_timing_report(cds_dir):
+    """Summarise startup timings without and with the AppCDS archive"""
+    try:
+        with open(f"{cds_dir}/timings.json", 'r') as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        return []
+
+    lines = []
+    for label in sorted({t['label'] for t in timings}):
+        without = [t['seconds'] for t in timings if t['label'] == label and t['mode'] != 'archive']
+        with_cds = [t['seconds'] for t in timings if t['label'] == label and t['mode'] == 'archive']
+        before = f"{sum(without) / len(without):.2f}s" if without else "n/a"
+        after = f"{sum(with_cds) / len(with_cds):.2f}s" if with_cds else "n/a"
+        lines.append(f"{label}: without AppCDS {before}, with AppCDS {after}")
+    return lines
+
+def boot_time():
+    """Seconds since the epoch at which the kernel booted"""
+    with open('/proc/stat', 'r') as f:
+        for line in f:
+            if line.startswith('btime '):
+                return int(line.split()[1])
+    return 0
+
+def read_pid_file(pid_path):
+    """Return the PID written by greengrass-wrapper.sh, or None"""
+    try:
+        with open(pid_path, 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def is_nucleus(pid, greengrass_dir):
+    """Return True if pid is a Greengrass nucleus JVM for greengrass_dir"""
+    try:
+        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+            cmdline = f.read().split(b'\0')
+    except OSError:
+        return False
+    return f"-Droot={greengrass_dir}".encode() in cmdline and \
+        any(arg.endswith(b'Greengrass.jar') for arg in cmdline)
+
+def find_nucleus(pid_path, greengrass_dir):
+    """Return the nucleus PID, scanning /proc only if the PID file is stale"""
+    pid = read_pid_file(pid_path)
+    if pid and is_nucleus(pid, greengrass_dir):
+        return pid
+    for entry in os.listdir('/proc'):
+        if entry.isdigit() and is_nucleus(int(entry), greengrass_dir):
+            return int(entry)
+    return None
+
+def process_stats(pid, btime=0):
+    """Return CPU, memory, thread and FD figures for a process, or None if it exited
+
+    startTime is in seconds since the epoch when btime is boot_time(), and
+    since boot otherwise.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            # The command name may contain spaces, so split after its ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/statm", 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        open_fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (OSError, IndexError, ValueError):
+        return None
+
+    # fields[0] is the state, field 3 of /proc/pid/stat
+    return {
+        'cpuSeconds': (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        'threads': int(fields[17]),
+        'startTime': btime + int(fields[19]) / CLOCK_TICKS,
+        'residentBytes': resident_pages * PAGE_SIZE,
+        'openFds': open_fds,
+    }
+
+HISTORY_MAX_BYTES = 64 * 1024
+
+def append_history(history_path, entry, counter):
+    """Append a JSON record to a history file, keeping the file bounded
+
+    Each record carries a sequence number under counter that survives
+    trimming, so the metrics exporter can report it as a counter.
+    """
+    try:
+        lines = []
+        if os.path.exists(history_path):
+            with open(history_path, 'r') as f:
+                lines = f.readlines()
+        try:
+            previous = json.loads(lines[-1]) if lines else {}
+        except ValueError:
+            previous = {}
+        entry[counter] = previous.get(counter, len(lines)) + 1
+
+        if os.path.exists(history_path) and os.path.getsize(history_path) > HISTORY_MAX_BYTES:
+            with open(history_path, 'w') as f:
+                f.writelines(lines[len(lines) // 2:])
+        with open(history_path, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        print(f"Could not record {counter}: {e}")
+
+def parse_time_arg(value):
+    """Parse --since/--until: an ISO timestamp or a relative age like 30s, 10m, 2h, 1d"""
+    match = re.fullmatch(r"(\d+)([smhd])", value)
+    if match:
+        unit = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}[match.group(2)]
+        return datetime.now(timezone.utc) - timedelta(**{unit: int(match.group(1))})
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {value}")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
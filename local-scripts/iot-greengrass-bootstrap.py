@@ -1,24 +1,36 @@
 #!/usr/bin/env python3
 import os
+import re
 import sys
+import csv
 import json
+import atexit
+import calendar
+import io
+import fcntl
+import tarfile
+import argparse
+import tempfile
 import yaml
 import zipfile
 import subprocess
 import time
-import glob
 import platform
+import shlex
+import shutil
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def get_architecture():
-    """Detect system architecture and return appropriate Java directory suffix"""
-    machine = platform.machine()
-    arch_map = {
-        'x86_64': 'amd64',
-        'aarch64': 'arm64',
-        'armv7l': 'armhf'
-    }
-    return arch_map.get(machine, machine)
+import greengrass_common
+from greengrass_common import (
+    RunReport, appcds_timing_report, build_logging_config, download_root_ca,
+    extract_nucleus_zip, get_appcds_options, get_architecture, get_component_cache,
+    get_java_runtime, get_ram_log_dir, logging_env_text, read_system_resources,
+    record_appcds_timing, seed_components, select_jvm_profile, select_logging,
+    write_jvm_options_file, write_logging_file,
+)
+
+greengrass_common.use_tags()
 
 def load_bootstrap_config():
     """Load bootstrap configuration from pre-loaded config file"""
@@ -53,54 +65,286 @@ def get_device_name(config):
     print(f"[OK] Device name: {device_name}")
     return device_name
 
-def validate_claim_certificates(config):
-    """Validate that claim certificates exist and are readable"""
+# Top-level keys of bootstrap-config.yaml: (accepted types, required)
+BOOTSTRAP_CONFIG_SCHEMA = {
+    'awsRegion': ((str,), True),
+    'deviceName': ((str, int), False),
+    'serialNumber': ((str, int), False),
+    'provisioningTemplate': ((str,), True),
+    'iotDataEndpoint': ((str,), True),
+    'iotCredEndpoint': ((str,), True),
+    'iotRoleAlias': ((str,), False),
+    'nucleusVersion': ((str,), False),
+    'claimCertificatePath': ((str,), True),
+    'claimPrivateKeyPath': ((str,), True),
+    'templateParameters': ((dict,), False),
+    'componentCache': ((str,), False),
+    'jvm': ((dict,), False),
+    'logging': ((dict,), False),
+}
+
+AWS_REGION = re.compile(r"^[a-z]{2}(-gov|-iso[a-z]*)?-[a-z]+-\d+$")
+NUCLEUS_VERSION = re.compile(r"^\d+\.\d+\.\d+$")
+DOMAIN_SUFFIX = r"\.amazonaws\.com(\.cn)?$"
+
+# Interfaces connect.sh connects, plus the auto-connected network ones
+REQUIRED_INTERFACES = ['network', 'network-bind', 'home', 'hardware-observe', 'system-observe',
+                       'mount-observe', 'process-control', 'snapd-control']
+
+# Claim certificates that expire sooner than this are reported
+CERT_EXPIRY_WARNING_DAYS = 30
+# Room for logs and the first deployment on top of the installed tree
+DISK_HEADROOM_MB = 64
+
+class Preflight:
+    """Collects every problem found before anything is installed"""
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def error(self, check, message):
+        self.errors.append((check, message))
+
+    def warn(self, check, message):
+        self.warnings.append((check, message))
+
+def check_config_schema(config, preflight):
+    """Check key presence and types, and values still set to the template placeholders"""
+    for key, (types, required) in BOOTSTRAP_CONFIG_SCHEMA.items():
+        value = config.get(key)
+        if value is None or value == '':
+            if required:
+                preflight.error('config', f"{key} is required")
+            continue
+        if not isinstance(value, types) or isinstance(value, bool):
+            expected = ' or '.join('mapping' if t is dict else 'string' if t is str else 'number'
+                                   for t in types)
+            preflight.error('config', f"{key} must be a {expected}, not {value!r}")
+            continue
+        if isinstance(value, str) and value.startswith('your-'):
+            preflight.error('config', f"{key} is still the template placeholder '{value}'")
+
+    for key in config:
+        if key not in BOOTSTRAP_CONFIG_SCHEMA:
+            preflight.warn('config', f"Unknown setting '{key}' is ignored")
+
+    region = config.get('awsRegion')
+    if isinstance(region, str) and region and not AWS_REGION.match(region):
+        preflight.error('config', f"awsRegion '{region}' is not an AWS region name")
+    device_name = config.get('deviceName')
+    if isinstance(device_name, (str, int)) and device_name not in ('', 'PROMPT') and \
+            not THING_NAME.match(str(device_name)):
+        preflight.error('config', f"deviceName '{device_name}' may only contain letters, digits, "
+                                  "':', '_' and '-'")
+    version = config.get('nucleusVersion')
+    if isinstance(version, str) and not NUCLEUS_VERSION.match(version):
+        preflight.error('config', f"nucleusVersion '{version}' is not a version like 2.16.0")
+
+def check_endpoints(config, preflight):
+    """Check that both endpoints are IoT hostnames in the configured region"""
+    region = config.get('awsRegion')
+    patterns = {
+        'iotDataEndpoint': (r"^[a-z0-9]+(-ats)?\.iot\.(?P<region>[a-z0-9-]+)" + DOMAIN_SUFFIX,
+                            "<prefix>-ats.iot.<region>.amazonaws.com"),
+        'iotCredEndpoint': (r"^[a-z0-9]+\.credentials\.iot\.(?P<region>[a-z0-9-]+)" + DOMAIN_SUFFIX,
+                            "<prefix>.credentials.iot.<region>.amazonaws.com"),
+    }
+    for key, (pattern, example) in patterns.items():
+        endpoint = config.get(key)
+        if not isinstance(endpoint, str) or not endpoint or endpoint.startswith('your-'):
+            continue
+        match = re.match(pattern, endpoint)
+        if not match:
+            hint = " (hostname only, without https:// or a port)" if '/' in endpoint or \
+                ':' in endpoint else ""
+            preflight.error('endpoint', f"{key} '{endpoint}' does not look like {example}{hint}")
+        elif isinstance(region, str) and match.group('region') != region:
+            preflight.error('endpoint', f"{key} is in {match.group('region')}, "
+                                        f"but awsRegion is {region}")
+        elif key == 'iotDataEndpoint' and not match.group(1):
+            preflight.warn('endpoint', f"{key} is a legacy endpoint; the Amazon Root CA 1 "
+                                       "trust chain needs the -ats endpoint")
+
+def der_element(data, offset):
+    """Return (tag, content start, content end) of the DER element at offset"""
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    return tag, offset, offset + length
+
+def certificate_validity(der):
+    """Return (notBefore, notAfter) in epoch seconds from a DER X.509 certificate"""
+    _, position, _ = der_element(der, 0)
+    _, position, _ = der_element(der, position)
+    tag, _, end = der_element(der, position)
+    # The version is an optional [0] field before the serial number
+    if tag == 0xa0:
+        position = end
+    for _ in range(3):
+        _, _, position = der_element(der, position)
+    _, position, _ = der_element(der, position)
+
+    times = []
+    for _ in range(2):
+        tag, start, end = der_element(der, position)
+        text = der[start:end].decode('ascii')
+        times.append(calendar.timegm(time.strptime(text, '%y%m%d%H%M%SZ' if tag == 0x17
+                                                   else '%Y%m%d%H%M%SZ')))
+        position = end
+    return times
+
+def check_claim_certificates(config, preflight):
+    """Check that the claim certificate and key exist, belong together and are in date"""
+    import ssl
+
     cert_path = config.get('claimCertificatePath')
     key_path = config.get('claimPrivateKeyPath')
+    if not isinstance(cert_path, str) or not isinstance(key_path, str) or \
+            not cert_path or not key_path:
+        return
 
-    if not cert_path or not key_path:
-        print("[ERROR] Claim certificate paths not specified in config")
-        return False
-
-    if not os.path.exists(cert_path):
-        print(f"[ERROR] Claim certificate not found: {cert_path}")
-        return False
+    missing = False
+    for label, path in (('certificate', cert_path), ('private key', key_path)):
+        if not os.path.isfile(path):
+            preflight.error('certificate', f"Claim {label} not found: {path}")
+            missing = True
+        elif not os.access(path, os.R_OK):
+            preflight.error('certificate', f"Claim {label} is not readable: {path}")
+            missing = True
+    if missing:
+        return
 
-    if not os.path.exists(key_path):
-        print(f"[ERROR] Claim private key not found: {key_path}")
-        return False
+    try:
+        with open(cert_path, 'r') as f:
+            pem = re.search(r"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----", f.read(),
+                            re.DOTALL)
+        if not pem:
+            raise ValueError("no certificate found")
+        not_before, not_after = certificate_validity(ssl.PEM_cert_to_DER_cert(pem.group(0)))
+    except (ValueError, IndexError, UnicodeError) as e:
+        preflight.error('certificate', f"Claim certificate {cert_path} is not a PEM certificate: {e}")
+        return
 
-    print(f"[OK] Claim certificate: {cert_path}")
-    print(f"[OK] Claim private key: {key_path}")
-    return True
+    try:
+        ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT).load_cert_chain(cert_path, key_path)
+    except ssl.SSLError as e:
+        if 'KEY_VALUES_MISMATCH' in str(e) or 'key values mismatch' in str(e):
+            preflight.error('certificate', f"Claim private key {key_path} does not belong to "
+                                           f"{cert_path}")
+        else:
+            preflight.error('certificate', f"Claim private key {key_path} could not be loaded: {e}")
 
-def download_root_ca():
-    """Download AWS IoT Root CA certificate"""
-    import urllib.request
+    now = time.time()
+    expires = time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(not_after))
+    if not_after < now:
+        preflight.error('certificate', f"Claim certificate expired on {expires}")
+    elif not_after - now < CERT_EXPIRY_WARNING_DAYS * 86400:
+        preflight.warn('certificate', f"Claim certificate expires on {expires}")
+    if not_before > now:
+        # Boards without a battery-backed clock often boot with an old date
+        preflight.warn('certificate', "Claim certificate is not valid yet; check the system clock")
 
-    certs_dir = f"{os.environ.get('SNAP_COMMON', '/tmp')}/certs"
-    os.makedirs(certs_dir, exist_ok=True)
-    root_ca_path = f"{certs_dir}/AmazonRootCA1.pem"
+def estimate_install_bytes(greengrass_root, image_path=None):
+    """Estimate the bytes the installed tree needs, without extracting anything"""
+    if os.path.exists(f"{greengrass_root}/.install-complete"):
+        return 0
+    if image_path:
+        if os.path.isdir(image_path):
+            return sum(os.path.getsize(os.path.join(directory, name))
+                       for directory, _, names in os.walk(image_path) for name in names
+                       if not os.path.islink(os.path.join(directory, name)))
+        # Compressed images expand to roughly three times their size
+        size = os.path.getsize(image_path)
+        return size if image_path.endswith('.tar') else size * 3
 
-    if os.path.exists(root_ca_path):
-        print(f"[OK] Root CA exists: {root_ca_path}")
-        return root_ca_path
+    snap_dir = os.environ.get('SNAP', '/tmp')
+    with zipfile.ZipFile(f"{snap_dir}/opt/greengrass/greengrass-nucleus.zip") as zf:
+        unpacked = sum(info.file_size for info in zf.infolist())
+    # The installer copies the distribution into alts/ next to the extracted zip
+    return unpacked * 2
 
+def check_disk_space(preflight, image_path=None):
+    """Check that $SNAP_COMMON has room for the installed tree"""
+    common_dir = os.environ.get('SNAP_COMMON', '/tmp')
     try:
-        url = "https://www.amazontrust.com/repository/AmazonRootCA1.pem"
-        print(f"Downloading Root CA from {url}...")
-        urllib.request.urlretrieve(url, root_ca_path)
-        print(f"[OK] Downloaded Root CA: {root_ca_path}")
-        return root_ca_path
-    except Exception as e:
-        print(f"[ERROR] Error downloading Root CA: {e}")
-        return None
+        needed = estimate_install_bytes(f"{common_dir}/greengrass/v2", image_path)
+        needed += DISK_HEADROOM_MB * 1024 * 1024
+        free = shutil.disk_usage(common_dir).free
+    except (OSError, zipfile.BadZipFile) as e:
+        preflight.warn('disk', f"Could not estimate the space needed: {e}")
+        return
+    if free < needed:
+        preflight.error('disk', f"{common_dir} has {free // 1024 // 1024} MB free; the install "
+                                f"needs about {needed // 1024 // 1024} MB")
 
-def create_fleet_provisioning_config(config, device_name, root_ca_path):
-    """Create Greengrass config for fleet provisioning with claim certificates"""
-    greengrass_root = f"{os.environ.get('SNAP_COMMON', '/tmp')}/greengrass/v2"
-    os.makedirs(greengrass_root, exist_ok=True)
+def check_snap_interfaces(preflight):
+    """Check that the interfaces the nucleus relies on are connected"""
+    if not os.environ.get('SNAP') or not shutil.which('snapctl'):
+        return
+    for interface in REQUIRED_INTERFACES:
+        try:
+            result = subprocess.run(['snapctl', 'is-connected', interface],
+                                    capture_output=True, text=True, timeout=10)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            preflight.warn('interfaces', f"Could not check the {interface} interface: {e}")
+            continue
+        if result.returncode == 1:
+            preflight.error('interfaces', f"{interface} is not connected; run "
+                                          f"sudo snap connect aws-iot-greengrass:{interface}")
+        elif result.returncode != 0:
+            preflight.warn('interfaces', f"Could not check the {interface} interface: "
+                                         f"{result.stderr.strip()}")
+
+PREFLIGHT_CHECKS = ('config', 'endpoint', 'certificate', 'disk', 'interfaces')
 
+def run_preflight(config, image_path=None, report=None, checks=PREFLIGHT_CHECKS):
+    """Validate the config, claim certificates, disk space and interfaces in one pass
+
+    Nothing is installed or contacted, so this takes well under a second,
+    and every problem is printed at once.  checks selects a subset for
+    staging and reconfigure, where this host's disk and interfaces do not
+    matter.  Returns True if there are no errors; warnings do not stop the
+    bootstrap.
+    """
+    report = report or RunReport('preflight')
+    if not isinstance(config, dict):
+        print("[ERROR] config: bootstrap-config.yaml must be a mapping of settings")
+        return False
+    preflight = Preflight()
+    with report.phase('preflight') as phase:
+        if 'config' in checks:
+            check_config_schema(config, preflight)
+        if 'endpoint' in checks:
+            check_endpoints(config, preflight)
+        if 'certificate' in checks:
+            check_claim_certificates(config, preflight)
+        if 'disk' in checks:
+            check_disk_space(preflight, image_path)
+        if 'interfaces' in checks:
+            check_snap_interfaces(preflight)
+        phase['errors'] = [f"{check}: {message}" for check, message in preflight.errors]
+        phase['warnings'] = [f"{check}: {message}" for check, message in preflight.warnings]
+
+    for check, message in preflight.warnings:
+        print(f"[WARN] {check}: {message}")
+    for check, message in preflight.errors:
+        print(f"[ERROR] {check}: {message}")
+    if preflight.errors:
+        print(f"[ERROR] Preflight found {len(preflight.errors)} problems; nothing was changed")
+        return False
+    print(f"[OK] Preflight checks passed"
+          f"{f' with {len(preflight.warnings)} warnings' if preflight.warnings else ''}")
+    return True
+
+def build_fleet_provisioning_config(config, device_name, root_ca_path, greengrass_root,
+                                    jvm_options=None, template_parameters=None,
+                                    logging_settings=None):
+    """Build the Greengrass fleet provisioning config for one device"""
     region = config.get('awsRegion')
     template_name = config.get('provisioningTemplate')
     iot_data_endpoint = config.get('iotDataEndpoint')
@@ -133,6 +377,8 @@ def create_fleet_provisioning_config(config, device_name, root_ca_path):
                     "iotDataEndpoint": iot_data_endpoint,
                     "rootPath": greengrass_root,
                     "templateParameters": {
+                        **(config.get('templateParameters') or {}),
+                        **(template_parameters or {}),
                         "ThingName": device_name,
                         "SerialNumber": config.get('serialNumber', device_name)
                     }
@@ -141,6 +387,23 @@ def create_fleet_provisioning_config(config, device_name, root_ca_path):
         }
     }
 
+    if jvm_options:
+        gg_config["services"]["aws.greengrass.Nucleus"]["configuration"]["jvmOptions"] = \
+            " ".join(jvm_options)
+    if logging_settings:
+        gg_config["services"]["aws.greengrass.Nucleus"]["configuration"]["logging"] = \
+            build_logging_config(logging_settings)
+    return gg_config
+
+def create_fleet_provisioning_config(config, device_name, root_ca_path, jvm_options=None,
+                                     greengrass_root=None, logging_settings=None):
+    """Create Greengrass config for fleet provisioning with claim certificates"""
+    greengrass_root = greengrass_root or f"{os.environ.get('SNAP_COMMON', '/tmp')}/greengrass/v2"
+    os.makedirs(greengrass_root, exist_ok=True)
+
+    gg_config = build_fleet_provisioning_config(config, device_name, root_ca_path, greengrass_root,
+                                                jvm_options, logging_settings=logging_settings)
+
     config_path = f"{greengrass_root}/config.yaml"
     with open(config_path, 'w') as f:
         yaml.dump(gg_config, f, default_flow_style=False)
@@ -148,36 +411,9 @@ def create_fleet_provisioning_config(config, device_name, root_ca_path):
     print(f"[OK] Created Greengrass config: {config_path}")
     return greengrass_root, config_path
 
-def find_java_binary(snap_dir):
-    """Find Java binary, trying architecture-agnostic symlink first, then arch-specific paths"""
-    arch = get_architecture()
-
-    # Ordered list of paths to try
-    java_paths = [
-        # Architecture-agnostic symlink (created in snapcraft.yaml)
-        f"{snap_dir}/usr/lib/jvm/java-11-openjdk/bin/java",
-        # Architecture-specific paths
-        f"{snap_dir}/usr/lib/jvm/java-11-openjdk-{arch}/bin/java",
-        # Glob pattern as fallback
-        f"{snap_dir}/usr/lib/jvm/java-11-openjdk-*/bin/java",
-    ]
-
-    for path in java_paths:
-        if '*' in path:
-            matches = glob.glob(path)
-            if matches:
-                print(f"[OK] Found Java via glob: {matches[0]}")
-                return matches[0]
-        elif os.path.exists(path):
-            print(f"[OK] Found Java: {path}")
-            return path
-
-    # Last resort: system java
-    print("[WARN] No snap Java found, falling back to system java")
-    return "java"
-
-def install_greengrass(greengrass_root, config_path):
+def install_greengrass(greengrass_root, config_path, appcds=False, report=None, jvm_options=()):
     """Install Greengrass with fleet provisioning (daemon will start it)"""
+    report = report or RunReport('install')
     snap_dir = os.environ.get('SNAP', '/tmp')
     greengrass_zip = f"{snap_dir}/opt/greengrass/greengrass-nucleus.zip"
 
@@ -185,9 +421,15 @@ def install_greengrass(greengrass_root, config_path):
         print(f"[ERROR] Greengrass installer not found: {greengrass_zip}")
         return False
 
-    with zipfile.ZipFile(greengrass_zip, 'r') as zip_ref:
-        zip_ref.extractall(greengrass_root)
-    print("[OK] Extracted Greengrass installer")
+    with report.phase('extraction') as phase:
+        stats = extract_nucleus_zip(greengrass_zip, greengrass_root)
+        phase.update(bytesWritten=stats['bytesWritten'], filesExtracted=stats['extracted'],
+                     filesSkipped=stats['skipped'])
+    if stats['extracted']:
+        print(f"[OK] Extracted Greengrass installer ({stats['extracted']} files updated, "
+              f"{stats['skipped']} unchanged)")
+    else:
+        print(f"[OK] Greengrass installer already extracted ({stats['skipped']} files unchanged)")
 
     # Copy FleetProvisioningByClaim plugin
     fleet_plugin_src = f"{snap_dir}/opt/greengrass/aws.greengrass.FleetProvisioningByClaim.jar"
@@ -196,18 +438,19 @@ def install_greengrass(greengrass_root, config_path):
     fleet_plugin_dst = f"{plugins_dir}/aws.greengrass.FleetProvisioningByClaim.jar"
 
     if os.path.exists(fleet_plugin_src):
-        import shutil
-        shutil.copy2(fleet_plugin_src, fleet_plugin_dst)
+        with report.phase('plugin_copy') as phase:
+            shutil.copy2(fleet_plugin_src, fleet_plugin_dst)
+            phase['bytesWritten'] = os.path.getsize(fleet_plugin_dst)
         print(f"[OK] Copied FleetProvisioningByClaim plugin")
     else:
         print(f"[ERROR] FleetProvisioningByClaim plugin not found: {fleet_plugin_src}")
         return False
 
-    # Find Java binary
-    arch = get_architecture()
-    print(f"[INFO] Detected architecture: {arch}")
-    java_path = find_java_binary(snap_dir)
-    print(f"[OK] Using Java: {java_path}")
+    # Find Java binary, reusing the result cached for this snap revision
+    runtime, cached = get_java_runtime(snap_dir, probe_version=False)
+    print(f"[INFO] Detected architecture: {runtime['ARCH']}")
+    java_path = runtime['JAVA_BIN']
+    print(f"[OK] Using Java: {java_path}{' (cached)' if cached else ''}")
 
     installer_jar = f"{greengrass_root}/lib/Greengrass.jar"
     fleet_plugin_jar = f"{greengrass_root}/plugins/aws.greengrass.FleetProvisioningByClaim.jar"
@@ -221,16 +464,26 @@ def install_greengrass(greengrass_root, config_path):
         return False
 
     # Set JAVA_HOME environment variable for child processes
-    java_home = os.path.dirname(os.path.dirname(java_path))
+    java_home = runtime['JAVA_HOME']
     env = os.environ.copy()
     env['JAVA_HOME'] = java_home
     print(f"[OK] JAVA_HOME: {java_home}")
 
+    # AppCDS stays enabled for later runs and the daemon once its directory exists
+    cds_dir = f"{greengrass_root}/cds"
+    if appcds:
+        os.makedirs(cds_dir, exist_ok=True)
+    installer_jar, cds_options, cds_mode = get_appcds_options(java_path, installer_jar, cds_dir, env)
+    if cds_mode != 'off':
+        print(f"[OK] AppCDS mode for installer: {cds_mode}")
+
     # Install Greengrass (setup only, don't start)
     install_cmd = [
         java_path,
         f"-Droot={greengrass_root}",
         "-Dlog.store=FILE",
+        *jvm_options,
+        *cds_options,
         "-jar", installer_jar,
         "--trusted-plugin", fleet_plugin_jar,
         "--init-config", config_path,
@@ -240,18 +493,797 @@ def install_greengrass(greengrass_root, config_path):
     ]
 
     print("Installing Greengrass...")
-    result = subprocess.run(install_cmd, capture_output=True, text=True, timeout=120, env=env)
+    install_start = time.monotonic()
+    with report.phase('installer', appcds=cds_mode) as phase:
+        result = subprocess.run(install_cmd, capture_output=True, text=True, timeout=120, env=env)
+        report.end(phase, 'ok' if result.returncode == 0 else 'failed', exitCode=result.returncode)
+    record_appcds_timing(cds_dir, 'installer', cds_mode, time.monotonic() - install_start)
 
     if result.returncode != 0:
         print(f"[ERROR] Installation failed: {result.stderr}")
         return False
 
+    # Lets the daemon's readiness check know the install is usable
+    open(f"{greengrass_root}/.install-complete", 'w').close()
+
     print("[OK] Greengrass installed")
+    for line in appcds_timing_report(cds_dir):
+        print(f"[INFO] {line}")
     print("[INFO] Greengrass daemon will start automatically")
     print("[INFO] Fleet provisioning will begin when daemon starts")
     return True
 
+# Device-specific or regenerated at runtime, so never part of a golden image
+IMAGE_EXCLUDES = {'config', 'config.yaml', 'logs', 'work', 'deployments', 'cds', '.install-complete'}
+IMAGE_MANIFEST = "golden-image.json"
+FICLONE = 0x40049409
+
+def write_golden_image(staging_root, image_path, manifest):
+    """Save an installed tree as a golden image directory or tar archive
+
+    Both layouts hold golden-image.json and the tree under root/.  Archives
+    store the manifest first so devices can apply them as a stream.
+    """
+    def exclude(tarinfo):
+        parts = tarinfo.name.split('/')
+        return None if len(parts) > 1 and parts[1] in IMAGE_EXCLUDES else tarinfo
+
+    manifest_data = json.dumps(manifest, indent=2).encode()
+    if image_path.endswith(('.tar', '.tar.gz', '.tgz')):
+        mode = 'w' if image_path.endswith('.tar') else 'w:gz'
+        tmp_path = f"{image_path}.partial"
+        with tarfile.open(tmp_path, mode) as tar:
+            info = tarfile.TarInfo(IMAGE_MANIFEST)
+            info.size = len(manifest_data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(manifest_data))
+            tar.add(staging_root, arcname='root', filter=exclude)
+        os.replace(tmp_path, image_path)
+    else:
+        shutil.rmtree(image_path, ignore_errors=True)
+        os.makedirs(image_path)
+        shutil.copytree(staging_root, f"{image_path}/root", symlinks=True,
+                        ignore=lambda path, names: IMAGE_EXCLUDES & set(names)
+                        if os.path.samefile(path, staging_root) else set())
+        with open(f"{image_path}/{IMAGE_MANIFEST}", 'wb') as f:
+            f.write(manifest_data)
+
+def export_golden_image(image_path, config, jvm_options=(), report=None):
+    """Run the installer once in a staging root and export the result"""
+    report = report or RunReport('export-image')
+    common_dir = os.environ.get('SNAP_COMMON', '/tmp')
+    staging_root = tempfile.mkdtemp(prefix='greengrass-image-', dir=common_dir)
+    try:
+        # Device values are placeholders; apply_golden_image injects the real config
+        _, config_path = create_fleet_provisioning_config(
+            config, 'golden-image', f"{common_dir}/certs/AmazonRootCA1.pem", jvm_options,
+            greengrass_root=staging_root)
+        if not install_greengrass(staging_root, config_path, report=report, jvm_options=jvm_options):
+            return False
+
+        with report.phase('image_export') as phase:
+            write_golden_image(staging_root, image_path, {
+                'formatVersion': 1,
+                'stagingRoot': staging_root,
+                'nucleusVersion': config.get('nucleusVersion', '2.16.1'),
+                'snapRevision': os.environ.get('SNAP_REVISION', ''),
+                'architecture': get_architecture(),
+                'created': time.time(),
+            })
+            if os.path.isfile(image_path):
+                phase['bytesWritten'] = os.path.getsize(image_path)
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
+
+    print(f"[OK] Exported golden image: {image_path}")
+    return True
+
+def rewrite_image_link(target, staging_root, greengrass_root):
+    """Point absolute symlinks into the staging root at the device root instead"""
+    if staging_root and (target == staging_root or target.startswith(staging_root + '/')):
+        return greengrass_root + target[len(staging_root):]
+    return target
+
+def clone_file(src, dst, link_mode):
+    """Place src at dst by hardlink, reflink or copy; returns the method used"""
+    if link_mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    if link_mode in ('auto', 'hardlink'):
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return 'reflink'
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def remove_existing(path):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+
+def apply_image_directory(image_path, greengrass_root, staging_root, link_mode, stats,
+                          link_root=None):
+    link_root = link_root or greengrass_root
+    source_root = f"{image_path}/root"
+    for dirpath, dirnames, filenames in os.walk(source_root):
+        relative = os.path.relpath(dirpath, source_root)
+        target_dir = os.path.normpath(f"{greengrass_root}/{relative}")
+        os.makedirs(target_dir, exist_ok=True)
+
+        for name in dirnames + filenames:
+            src = f"{dirpath}/{name}"
+            dst = f"{target_dir}/{name}"
+            if os.path.islink(src):
+                remove_existing(dst)
+                os.symlink(rewrite_image_link(os.readlink(src), staging_root, link_root), dst)
+                stats['symlinks'] += 1
+            elif name in filenames:
+                remove_existing(dst)
+                method = clone_file(src, dst, link_mode)
+                stats[method] = stats.get(method, 0) + 1
+                if method == 'copy':
+                    stats['bytesWritten'] += os.path.getsize(dst)
+
+def inside(path, root):
+    """True if a normalised path is root or below it"""
+    return path == root or path.startswith(root.rstrip('/') + '/')
+
+def apply_image_archive(image_path, greengrass_root, stats, link_root=None):
+    """Extract a golden image archive as a stream, refusing anything that leaves the tree
+
+    Member paths, the real location of each member's parent directory (so
+    an earlier symlink cannot redirect later files), hardlink sources and
+    symlink targets must all stay inside greengrass_root, or link_root for
+    absolute symlinks.
+    """
+    link_root = os.path.normpath(link_root or greengrass_root)
+    dest_root = os.path.realpath(greengrass_root)
+    staging_root = None
+    with tarfile.open(image_path, 'r|*') as tar:
+        for member in tar:
+            if member.name == IMAGE_MANIFEST:
+                staging_root = json.load(tar.extractfile(member)).get('stagingRoot')
+                continue
+            if member.name != 'root' and not member.name.startswith('root/'):
+                continue
+            target = os.path.normpath(f"{dest_root}/{member.name[len('root'):]}")
+            if not inside(target, dest_root) or (target != dest_root and not inside(
+                    os.path.realpath(os.path.dirname(target)), dest_root)):
+                raise ValueError(f"Refusing to extract {member.name} outside {greengrass_root}")
+
+            if member.isdir():
+                if os.path.islink(target):
+                    raise ValueError(f"Refusing to extract {member.name} through a symlink")
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            remove_existing(target)
+            if member.issym():
+                if staging_root is None:
+                    raise ValueError(f"{image_path} has no {IMAGE_MANIFEST} before its files")
+                link_target = rewrite_image_link(member.linkname, staging_root, link_root)
+                if os.path.isabs(link_target):
+                    allowed = inside(os.path.normpath(link_target), link_root)
+                else:
+                    allowed = inside(os.path.normpath(
+                        os.path.join(os.path.dirname(target), link_target)), dest_root)
+                if not allowed:
+                    raise ValueError(f"Refusing symlink {member.name} -> {member.linkname} "
+                                     "outside the image")
+                os.symlink(link_target, target)
+                stats['symlinks'] += 1
+            elif member.islnk():
+                source = os.path.normpath(f"{dest_root}/{member.linkname[len('root'):]}")
+                if not member.linkname.startswith('root/') or not inside(source, dest_root) or \
+                        not inside(os.path.realpath(os.path.dirname(source)), dest_root):
+                    raise ValueError(f"Refusing hardlink {member.name} to {member.linkname} "
+                                     "outside the image")
+                os.link(source, target)
+                stats['hardlink'] = stats.get('hardlink', 0) + 1
+            elif member.isfile():
+                with open(target, 'wb') as dst:
+                    shutil.copyfileobj(tar.extractfile(member), dst, 1024 * 1024)
+                os.chmod(target, member.mode)
+                os.utime(target, (member.mtime, member.mtime))
+                stats['copy'] = stats.get('copy', 0) + 1
+                stats['bytesWritten'] += member.size
+
+def copy_golden_image(image_path, greengrass_root, link_mode='auto', link_root=None):
+    """Copy a golden image's tree into greengrass_root; returns copy statistics
+
+    Directory images are cloned file by file (reflinks by default, hardlinks
+    on request, copies as the fallback); archives are extracted as a stream.
+    Absolute symlinks are pointed at link_root, which defaults to
+    greengrass_root.
+    """
+    stats = {'symlinks': 0, 'bytesWritten': 0}
+    if os.path.isdir(image_path):
+        with open(f"{image_path}/{IMAGE_MANIFEST}", 'r') as f:
+            manifest = json.load(f)
+        print(f"[INFO] Golden image: nucleus {manifest.get('nucleusVersion')}, "
+              f"snap revision {manifest.get('snapRevision') or 'unknown'}")
+        apply_image_directory(image_path, greengrass_root, manifest.get('stagingRoot'),
+                              link_mode, stats, link_root)
+    else:
+        apply_image_archive(image_path, greengrass_root, stats, link_root)
+    return stats
+
+def image_init_config(device_config):
+    """Return what the installer's --init-config and --component-default-user would write"""
+    nucleus_config = device_config['services']['aws.greengrass.Nucleus']['configuration']
+    nucleus_config.setdefault('runWithDefault', {'posixUser': 'root:root'})
+    return device_config
+
+def apply_golden_image(image_path, greengrass_root, config_path, link_mode='auto', report=None):
+    """Install Greengrass from a golden image instead of running the installer
+
+    The device config is injected where the nucleus reads it on first start.
+    """
+    report = report or RunReport('install')
+    if not os.path.exists(image_path):
+        print(f"[ERROR] Golden image not found: {image_path}")
+        return False
+
+    with report.phase('image_apply') as phase:
+        stats = copy_golden_image(image_path, greengrass_root, link_mode)
+        phase.update(stats)
+    print(f"[OK] Applied golden image ({', '.join(f'{key}: {value}' for key, value in stats.items())})")
+
+    with open(config_path, 'r') as f:
+        device_config = image_init_config(yaml.safe_load(f))
+    os.makedirs(f"{greengrass_root}/config", exist_ok=True)
+    with open(f"{greengrass_root}/config/config.yaml", 'w') as f:
+        yaml.dump(device_config, f, default_flow_style=False)
+
+    if not os.path.isfile(f"{greengrass_root}/lib/Greengrass.jar"):
+        print(f"[ERROR] Golden image did not contain lib/Greengrass.jar")
+        return False
+
+    # Lets the daemon's readiness check know the install is usable
+    open(f"{greengrass_root}/.install-complete", 'w').close()
+    print("[OK] Greengrass installed from golden image")
+    print("[INFO] Fleet provisioning will begin when daemon starts")
+    return True
+
+DEVICE_COMMON = "/var/snap/aws-iot-greengrass/common"
+THING_NAME = re.compile(r"^[a-zA-Z0-9:_-]+$")
+
+def load_staging_manifest(manifest_path):
+    """Load device names, serial numbers and template parameters from a CSV or YAML manifest
+
+    CSV manifests need a header row with a 'deviceName' column and may have
+    a 'serialNumber' column; every other non-empty column becomes a
+    provisioning template parameter.  YAML manifests are a list of devices
+    (or a mapping with a 'devices' list), where each entry is a device name
+    or a mapping with 'deviceName', 'serialNumber' and 'templateParameters'.
+    """
+    devices = []
+
+    if manifest_path.lower().endswith('.csv'):
+        with open(manifest_path, newline='') as f:
+            for row in csv.DictReader(f):
+                name = (row.pop('deviceName', None) or '').strip()
+                if not name:
+                    continue
+                serial = (row.pop('serialNumber', None) or '').strip()
+                parameters = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+                devices.append({'deviceName': name, 'serialNumber': serial,
+                                'templateParameters': parameters})
+    else:
+        with open(manifest_path, 'r') as f:
+            data = yaml.safe_load(f) or []
+        if isinstance(data, dict):
+            data = data.get('devices', [])
+        for entry in data:
+            if isinstance(entry, str):
+                entry = {'deviceName': entry}
+            name = str(entry.get('deviceName') or '').strip()
+            if not name:
+                continue
+            parameters = {str(k): str(v) for k, v in (entry.get('templateParameters') or {}).items()}
+            devices.append({'deviceName': name, 'serialNumber': str(entry.get('serialNumber') or ''),
+                            'templateParameters': parameters})
+
+    invalid = [d['deviceName'] for d in devices if not THING_NAME.match(d['deviceName'])]
+    if invalid:
+        raise ValueError(f"Invalid device names in manifest: {', '.join(invalid)}")
+    names = [d['deviceName'] for d in devices]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate device names in manifest: {', '.join(duplicates)}")
+
+    return devices
+
+def prepare_staging_template(template_dir, image_path, device_root):
+    """Build the part of every staged tree that is the same for all devices
+
+    Returns True when the template came from a golden image, so the staged
+    trees are fully installed.
+    """
+    if image_path:
+        copy_golden_image(image_path, template_dir, link_root=device_root)
+        return True
+
+    snap_dir = os.environ.get('SNAP', '/tmp')
+    extract_nucleus_zip(f"{snap_dir}/opt/greengrass/greengrass-nucleus.zip", template_dir)
+    os.makedirs(f"{template_dir}/plugins", exist_ok=True)
+    shutil.copy2(f"{snap_dir}/opt/greengrass/aws.greengrass.FleetProvisioningByClaim.jar",
+                 f"{template_dir}/plugins/aws.greengrass.FleetProvisioningByClaim.jar")
+    return False
+
+def as_root(tarinfo):
+    """Tar filter: files on the device belong to root"""
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = 'root'
+    return tarinfo
+
+def stage_device(device, job):
+    """Write one device's $SNAP_COMMON archive; runs in a worker process"""
+    start = time.monotonic()
+    device_name = device['deviceName']
+    result = {'deviceName': device_name, 'status': 'failed'}
+    archive_path = f"{job['outputDir']}/{device_name}.tar.gz"
+
+    try:
+        device_common = job['deviceCommon']
+        device_root = f"{device_common}/greengrass/v2"
+        config = dict(job['config'], deviceName=device_name)
+        if device['serialNumber']:
+            config['serialNumber'] = device['serialNumber']
+        # Kept in the device's bootstrap config so a later reconfigure keeps them
+        if device['templateParameters']:
+            config['templateParameters'] = {**(config.get('templateParameters') or {}),
+                                            **device['templateParameters']}
+
+        gg_config = build_fleet_provisioning_config(
+            config, device_name, f"{device_common}/certs/AmazonRootCA1.pem", device_root,
+            job['jvmOptions'], logging_settings=job['logging'])
+        files = {
+            'bootstrap-config.yaml': yaml.dump(config, default_flow_style=False),
+            'certs/AmazonRootCA1.pem': job['rootCaPem'],
+            'greengrass/v2/config.yaml': yaml.dump(gg_config, default_flow_style=False),
+        }
+        if job['installed']:
+            files['greengrass/v2/config/config.yaml'] = yaml.dump(image_init_config(gg_config),
+                                                                  default_flow_style=False)
+            files['greengrass/v2/.install-complete'] = ''
+        if job['jvmOptions']:
+            files['jvm-options.env'] = (f"JVM_PROFILE={shlex.quote(job['jvmProfile'])}\n"
+                                        f"JVM_OPTIONS={shlex.quote(' '.join(job['jvmOptions']))}\n")
+        files['logging.env'] = logging_env_text(job['logging'], device_root)
+
+        tmp_path = f"{archive_path}.partial"
+        with tarfile.open(tmp_path, 'w:gz', compresslevel=job['compressLevel']) as tar:
+            tar.add(job['templateDir'], arcname='greengrass/v2', filter=as_root)
+            for arcname, source in job['claimFiles'].items():
+                tar.add(source, arcname=arcname, filter=as_root)
+            for arcname, text in files.items():
+                data = text.encode()
+                info = as_root(tarfile.TarInfo(arcname))
+                info.size = len(data)
+                info.mtime = int(time.time())
+                info.mode = 0o600 if arcname.endswith('.yaml') else 0o644
+                tar.addfile(info, io.BytesIO(data))
+        os.replace(tmp_path, archive_path)
+
+        result.update(status='staged', archive=archive_path, bytes=os.path.getsize(archive_path))
+    except Exception as e:
+        result['error'] = str(e)
+
+    result['seconds'] = round(time.monotonic() - start, 3)
+    return result
+
+def staging_preflight_config(config, device_common):
+    """Return the config and checks for preflight on a staging host
+
+    Claim certificate paths point at the device's $SNAP_COMMON; they are
+    checked at the same relative path on this host, and skipped when this
+    host does not have them.
+    """
+    local_common = os.environ.get('SNAP_COMMON', '/tmp')
+    preflight_config = dict(config) if isinstance(config, dict) else config
+    local_paths = 0
+    for key in ('claimCertificatePath', 'claimPrivateKeyPath'):
+        path = preflight_config.get(key) if isinstance(preflight_config, dict) else None
+        if isinstance(path, str) and path.startswith(device_common + '/'):
+            local_path = f"{local_common}/{path[len(device_common) + 1:]}"
+            if os.path.isfile(local_path):
+                preflight_config[key] = local_path
+                local_paths += 1
+    checks = ('config', 'endpoint', 'certificate') if local_paths == 2 else ('config', 'endpoint')
+    return preflight_config, checks
+
+def run_factory_staging(manifest_path, config, output_dir, workers, image_path, device_common,
+                        compress_level, report, component_cache=None):
+    """Stage a device-ready $SNAP_COMMON archive for every device in a manifest"""
+    print("=== Factory staging ===")
+    try:
+        devices = load_staging_manifest(manifest_path)
+    except Exception as e:
+        print(f"[ERROR] Could not load device manifest: {e}")
+        return False
+    if not devices:
+        print(f"[ERROR] No devices found in manifest {manifest_path}")
+        return False
+    print(f"[OK] Loaded {len(devices)} devices from {manifest_path}")
+
+    root_ca_path = download_root_ca()
+    if not root_ca_path:
+        return False
+    with open(root_ca_path, 'r') as f:
+        root_ca_pem = f.read()
+
+    # RAM on the staging host says nothing about the devices, so only an
+    # explicit profile from the jvm section is applied
+    jvm_overrides = config.get('jvm') or {}
+    jvm_profile, jvm_options = 'auto', []
+    if str(jvm_overrides.get('profile') or 'auto') != 'auto':
+        jvm_profile, jvm_options = select_jvm_profile(None, 2, jvm_overrides)
+        print(f"[OK] JVM profile for devices: {jvm_profile}")
+    else:
+        print("[INFO] No jvm.profile set; device JVMs keep their defaults")
+
+    # Claim certificates are included when their on-device location is in
+    # $SNAP_COMMON and the staging host has them at the same relative path
+    local_common = os.environ.get('SNAP_COMMON', '/tmp')
+    claim_files = {}
+    for key in ('claimCertificatePath', 'claimPrivateKeyPath'):
+        path = config.get(key) or ''
+        if path.startswith(device_common + '/'):
+            relative = path[len(device_common) + 1:]
+            if os.path.isfile(f"{local_common}/{relative}"):
+                claim_files[relative] = f"{local_common}/{relative}"
+    if len(claim_files) < 2:
+        print("[WARN] Claim certificates not found on this host; load them onto devices separately")
+
+    os.makedirs(output_dir, exist_ok=True)
+    template_dir = tempfile.mkdtemp(prefix='greengrass-template-', dir=output_dir)
+    try:
+        with report.phase('staging_template') as phase:
+            installed = prepare_staging_template(template_dir, image_path,
+                                                 f"{device_common}/greengrass/v2")
+            phase['installed'] = installed
+        # Seeded once into the template, so every archive carries the components
+        if component_cache:
+            seed_components(component_cache, template_dir, report)
+        if installed:
+            print("[OK] Staging from golden image; devices start without running the installer")
+        else:
+            print("[INFO] No --image given; devices finish installing with `bootstrap` on first boot")
+
+        job = {
+            'config': config,
+            'outputDir': output_dir,
+            'templateDir': template_dir,
+            'deviceCommon': device_common,
+            'installed': installed,
+            'rootCaPem': root_ca_pem,
+            'claimFiles': claim_files,
+            'jvmProfile': jvm_profile,
+            'jvmOptions': jvm_options,
+            'logging': select_logging(config.get('logging')),
+            'compressLevel': compress_level,
+        }
+
+        print(f"\n=== Staging {len(devices)} devices with {workers} workers ===")
+        results = []
+        staging_start = time.monotonic()
+        staging_phase = report.begin('staging', devices=len(devices), workers=workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(stage_device, device, job) for device in devices]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                report.event('device_result', **result)
+                if result['status'] == 'staged':
+                    print(f"[OK] {result['deviceName']}: {result['bytes'] / 1e6:.1f} MB "
+                          f"in {result['seconds']:.2f}s")
+                else:
+                    print(f"[ERROR] {result['deviceName']}: {result['error']}")
+        elapsed = time.monotonic() - staging_start
+    finally:
+        shutil.rmtree(template_dir, ignore_errors=True)
+
+    results.sort(key=lambda r: r['deviceName'])
+    staged = [r for r in results if r['status'] == 'staged']
+    failed = [r for r in results if r['status'] != 'staged']
+    total_bytes = sum(r['bytes'] for r in staged)
+    report.end(staging_phase, 'ok' if not failed else 'failed',
+               staged=len(staged), failedDevices=len(failed), bytesWritten=total_bytes)
+
+    summary = {
+        'manifest': manifest_path,
+        'workers': workers,
+        'deviceCommon': device_common,
+        'installed': installed,
+        'total': len(results),
+        'staged': len(staged),
+        'failed': len(failed),
+        'elapsedSeconds': round(elapsed, 3),
+        'devicesPerMinute': round(len(staged) / elapsed * 60, 2) if elapsed else None,
+        'megabytesPerSecond': round(total_bytes / 1e6 / elapsed, 2) if elapsed else None,
+        'devices': results
+    }
+    summary_path = f"{output_dir}/staging-report.json"
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print("\n" + "=" * 50)
+    print(f"Staged {len(staged)}/{len(results)} devices in {elapsed:.1f}s "
+          f"({summary['devicesPerMinute']} devices/min, {summary['megabytesPerSecond']} MB/s)")
+    print(f"Archives: {output_dir}")
+    print(f"Report: {summary_path}")
+    print(f"Write each archive to its device with: tar -xzpf <device>.tar.gz -C <data partition>{device_common}")
+    for r in failed:
+        print(f"  [ERROR] {r['deviceName']}: {r['error']}")
+    print("=" * 50)
+    return not failed
+
+NUCLEUS = ('services', 'aws.greengrass.Nucleus')
+PROVISIONING = ('services', 'aws.greengrass.FleetProvisioningByClaim')
+
+# Settings reconfigure keeps in step with bootstrap-config.yaml.  A running
+# nucleus writes its effective config back out, so any of them, even the
+# provisioning settings it only reads when the device provisions, is
+# patched with the daemon stopped.
+RECONFIGURE_KEYS = [
+    NUCLEUS + ('configuration', 'awsRegion'),
+    NUCLEUS + ('configuration', 'iotRoleAlias'),
+    NUCLEUS + ('configuration', 'iotDataEndpoint'),
+    NUCLEUS + ('configuration', 'iotCredEndpoint'),
+    NUCLEUS + ('configuration', 'jvmOptions'),
+    NUCLEUS + ('configuration', 'logging'),
+    PROVISIONING + ('configuration', 'provisioningTemplate'),
+    PROVISIONING + ('configuration', 'iotDataEndpoint'),
+    PROVISIONING + ('configuration', 'claimCertificatePath'),
+    PROVISIONING + ('configuration', 'claimCertificatePrivateKeyPath'),
+    PROVISIONING + ('configuration', 'templateParameters'),
+]
+
+def get_config_value(config, path):
+    """Return the value at a key path in a nested config, or None"""
+    for key in path:
+        if not isinstance(config, dict):
+            return None
+        config = config.get(key)
+    return config
+
+def set_config_value(config, path, value):
+    """Set (or remove, for None) the value at a key path in a nested config"""
+    for key in path[:-1]:
+        config = config.setdefault(key, {})
+    if value is None:
+        config.pop(path[-1], None)
+    else:
+        config[path[-1]] = value
+
+def diff_greengrass_config(current, desired):
+    """Return [(key path, current value, desired value)] for changed settings"""
+    changes = []
+    for path in RECONFIGURE_KEYS:
+        # Settings for a service the device does not run are left alone
+        if get_config_value(current, path[:2]) is None:
+            continue
+        old_value = get_config_value(current, path)
+        new_value = get_config_value(desired, path)
+        if old_value != new_value:
+            changes.append((path, old_value, new_value))
+    return changes
+
+def daemon_active():
+    """Return True/False for the greengrass-daemon service state, or None if unknown"""
+    try:
+        result = subprocess.run(['snapctl', 'services', 'aws-iot-greengrass.greengrass-daemon'],
+                                capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    for line in result.stdout.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) >= 3:
+            return fields[2] == 'active'
+    return None
+
+def snapctl_daemon(action):
+    """Run snapctl start/stop for the greengrass-daemon service"""
+    result = subprocess.run(['snapctl', action, 'aws-iot-greengrass.greengrass-daemon'],
+                            capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        print(f"[ERROR] snapctl {action} failed: {result.stderr.strip()}")
+        return False
+    return True
+
+def write_yaml_atomic(path, data):
+    """Replace a YAML file in one step so the nucleus never reads half of it"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        yaml.dump(data, f, default_flow_style=False, sort_keys=False)
+    os.chmod(tmp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o600)
+    os.replace(tmp_path, path)
+
+def reconfigure_greengrass(config, dry_run=False, restart=True, report=None):
+    """Apply changed bootstrap-config.yaml settings to an installed nucleus
+
+    The desired settings are compared with config/effectiveConfig.yaml (or
+    the init config of a device that has not started yet) and only changed
+    keys are written.  A running nucleus writes its effective config back
+    out, so a running daemon is stopped while the config is patched and
+    started again afterwards; with restart=False the config is left alone
+    while the daemon runs.
+    """
+    report = report or RunReport('reconfigure')
+    common_dir = os.environ.get('SNAP_COMMON', '/tmp')
+    greengrass_root = f"{common_dir}/greengrass/v2"
+
+    current_path = None
+    for candidate in (f"{greengrass_root}/config/effectiveConfig.yaml",
+                      f"{greengrass_root}/config/config.yaml"):
+        if os.path.isfile(candidate):
+            current_path = candidate
+            break
+    if not current_path:
+        print(f"[ERROR] Greengrass is not installed in {greengrass_root}; run bootstrap first")
+        return False
+    print(f"[OK] Current config: {current_path}")
+
+    with report.phase('config_diff') as phase:
+        with open(current_path, 'r') as f:
+            current = yaml.safe_load(f) or {}
+
+        # The device name and root CA are fixed once the device is installed
+        provisioning = get_config_value(current, PROVISIONING + ('configuration',)) or {}
+        device_name = config.get('deviceName')
+        if not device_name or device_name == 'PROMPT':
+            device_name = (get_config_value(current, ('system', 'thingName')) or
+                           (provisioning.get('templateParameters') or {}).get('ThingName'))
+        root_ca_path = provisioning.get('rootCaPath') or f"{common_dir}/certs/AmazonRootCA1.pem"
+
+        total_mb, cpus = read_system_resources()
+        profile_name, jvm_options = select_jvm_profile(total_mb, cpus, config.get('jvm'))
+        logging_settings = select_logging(config.get('logging'))
+        desired = build_fleet_provisioning_config(config, device_name, root_ca_path,
+                                                  greengrass_root, jvm_options,
+                                                  logging_settings=logging_settings)
+        changes = diff_greengrass_config(current, desired)
+        phase['changedKeys'] = ['.'.join(path[1:]) for path, _, _ in changes]
+
+    jvm_env_path = f"{common_dir}/jvm-options.env"
+    jvm_line = f"JVM_OPTIONS={shlex.quote(' '.join(jvm_options))}"
+    try:
+        with open(jvm_env_path, 'r') as f:
+            jvm_env_changed = jvm_line not in f.read().splitlines()
+    except FileNotFoundError:
+        jvm_env_changed = bool(jvm_options)
+
+    logging_env_path = f"{common_dir}/logging.env"
+    try:
+        with open(logging_env_path, 'r') as f:
+            logging_env_changed = f.read() != logging_env_text(logging_settings, greengrass_root)
+    except FileNotFoundError:
+        logging_env_changed = True
+
+    current_version = get_config_value(current, NUCLEUS + ('version',))
+    desired_version = config.get('nucleusVersion', '2.16.1')
+    if current_version and current_version != desired_version:
+        print(f"[WARN] nucleusVersion {current_version} -> {desired_version} is not applied: "
+              "upgrade the nucleus with a Greengrass deployment or re-run bootstrap")
+
+    if not changes and not jvm_env_changed and not logging_env_changed:
+        print("[OK] Greengrass config is up to date")
+        return True
+
+    for path, old_value, new_value in changes:
+        print(f"[INFO] {'.'.join(path[1:])}: {old_value!r} -> {new_value!r}")
+    if jvm_env_changed:
+        print(f"[INFO] {jvm_env_path}: JVM profile {profile_name}")
+    if logging_env_changed:
+        print(f"[INFO] {logging_env_path}: RAM log directory "
+              f"{'on' if logging_settings['ramDirectory'] else 'off'}")
+
+    if dry_run:
+        print("[INFO] Dry run; nothing was changed")
+        return True
+
+    # The nucleus rewrites its effective config while running, so it is
+    # stopped before the file is patched rather than restarted afterwards.
+    # Every change, including the env files, needs a restart to take effect
+    active = daemon_active()
+    skipped = []
+    if active and not restart:
+        skipped = ['.'.join(path[1:]) for path, _, _ in changes]
+        changes = []
+        active = False
+    if skipped:
+        print("[WARN] greengrass-daemon is running and --no-restart was given; "
+              f"not applied: {', '.join(skipped)} (run --reconfigure again while it is stopped)")
+    if active and not snapctl_daemon('stop'):
+        return False
+
+    with report.phase('config_patch') as phase:
+        for path, _, new_value in changes:
+            set_config_value(current, path, new_value)
+        if changes:
+            write_yaml_atomic(current_path, current)
+        if jvm_env_changed:
+            write_jvm_options_file(jvm_env_path, profile_name, jvm_options)
+        if logging_env_changed:
+            write_logging_file(logging_env_path, logging_settings, greengrass_root)
+        # Keep the installer's config in step for a later full bootstrap
+        if os.path.isfile(f"{greengrass_root}/config.yaml"):
+            write_yaml_atomic(f"{greengrass_root}/config.yaml", desired)
+        phase['restart'] = bool(active)
+        phase['skippedKeys'] = skipped
+    print(f"[OK] Patched {len(changes)} settings in {current_path}")
+
+    if active:
+        with report.phase('daemon_restart'):
+            if not snapctl_daemon('start'):
+                return False
+        print("[OK] Restarted greengrass-daemon")
+    else:
+        print("[INFO] Changes take effect the next time greengrass-daemon starts")
+    return True
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="AWS IoT Greengrass Bootstrap Setup")
+    parser.add_argument('--appcds', action='store_true',
+                        help="Enable an AppCDS class-data-sharing archive for the Greengrass "
+                             "JVMs (also used by the daemon)")
+    parser.add_argument('--preflight-only', action='store_true',
+                        help="Run the preflight checks on bootstrap-config.yaml, the claim "
+                             "certificates, disk space and snap interfaces, then exit")
+    parser.add_argument('--export-image', metavar='PATH',
+                        help="Run the installer once in a staging root and export a golden image "
+                             "to PATH (a directory, or a .tar/.tar.gz archive), then exit")
+    parser.add_argument('--image', metavar='PATH',
+                        help="Install from a golden image instead of running the Java installer")
+    parser.add_argument('--image-link', choices=['auto', 'hardlink', 'copy'], default='auto',
+                        help="How files are taken from a directory image: auto (reflink, else "
+                             "copy), hardlink (shares inodes with the image) or copy (default: auto)")
+    parser.add_argument('--stage-manifest', metavar='PATH',
+                        help="Factory staging: write a device-ready $SNAP_COMMON archive for every "
+                             "device in this CSV or YAML manifest, then exit")
+    parser.add_argument('--output-dir',
+                        help="Directory for staged archives (default: $SNAP_COMMON/staging)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Devices staged in parallel (default: number of CPUs)")
+    parser.add_argument('--device-common', default=DEVICE_COMMON,
+                        help=f"$SNAP_COMMON path on the devices (default: {DEVICE_COMMON})")
+    parser.add_argument('--compress-level', type=int, default=6, choices=range(1, 10),
+                        metavar='1-9', help="gzip level for staged archives (default: 6)")
+    parser.add_argument('--component-cache', metavar='PATH',
+                        help="Directory or .tar/.tar.gz of component recipes and artifacts to "
+                             "seed into the nucleus store (default: componentCache from "
+                             "bootstrap-config.yaml, else $SNAP_COMMON/component-cache if present)")
+    parser.add_argument('--reconfigure', action='store_true',
+                        help="Apply changed bootstrap-config.yaml settings to the installed nucleus "
+                             "without reinstalling, restarting the daemon if anything changed")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="With --reconfigure, show the changes without applying them")
+    parser.add_argument('--no-restart', action='store_true',
+                        help="With --reconfigure, never restart greengrass-daemon (config keys are "
+                             "then not patched while it runs)")
+    parser.add_argument('--report',
+                        help="Write a JSON report of phase timings, outcomes and exit codes to this file")
+    parser.add_argument('--events',
+                        help="Append phase start/end events as JSON lines to this file")
+    return parser.parse_args(argv)
+
 def main():
+    args = parse_args()
+
+    # Written on every exit path, including sys.exit on failure
+    report = RunReport('bootstrap', args.report, args.events)
+    atexit.register(report.write)
+
     print("=" * 50)
     print("AWS IoT Greengrass Bootstrap Setup")
     print("(Fleet Provisioning with Claim Certificates)")
@@ -262,31 +1294,105 @@ def main():
     print(f"[INFO] Running on architecture: {arch} ({platform.machine()})")
 
     # Load bootstrap config
-    config, config_path = load_bootstrap_config()
+    with report.phase('load_config'):
+        config, config_path = load_bootstrap_config()
     if not config:
         sys.exit(1)
 
+    if args.reconfigure:
+        # Catch placeholder or malformed endpoints before they are written to the device
+        if not run_preflight(config, report=report, checks=('config', 'endpoint')):
+            sys.exit(1)
+        if not reconfigure_greengrass(config, args.dry_run, not args.no_restart, report):
+            print("[ERROR] Reconfigure failed")
+            sys.exit(1)
+        report.outcome = 'success'
+        return
+
+    if args.stage_manifest:
+        output_dir = args.output_dir or f"{os.environ.get('SNAP_COMMON', '/tmp')}/staging"
+        # A bad config would otherwise be copied into every staged archive. Claim
+        # certificates are checked when this host has them (see run_factory_staging)
+        preflight_config, checks = staging_preflight_config(config, args.device_common.rstrip('/'))
+        if not run_preflight(preflight_config, report=report, checks=checks):
+            sys.exit(1)
+        if not run_factory_staging(args.stage_manifest, config, output_dir, max(args.workers, 1),
+                                   args.image, args.device_common.rstrip('/'), args.compress_level,
+                                   report, get_component_cache(args.component_cache or
+                                                               config.get('componentCache'))):
+            sys.exit(1)
+        report.outcome = 'success'
+        return
+
+    if args.export_image:
+        # The image is built from this config; claim certificates are not part of it
+        if not run_preflight(config, report=report, checks=('config', 'endpoint', 'disk')):
+            sys.exit(1)
+        _, jvm_options = select_jvm_profile(*read_system_resources(), config.get('jvm'))
+        if not export_golden_image(args.export_image, config, jvm_options, report):
+            print("[ERROR] Golden image export failed")
+            sys.exit(1)
+        report.outcome = 'success'
+        return
+
+    # Catch config, certificate, disk and interface problems before anything heavy runs
+    if not run_preflight(config, args.image, report):
+        sys.exit(1)
+    if args.preflight_only:
+        report.outcome = 'success'
+        return
+
     # Get device name
     device_name = get_device_name(config)
     if not device_name:
         sys.exit(1)
 
-    # Validate claim certificates
-    if not validate_claim_certificates(config):
-        sys.exit(1)
+    report.details.update(deviceName=device_name, region=config.get('awsRegion'))
 
     # Download Root CA
-    root_ca_path = download_root_ca()
+    with report.phase('root_ca'):
+        root_ca_path = download_root_ca()
     if not root_ca_path:
         sys.exit(1)
 
+    # Size the nucleus JVM for this device, with overrides from the jvm section
+    total_mb, cpus = read_system_resources()
+    profile_name, jvm_options = select_jvm_profile(total_mb, cpus, config.get('jvm'))
+    print(f"[OK] JVM profile: {profile_name} ({total_mb or 'unknown'} MB RAM, {cpus} CPUs)")
+    if jvm_options:
+        print(f"[INFO] JVM options: {' '.join(jvm_options)}")
+    write_jvm_options_file(f"{os.environ.get('SNAP_COMMON', '/tmp')}/jvm-options.env",
+                           profile_name, jvm_options)
+
+    # Log level, rotation and location, with overrides from the logging section
+    logging_settings = select_logging(config.get('logging'))
+    logs_dir = (get_ram_log_dir() if logging_settings['ramDirectory']
+                else f"{os.environ.get('SNAP_COMMON', '/tmp')}/greengrass/v2/logs")
+    print(f"[OK] Logging: {logging_settings['level']}, {logging_settings['format']}, "
+          f"{logging_settings['fileSizeKB']} KB files, {logging_settings['totalLogsSizeKB']} KB "
+          f"per log, in {logs_dir}")
+    write_logging_file(f"{os.environ.get('SNAP_COMMON', '/tmp')}/logging.env", logging_settings,
+                       f"{os.environ.get('SNAP_COMMON', '/tmp')}/greengrass/v2")
+
     # Create Greengrass config
-    greengrass_root, gg_config_path = create_fleet_provisioning_config(
-        config, device_name, root_ca_path
-    )
+    with report.phase('config_generation') as phase:
+        greengrass_root, gg_config_path = create_fleet_provisioning_config(
+            config, device_name, root_ca_path, jvm_options, logging_settings=logging_settings
+        )
+        phase['bytesWritten'] = os.path.getsize(gg_config_path)
 
     # Install and start Greengrass
-    if install_greengrass(greengrass_root, gg_config_path):
+    if args.image:
+        installed = apply_golden_image(args.image, greengrass_root, gg_config_path, args.image_link,
+                                       report)
+    else:
+        installed = install_greengrass(greengrass_root, gg_config_path, args.appcds, report,
+                                       jvm_options)
+    component_cache = get_component_cache(args.component_cache or config.get('componentCache'))
+    if installed and component_cache:
+        seed_components(component_cache, greengrass_root, report)
+    if installed:
+        report.outcome = 'success'
         print("\n" + "=" * 50)
         print("[OK] Bootstrap setup completed!")
         print("=" * 50)
@@ -297,7 +1403,7 @@ def main():
         print("1. Start the Greengrass daemon:")
         print("   sudo snap start aws-iot-greengrass.greengrass-daemon")
         print("\n2. Monitor fleet provisioning:")
-        print(f"   tail -f {greengrass_root}/logs/greengrass.log")
+        print(f"   tail -f {logs_dir}/greengrass.log")
         print("\n3. Check daemon status:")
         print("   snap services aws-iot-greengrass")
         print("\nFleet provisioning will exchange claim certificates")
@@ -1,52 +1,32 @@
 import os
 import sys
+import csv
 import json
-import zipfile
+import atexit
+import fcntl
+import argparse
 import subprocess
 import time
-import glob
+import hashlib
+import importlib
 import platform
-import boto3
-from botocore.exceptions import ClientError
-import yaml
-
-def get_architecture():
-    """Detect system architecture and return appropriate Java directory suffix"""
-    machine = platform.machine()
-    arch_map = {
-        'x86_64': 'amd64',
-        'aarch64': 'arm64',
-        'armv7l': 'armhf'
-    }
-    return arch_map.get(machine, machine)
-
-def find_java_binary(snap_dir):
-    """Find Java binary, trying architecture-agnostic symlink first, then arch-specific paths"""
-    arch = get_architecture()
-
-    # Ordered list of paths to try
-    java_paths = [
-        # Architecture-agnostic symlink (created in snapcraft.yaml)
-        f"{snap_dir}/usr/lib/jvm/java-11-openjdk/bin/java",
-        # Architecture-specific paths
-        f"{snap_dir}/usr/lib/jvm/java-11-openjdk-{arch}/bin/java",
-        # Glob pattern as fallback
-        f"{snap_dir}/usr/lib/jvm/java-11-openjdk-*/bin/java",
-        # System paths
-        f"{snap_dir}/usr/bin/java",
-        "/usr/bin/java",
-    ]
-
-    for path in java_paths:
-        if '*' in path:
-            matches = glob.glob(path)
-            if matches:
-                return matches[0]
-        elif os.path.exists(path):
-            return path
-
-    # Last resort: system java
-    return "java"
+import random
+import re
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from greengrass_common import (
+    JVM_PROFILES, LOG_FORMATS, LOG_LEVELS, LOGGING_DEFAULTS, RunReport,
+    appcds_timing_report, build_logging_config, download_root_ca, extract_nucleus_zip,
+    get_appcds_options, get_architecture, get_component_cache, get_java_runtime,
+    get_ram_log_dir, read_system_resources, record_appcds_timing, seed_components,
+    select_jvm_profile, select_logging, write_jvm_options_file, write_logging_file,
+)
+
+# boto3, botocore and yaml are imported where they are used: they take
+# seconds to load on small boards and are not needed to show prompts or
+# handle --help and --clear-cache
 
 def get_aws_credentials():
     """Get AWS credentials from user input"""
@@ -72,51 +52,567 @@ def get_device_info():
 
     return device_name
 
-def create_aws_clients(access_key, secret_key, region):
-    """Create AWS service clients"""
+def preload_modules(*names):
+    """Import modules on a background thread while the user answers prompts
+
+    A later import of the same module waits for this one to finish, so
+    callers import as usual.
+    """
+    def load():
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+
+    threading.Thread(target=load, name='preload', daemon=True).start()
+
+def create_aws_clients(access_key, secret_key, region, max_pool_connections=10, governor=None):
+    """Create AWS service clients, rate limited by governor if given"""
     try:
+        import boto3
+        from botocore.config import Config
+
         session = boto3.Session(
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
             region_name=region
         )
 
-        iot_client = session.client('iot')
-        iam_client = session.client('iam')
-        sts_client = session.client('sts')
-        account_id = sts_client.get_caller_identity()['Account']
+        # Clients are shared across batch workers and concurrent steps,
+        # so size the pool to match and keep idle connections alive between
+        # calls.  Throttling retries are left to the governor's backoff
+        client_config = Config(
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True,
+            connect_timeout=10,
+            read_timeout=30,
+            retries={'mode': 'standard',
+                     'max_attempts': governor.max_attempts if governor else 5}
+        )
+
+        iot_client = session.client('iot', config=client_config)
+        iam_client = session.client('iam', config=client_config)
+        sts_client = session.client('sts', config=client_config)
+        if governor:
+            for client in (iot_client, iam_client, sts_client):
+                governor.attach(client)
 
-        return iot_client, iam_client, account_id
+        return iot_client, iam_client, sts_client
     except Exception as e:
         print(f"Error creating AWS clients: {e}")
-        return None, None
+        return None, None, None
 
-def get_iot_endpoints(iot_client):
-    """Get IoT endpoints from AWS API"""
-    print("\n=== Getting IoT Endpoints ===")
-    try:
-        # Get data endpoint (ATS)
-        data_response = iot_client.describe_endpoint(endpointType='iot:Data-ATS')
-        iot_data_endpoint = data_response['endpointAddress']
-        print(f"✓ Data endpoint: {iot_data_endpoint}")
+class DiscoveryCache:
+    """On-disk cache of account discovery results and known resources
 
-        # Get credentials endpoint
-        cred_response = iot_client.describe_endpoint(endpointType='iot:CredentialProvider')
-        iot_cred_endpoint = cred_response['endpointAddress']
-        print(f"✓ Credentials endpoint: {iot_cred_endpoint}")
+    Entries are keyed by region and a hash of the access key ID, so
+    different accounts or credentials never share results, and each value
+    expires ttl seconds after it was stored.  A ttl of 0 disables the cache.
+    """
 
-        # Use data endpoint as core endpoint (they're the same for ATS)
-        iot_core_endpoint = iot_data_endpoint
-        print(f"✓ Core endpoint: {iot_core_endpoint}")
+    def __init__(self, path, region, access_key, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.key = f"{region}:{hashlib.sha256(access_key.encode()).hexdigest()[:16]}"
+        self.lock = threading.Lock()
+        self.data = {}
 
-        return iot_core_endpoint, iot_data_endpoint, iot_cred_endpoint
+        if self.ttl > 0 and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠ Ignoring unreadable discovery cache {self.path}: {e}")
+
+    def _entries(self):
+        return self.data.setdefault(self.key, {})
+
+    def get(self, name):
+        """Return a cached value, or None if missing or expired"""
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            entry = self._entries().get(name)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['value']
+        return None
 
-    except Exception as e:
-        print(f"Error getting IoT endpoints: {e}")
-        return None, None, None
+    def set(self, name, value):
+        """Store a value with the current timestamp"""
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self._entries()[name] = {'value': value, 'time': time.time()}
+
+    def is_known(self, kind, name):
+        """Return True if a resource is cached as existing"""
+        return bool(self.get(f"{kind}:{name}"))
+
+    def remember(self, kind, name):
+        """Record that a resource exists"""
+        self.set(f"{kind}:{name}", True)
+
+    def save(self):
+        """Atomically write the cache back to disk"""
+        if self.ttl <= 0:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with self.lock:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.data, f, indent=2)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠ Could not write discovery cache {self.path}: {e}")
+
+# Sustained TPS the governor starts each API at.  These are the AWS IoT
+# default quotas, which apply to the whole account in a region, not to
+# one station
+API_RATE_LIMITS = {
+    'CreateKeysAndCertificate': 10,
+    'CreateThing': 15,
+    'CreateThingType': 15,
+    'CreatePolicy': 10,
+    'AttachThingPrincipal': 15,
+    'AttachPrincipalPolicy': 15,
+    'DescribeEndpoint': 10,
+}
+DEFAULT_API_RATE = 10
+
+THROTTLE_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException',
+}
+
+class ApiRateGovernor:
+    """Per-API token buckets shared by every worker thread and process
+
+    Worker threads draw from buckets held in memory.  A throttled call
+    halves that API's rate and is retried after a fully jittered exponential
+    backoff; each successful call adds back a twentieth of the configured
+    rate, and a rate that has not been throttled for recovery_seconds goes
+    straight back to the limit.  Reduced rates and when they were throttled
+    are shared with other configure runs on the same station through a JSON
+    file under an exclusive flock, written on every throttle and otherwise
+    at most every flush_seconds.  Entries are keyed by region and a hash of
+    the access key ID, like the discovery cache.
+    """
+
+    def __init__(self, path, region, access_key, rates=None, default_rate=DEFAULT_API_RATE,
+                 max_attempts=8, base_delay=0.25, max_delay=20.0, recovery_seconds=300,
+                 flush_seconds=5):
+        self.path = path
+        self.key = f"{region}:{hashlib.sha256(access_key.encode()).hexdigest()[:16]}"
+        self.rates = {**API_RATE_LIMITS, **(rates or {})}
+        self.default_rate = default_rate
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.recovery_seconds = recovery_seconds
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.calls = {}
+        self.buckets = {}
+        self.flushed = 0.0
+        self.flush()
+
+    def limit(self, api):
+        """Configured sustained TPS for an API"""
+        return float(self.rates.get(api, self.default_rate))
+
+    def _sync(self, now):
+        """Merge the shared state file into the buckets and write the result back
+
+        Called with self.lock held.  When the file cannot be used the buckets
+        are only kept in memory.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                saved = state.setdefault(self.key, {})
+                for api, entry in saved.items():
+                    if isinstance(entry, dict):
+                        self._merge(api, entry, now)
+                for api, bucket in self.buckets.items():
+                    saved[api] = {'rate': bucket['rate'], 'throttled': bucket['throttled']}
+                # Entries that have recovered are dropped rather than kept forever
+                state[self.key] = {api: entry for api, entry in saved.items()
+                                   if isinstance(entry, dict) and
+                                   now - entry.get('throttled', 0) < self.recovery_seconds}
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+        except OSError as e:
+            print(f"⚠ Could not update API rate state {self.path}: {e}")
+
+    def _merge(self, api, entry, now):
+        """Adopt a reduced rate another run saved, if its throttle is recent"""
+        throttled = entry.get('throttled', 0)
+        if now - throttled >= self.recovery_seconds:
+            return
+        bucket = self._bucket(api, now)
+        if throttled > bucket['throttled']:
+            bucket['rate'] = max(0.2, min(bucket['rate'], float(entry.get('rate', bucket['rate']))))
+            bucket['tokens'] = min(bucket['tokens'], bucket['rate'])
+            bucket['throttled'] = throttled
+
+    def _bucket(self, api, now):
+        """Return an API's bucket refilled up to now; call with self.lock held"""
+        limit = self.limit(api)
+        bucket = self.buckets.get(api)
+        if bucket is None:
+            bucket = self.buckets[api] = {'tokens': limit, 'rate': limit, 'updated': now,
+                                          'throttled': 0}
+        # A lowered --api-rate takes effect straight away, and a reduced rate
+        # recovers fully once the API has gone a while without a throttle
+        bucket['rate'] = min(bucket['rate'], limit)
+        if now - bucket['throttled'] >= self.recovery_seconds:
+            bucket['rate'] = limit
+        elapsed = max(0.0, now - bucket['updated'])
+        bucket['tokens'] = min(limit, bucket['tokens'] + elapsed * bucket['rate'])
+        bucket['updated'] = now
+        return bucket
+
+    def _stats(self, api):
+        return self.calls.setdefault(api, {'calls': 0, 'throttles': 0, 'retries': 0,
+                                           'waitSeconds': 0.0})
+
+    def acquire(self, api):
+        """Block until the API's bucket has a token and take it"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                if now - self.flushed >= self.flush_seconds:
+                    self.flush_locked(now)
+                bucket = self._bucket(api, now)
+                if bucket['tokens'] >= 1:
+                    bucket['tokens'] -= 1
+                    wait = 0.0
+                else:
+                    wait = (1 - bucket['tokens']) / bucket['rate']
+            if not wait:
+                break
+            # Jitter keeps waiting workers from waking in lockstep
+            wait *= random.uniform(1.0, 1.2)
+            time.sleep(wait)
+            waited += wait
+
+        with self.lock:
+            stats = self._stats(api)
+            stats['calls'] += 1
+            stats['waitSeconds'] += waited
+
+    def record_throttle(self, api):
+        """Halve an API's rate and empty its bucket after a throttling error"""
+        with self.lock:
+            now = time.time()
+            bucket = self._bucket(api, now)
+            bucket['rate'] = max(0.2, bucket['rate'] / 2)
+            bucket['tokens'] = min(bucket['tokens'], 0.0)
+            bucket['throttled'] = now
+            self._stats(api)['throttles'] += 1
+            # Other runs should back off straight away, not at the next flush
+            self.flush_locked(now)
+
+    def record_success(self, api):
+        """Raise a reduced rate back towards the configured limit"""
+        limit = self.limit(api)
+        with self.lock:
+            bucket = self._bucket(api, time.time())
+            bucket['rate'] = min(limit, bucket['rate'] + limit / 20)
+
+    def flush_locked(self, now):
+        """Share the buckets' rates through the state file; call with self.lock held"""
+        self._sync(now)
+        self.flushed = now
+
+    def flush(self):
+        """Share the buckets' rates through the state file"""
+        with self.lock:
+            self.flush_locked(time.time())
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff before retry number attempt"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _before_send(self, event_name, **kwargs):
+        self.acquire(event_name.rsplit('.', 1)[-1])
+
+    def _needs_retry(self, event_name, response=None, attempts=1, **kwargs):
+        if response is None:
+            return None
+        http_response, parsed = response
+        code = parsed.get('Error', {}).get('Code')
+        if code not in THROTTLE_CODES and http_response.status_code != 429:
+            return None
+
+        api = event_name.rsplit('.', 1)[-1]
+        self.record_throttle(api)
+        if attempts >= self.max_attempts:
+            return None
+        with self.lock:
+            self._stats(api)['retries'] += 1
+        return self.backoff(attempts)
+
+    def _after_call(self, http_response=None, model=None, **kwargs):
+        if http_response is not None and http_response.status_code < 300:
+            self.record_success(model.name)
+
+    def attach(self, client):
+        """Route a boto3 client's calls through the governor"""
+        service = client.meta.service_model.service_id.hyphenize()
+        client.meta.events.register(f"before-send.{service}", self._before_send)
+        # Registered first so throttles get this backoff rather than botocore's
+        client.meta.events.register_first(f"needs-retry.{service}", self._needs_retry)
+        client.meta.events.register(f"after-call.{service}", self._after_call)
+        return client
+
+    def summary(self):
+        """Per-API calls, throttles, retries, time waited and effective TPS for this run"""
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            return {
+                api: {**stats, 'waitSeconds': round(stats['waitSeconds'], 3),
+                      'effectiveTps': round(stats['calls'] / elapsed, 2) if elapsed else None}
+                for api, stats in sorted(self.calls.items())
+            }
 
-def create_iot_thing_type(iot_client, thing_type_name):
+def get_rate_state_path():
+    """Location of the API rate governor state, shared by every configure run"""
+    return f"{os.environ.get('SNAP_COMMON', '/tmp')}/cache/api-rate-state.json"
+
+def print_api_summary(governor, report):
+    """Show and record per-API throttling and effective TPS"""
+    governor.flush()
+    summary = governor.summary()
+    report.details['apiCalls'] = summary
+    throttles = sum(stats['throttles'] for stats in summary.values())
+    calls = sum(stats['calls'] for stats in summary.values())
+    print(f"✓ AWS API calls: {calls}, throttled: {throttles}")
+    for api, stats in summary.items():
+        if stats['throttles'] or stats['waitSeconds']:
+            print(f"  {api}: {stats['calls']} calls at {stats['effectiveTps']} TPS, "
+                  f"{stats['throttles']} throttled, waited {stats['waitSeconds']:.1f}s")
+
+class ProvisioningJournal:
+    """Record of completed provisioning steps for one device
+
+    Each completed step is written to disk straight away together with the
+    data later steps need (such as the certificate ARN and file paths), so a
+    configure run that fails part way resumes from the first incomplete
+    step instead of minting a new certificate and repeating every call.
+    """
+
+    def __init__(self, path, device_name, region):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'deviceName': device_name, 'region': region, 'steps': {}}
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    existing = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠ Ignoring unreadable provisioning journal {self.path}: {e}")
+                return
+
+            if existing.get('deviceName') == device_name and existing.get('region') == region:
+                self.data = existing
+                if self.data['steps']:
+                    print(f"✓ Resuming provisioning of {device_name}; completed steps: "
+                          f"{', '.join(self.data['steps'])}")
+            else:
+                print(f"⚠ Provisioning journal is for {existing.get('deviceName')} in "
+                      f"{existing.get('region')}; starting a new journal")
+
+    def is_done(self, step):
+        """Return True if a step has been recorded as complete"""
+        with self.lock:
+            return step in self.data['steps']
+
+    def result(self, step):
+        """Return the data recorded for a completed step"""
+        with self.lock:
+            return self.data['steps'][step]['result']
+
+    def record(self, step, result=None):
+        """Mark a step complete and flush the journal to disk"""
+        with self.lock:
+            self.data['steps'][step] = {'result': result, 'time': time.time()}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+
+    def wrap(self, step, func, keep_result=False, is_valid=None):
+        """Wrap a scheduler step so it is skipped once recorded
+
+        With keep_result the step's return value is journaled and handed
+        back on resume; it must be JSON serialisable.  is_valid, if given,
+        is called with the recorded result and must return True for the
+        step to be skipped.
+        """
+        def run(results):
+            if self.is_done(step):
+                recorded = self.result(step)
+                if is_valid is None or is_valid(recorded):
+                    print(f"✓ Skipping completed step: {step}")
+                    return recorded
+                print(f"⚠ Recorded result for step '{step}' is no longer valid; redoing it")
+            value = func(results)
+            self.record(step, value if keep_result else None)
+            return value
+        return run
+
+def get_journal_path():
+    """Location of the provisioning journal file"""
+    return f"{os.environ.get('SNAP_COMMON', '/tmp')}/provisioning-journal.json"
+
+def open_journal(device_name, region, fresh=False):
+    """Open the provisioning journal, discarding it first with fresh (--fresh)"""
+    journal_path = get_journal_path()
+    if fresh and os.path.exists(journal_path):
+        os.remove(journal_path)
+        print(f"✓ Discarded provisioning journal: {journal_path}")
+    return ProvisioningJournal(journal_path, device_name, region)
+
+def certificate_files_exist(certificate):
+    """Return True if a journaled certificate's cert and key files are still on disk"""
+    return all(os.path.exists(path) for path in certificate[2:])
+
+def get_cache_path():
+    """Location of the discovery cache file"""
+    return f"{os.environ.get('SNAP_COMMON', '/tmp')}/cache/aws-discovery.json"
+
+def clear_discovery_cache():
+    """Delete the discovery cache file"""
+    cache_path = get_cache_path()
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+        print(f"✓ Removed discovery cache: {cache_path}")
+    else:
+        print(f"✓ No discovery cache at: {cache_path}")
+
+def get_account_id(sts_client, cache=None):
+    """Get the AWS account ID for the configured credentials"""
+    account_id = cache.get('accountId') if cache else None
+    if account_id:
+        print(f"✓ AWS account: {account_id} (cached)")
+        return account_id
+
+    account_id = sts_client.get_caller_identity()['Account']
+    print(f"✓ AWS account: {account_id}")
+    if cache:
+        cache.set('accountId', account_id)
+    return account_id
+
+def describe_iot_endpoint(iot_client, endpoint_type, cache=None):
+    """Get a single IoT endpoint address from AWS API"""
+    endpoint = cache.get(f"endpoint:{endpoint_type}") if cache else None
+    if endpoint:
+        print(f"✓ {endpoint_type} endpoint: {endpoint} (cached)")
+        return endpoint
+
+    response = iot_client.describe_endpoint(endpointType=endpoint_type)
+    endpoint = response['endpointAddress']
+    print(f"✓ {endpoint_type} endpoint: {endpoint}")
+    if cache:
+        cache.set(f"endpoint:{endpoint_type}", endpoint)
+    return endpoint
+
+class StepScheduler:
+    """Run provisioning steps concurrently, honouring their dependencies
+
+    Each step is a callable taking the dict of results produced so far; it
+    is started as soon as every step it depends on has finished, so
+    independent AWS round trips overlap instead of running back to back.
+    The first failing step stops scheduling and is re-raised once the steps
+    already in flight have finished.
+    """
+
+    def __init__(self, max_workers=6, report=None):
+        self.max_workers = max_workers
+        self.report = report or RunReport('steps')
+        self.steps = {}
+
+    def add(self, name, func, depends_on=()):
+        """Register a step and the names of the steps it depends on"""
+        self.steps[name] = (func, tuple(depends_on))
+
+    def _run_step(self, name, func, results):
+        with self.report.phase(f"aws.{name}"):
+            return func(results)
+
+    def run(self):
+        """Run all steps and return a dict of step name to result"""
+        unknown = {dep for _, deps in self.steps.values() for dep in deps} - set(self.steps)
+        if unknown:
+            raise ValueError(f"Unknown step dependencies: {', '.join(sorted(unknown))}")
+
+        results = {}
+        pending = dict(self.steps)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, (func, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        future = executor.submit(self._run_step, name, func, results)
+                        running[future] = name
+                        del pending[name]
+
+                if not running:
+                    raise ValueError(f"Circular step dependencies: {', '.join(sorted(pending))}")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        pending.clear()
+                        raise RuntimeError(f"step '{name}' failed: {e}") from e
+
+        return results
+
+def require(value, message):
+    """Return value, raising RuntimeError with message if it is empty"""
+    if not value:
+        raise RuntimeError(message)
+    return value
+
+def add_discovery_steps(scheduler, iot_client, sts_client, thing_type_name, cache=None):
+    """Register the account-wide lookups shared by every device"""
+    scheduler.add('account_id', lambda r: get_account_id(sts_client, cache))
+    scheduler.add('data_endpoint', lambda r: describe_iot_endpoint(iot_client, 'iot:Data-ATS', cache))
+    scheduler.add('cred_endpoint',
+                  lambda r: describe_iot_endpoint(iot_client, 'iot:CredentialProvider', cache))
+    scheduler.add('thing_type', lambda r: create_iot_thing_type(iot_client, thing_type_name, cache))
+    scheduler.add('root_ca', lambda r: require(download_root_ca(), "failed to install Root CA"))
+
+def create_iot_thing_type(iot_client, thing_type_name, cache=None):
     """Create IoT thing type for Greengrass"""
+    from botocore.exceptions import ClientError
+
+    if cache and cache.is_known('thingType', thing_type_name):
+        print(f"✓ IoT thing type '{thing_type_name}' already exists (cached)")
+        return None
+
     try:
         response = iot_client.create_thing_type(
             thingTypeName=thing_type_name,
@@ -125,19 +621,29 @@ def create_iot_thing_type(iot_client, thing_type_name):
             }
         )
         print(f"✓ Successfully created IoT thing type: {thing_type_name}")
-        return response
     except ClientError as e:
         if e.response['Error']['Code'] == 'ResourceAlreadyExistsException':
             print(f"⚠ IoT thing type '{thing_type_name}' already exists")
+            response = None
         else:
             raise e
 
-def create_iot_thing(iot_client, thing_name, thing_type_name):
+    if cache:
+        cache.remember('thingType', thing_type_name)
+    return response
+
+def create_iot_thing(iot_client, thing_name, thing_type_name, attributes=None):
     """Create IoT thing"""
+    from botocore.exceptions import ClientError
+
     try:
+        kwargs = {}
+        if attributes:
+            kwargs['attributePayload'] = {'attributes': attributes}
         response = iot_client.create_thing(
             thingName=thing_name,
-            thingTypeName=thing_type_name
+            thingTypeName=thing_type_name,
+            **kwargs
         )
         print(f"✓ Successfully created IoT thing: {thing_name}")
         return response
@@ -147,7 +653,7 @@ def create_iot_thing(iot_client, thing_name, thing_type_name):
         else:
             raise e
 
-def create_device_certificate(iot_client, thing_name):
+def create_device_certificate(iot_client, thing_name, certs_dir=None, attach_to_thing=True):
     """Create and activate device certificate"""
     try:
         # Create certificate
@@ -162,7 +668,8 @@ def create_device_certificate(iot_client, thing_name):
         print(f"✓ Certificate ARN: {cert_arn}")
 
         # Save certificate and key files
-        certs_dir = f"{os.environ.get('SNAP_COMMON', '/tmp')}/certs"
+        if certs_dir is None:
+            certs_dir = f"{os.environ.get('SNAP_COMMON', '/tmp')}/certs"
         os.makedirs(certs_dir, exist_ok=True)
 
         cert_path = f"{certs_dir}/{thing_name}.cert.pem"
@@ -181,12 +688,8 @@ def create_device_certificate(iot_client, thing_name):
         print(f"✓ Saved certificate to: {cert_path}")
         print(f"✓ Saved private key to: {key_path}")
 
-        # Attach certificate to thing
-        iot_client.attach_thing_principal(
-            thingName=thing_name,
-            principal=cert_arn
-        )
-        print(f"✓ Attached certificate to thing: {thing_name}")
+        if attach_to_thing:
+            attach_certificate_to_thing(iot_client, thing_name, cert_arn)
 
         return cert_arn, cert_id, cert_path, key_path
 
@@ -194,8 +697,22 @@ def create_device_certificate(iot_client, thing_name):
         print(f"Error creating device certificate: {e}")
         return None, None, None, None
 
-def create_greengrass_policy(iot_client, policy_name, region, account_id):
+def attach_certificate_to_thing(iot_client, thing_name, cert_arn):
+    """Attach certificate to thing"""
+    iot_client.attach_thing_principal(
+        thingName=thing_name,
+        principal=cert_arn
+    )
+    print(f"✓ Attached certificate to thing: {thing_name}")
+
+def create_greengrass_policy(iot_client, policy_name, region, account_id, cache=None):
     """Create IoT policy for Greengrass device"""
+    from botocore.exceptions import ClientError
+
+    if cache and cache.is_known('policy', policy_name):
+        print(f"✓ IoT policy '{policy_name}' already exists (cached)")
+        return None
+
     policy_document = {
         "Version": "2012-10-17",
         "Statement": [
@@ -234,13 +751,17 @@ def create_greengrass_policy(iot_client, policy_name, region, account_id):
             policyDocument=json.dumps(policy_document)
         )
         print(f"✓ Created IoT policy: {policy_name}")
-        return response
     except ClientError as e:
         if e.response['Error']['Code'] == 'ResourceAlreadyExistsException':
             print(f"⚠ IoT policy '{policy_name}' already exists")
+            response = None
         else:
             raise e
 
+    if cache:
+        cache.remember('policy', policy_name)
+    return response
+
 def attach_policy_to_certificate(iot_client, policy_name, cert_arn):
     """Attach policy to certificate"""
     try:
@@ -249,63 +770,17 @@ def attach_policy_to_certificate(iot_client, policy_name, cert_arn):
             principal=cert_arn
         )
         print(f"✓ Attached policy '{policy_name}' to certificate")
+        return True
     except Exception as e:
         print(f"Error attaching policy to certificate: {e}")
-
-def download_root_ca():
-    """Download AWS IoT Root CA certificate"""
-    import requests
-
-    certs_dir = f"{os.environ.get('SNAP_COMMON', '/tmp')}/certs"
-    root_ca_path = f"{certs_dir}/AmazonRootCA1.pem"
-
-    if os.path.exists(root_ca_path):
-        print(f"✓ Root CA already exists: {root_ca_path}")
-        return root_ca_path
-
-    try:
-        url = "https://www.amazontrust.com/repository/AmazonRootCA1.pem"
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-
-        with open(root_ca_path, 'w') as f:
-            f.write(response.text)
-
-        print(f"✓ Downloaded Root CA to: {root_ca_path}")
-        return root_ca_path
-
-    except Exception as e:
-        print(f"Error downloading Root CA: {e}")
-        return None
-
-def install_greengrass_v2(thing_name, region, cert_path, private_key_path, root_ca_path, 
-                         iot_core_endpoint, iot_data_endpoint, iot_cred_endpoint):
-    """Install and configure AWS Greengrass v2"""
-    print("\n=== Installing AWS Greengrass v2 ===")
-
-    # Display architecture info
-    arch = get_architecture()
-    print(f"✓ Detected architecture: {arch} ({platform.machine()})")
-
-    # Create Greengrass directory
-    greengrass_root = f"{os.environ.get('SNAP_COMMON', '/tmp')}/greengrass/v2"
-    os.makedirs(greengrass_root, exist_ok=True)
-
-    # Extract Greengrass installer
-    snap_dir = os.environ.get('SNAP', '/tmp')
-    greengrass_zip = f"{snap_dir}/opt/greengrass/greengrass-nucleus.zip"
-
-    if os.path.exists(greengrass_zip):
-        with zipfile.ZipFile(greengrass_zip, 'r') as zip_ref:
-            zip_ref.extractall(greengrass_root)
-        print("✓ Extracted Greengrass v2 installer")
-    else:
-        print("⚠ Greengrass installer not found in snap")
         return False
 
+def build_greengrass_config(thing_name, region, cert_path, private_key_path, root_ca_path,
+                            greengrass_root, iot_data_endpoint, iot_cred_endpoint, jvm_options=None,
+                            logging_settings=None):
+    """Build the Greengrass nucleus init config for a provisioned thing"""
     iot_role_alias = "GreengrassV2TokenExchangeRoleAlias"
 
-    # Create Greengrass configuration with all IoT endpoints
     config = {
         "system": {
             "certificateFilePath": cert_path,
@@ -330,35 +805,106 @@ def install_greengrass_v2(thing_name, region, cert_path, private_key_path, root_
             }
         }
     }
+    if jvm_options:
+        config["services"]["aws.greengrass.Nucleus"]["configuration"]["jvmOptions"] = \
+            " ".join(jvm_options)
+    if logging_settings:
+        config["services"]["aws.greengrass.Nucleus"]["configuration"]["logging"] = \
+            build_logging_config(logging_settings)
+    return config
+
+def install_greengrass_v2(thing_name, region, cert_path, private_key_path, root_ca_path, 
+                         iot_core_endpoint, iot_data_endpoint, iot_cred_endpoint, journal=None,
+                         appcds=False, startup_timeout=90, report=None, jvm_profile='auto',
+                         logging_settings=None, component_cache=None):
+    """Install and configure AWS Greengrass v2"""
+    import yaml
+
+    report = report or RunReport('install')
+    print("\n=== Installing AWS Greengrass v2 ===")
+
+    # Display architecture info
+    arch = get_architecture()
+    print(f"✓ Detected architecture: {arch} ({platform.machine()})")
+
+    # Create Greengrass directory
+    greengrass_root = f"{os.environ.get('SNAP_COMMON', '/tmp')}/greengrass/v2"
+    os.makedirs(greengrass_root, exist_ok=True)
+
+    # Extract Greengrass installer
+    snap_dir = os.environ.get('SNAP', '/tmp')
+    greengrass_zip = f"{snap_dir}/opt/greengrass/greengrass-nucleus.zip"
+
+    if os.path.exists(greengrass_zip):
+        with report.phase('extraction') as phase:
+            stats = extract_nucleus_zip(greengrass_zip, greengrass_root)
+            phase.update(bytesWritten=stats['bytesWritten'], filesExtracted=stats['extracted'],
+                         filesSkipped=stats['skipped'])
+        if stats['extracted']:
+            print(f"✓ Extracted Greengrass v2 installer ({stats['extracted']} files updated, "
+                  f"{stats['skipped']} unchanged)")
+        else:
+            print(f"✓ Greengrass v2 installer already extracted ({stats['skipped']} files unchanged)")
+        if journal:
+            journal.record('extraction')
+    else:
+        print("⚠ Greengrass installer not found in snap")
+        return False
+
+    # Size the nucleus JVM for this device's RAM and CPUs
+    total_mb, cpus = read_system_resources()
+    profile_name, jvm_options = select_jvm_profile(total_mb, cpus, {'profile': jvm_profile})
+    print(f"✓ JVM profile: {profile_name} ({total_mb or 'unknown'} MB RAM, {cpus} CPUs)")
+    if jvm_options:
+        print(f"  JVM options: {' '.join(jvm_options)}")
+    write_jvm_options_file(f"{os.environ.get('SNAP_COMMON', '/tmp')}/jvm-options.env",
+                           profile_name, jvm_options)
+
+    logging_settings = logging_settings or select_logging()
+    logs_dir = get_ram_log_dir() if logging_settings['ramDirectory'] else f"{greengrass_root}/logs"
+    write_logging_file(f"{os.environ.get('SNAP_COMMON', '/tmp')}/logging.env", logging_settings,
+                       greengrass_root)
+    print(f"✓ Logging: {logging_settings['level']}, {logging_settings['format']}, "
+          f"{logging_settings['fileSizeKB']} KB files, {logging_settings['totalLogsSizeKB']} KB "
+          f"per log, in {logs_dir}")
+
+    # Create Greengrass configuration with all IoT endpoints
+    config = build_greengrass_config(thing_name, region, cert_path, private_key_path, root_ca_path,
+                                     greengrass_root, iot_data_endpoint, iot_cred_endpoint,
+                                     jvm_options, logging_settings)
 
     config_path = f"{greengrass_root}/config.yaml"
-    with open(config_path, 'w') as f:
-        yaml.dump(config, f, default_flow_style=False)
+    with report.phase('config_generation') as phase:
+        config_text = yaml.dump(config, default_flow_style=False)
+        with open(config_path, 'w') as f:
+            f.write(config_text)
+        phase['bytesWritten'] = os.path.getsize(config_path)
+    config_hash = hashlib.sha256(config_text.encode()).hexdigest()
 
     print(f"✓ Created Greengrass configuration at {config_path}")
     print(f"  IoT Core Endpoint: {iot_core_endpoint}")
     print(f"  IoT Data Endpoint: {iot_data_endpoint}")
     print(f"  IoT Cred Endpoint: {iot_cred_endpoint}")
 
-    # Find Java binary using architecture detection
-    java_path = find_java_binary(snap_dir)
-    print(f"✓ Using Java at: {java_path}")
+    # Find and test Java, reusing the result cached for this snap revision
+    phase = report.begin('java_probe')
+    try:
+        runtime, cached = get_java_runtime(snap_dir)
+        report.end(phase, cached=cached)
+    except Exception as e:
+        report.end(phase, 'error', error=str(e))
+        print(f"⚠ Java test failed: {e}")
+        return False
+
+    java_path = runtime['JAVA_BIN']
+    java_home = runtime['JAVA_HOME']
+    print(f"✓ Using Java at: {java_path}{' (cached)' if cached else ''}")
 
     # Set JAVA_HOME for child processes
-    java_home = os.path.dirname(os.path.dirname(java_path))
     env = os.environ.copy()
     env['JAVA_HOME'] = java_home
     print(f"✓ JAVA_HOME: {java_home}")
-
-    # Test Java installation
-    try:
-        java_test = subprocess.run([java_path, "-version"], 
-                                 capture_output=True, text=True, timeout=10, env=env)
-        java_version = java_test.stderr.split('\n')[0] if java_test.stderr else "Unknown"
-        print(f"✓ Java version: {java_version}")
-    except Exception as e:
-        print(f"⚠ Java test failed: {e}")
-        return False
+    print(f"✓ Java version: {runtime['JAVA_VERSION']}")
 
     # Check installer JAR
     installer_jar = f"{greengrass_root}/lib/Greengrass.jar"
@@ -379,7 +925,23 @@ def install_greengrass_v2(thing_name, region, cert_path, private_key_path, root_
     # Construct cacerts path using architecture detection
     cacerts_path = f"{snap_dir}/etc/ssl/certs/java/cacerts"
 
+    # AppCDS stays enabled for later runs and the daemon once its directory exists
+    cds_dir = f"{greengrass_root}/cds"
+    if appcds:
+        os.makedirs(cds_dir, exist_ok=True)
+    installer_jar, cds_options, cds_mode = get_appcds_options(java_path, installer_jar, cds_dir, env)
+    if cds_mode != 'off':
+        print(f"✓ AppCDS mode for installer: {cds_mode}")
+
+    nucleus_jar = f"{greengrass_root}/alts/current/distro/lib/Greengrass.jar"
+    # The installer applies the init config, so a changed config (new endpoints,
+    # JVM or logging settings) runs it again
+    already_installed = journal and journal.is_done('install') and \
+        (journal.result('install') or {}).get('configSha256') == config_hash and \
+        os.path.exists(nucleus_jar)
+
     # Install Greengrass with debugging
+    phase = report.begin('installer', appcds=cds_mode)
     try:
         install_cmd = [
             java_path,
@@ -387,6 +949,8 @@ def install_greengrass_v2(thing_name, region, cert_path, private_key_path, root_
             f"-Djavax.net.ssl.trustStore={cacerts_path}",
             "-Djavax.net.ssl.trustStoreType=JKS",
             "-Dlog.store=FILE",
+            *jvm_options,
+            *cds_options,
             "-jar", installer_jar,
             "--init-config", config_path,
             "--component-default-user", "root:root",
@@ -394,29 +958,49 @@ def install_greengrass_v2(thing_name, region, cert_path, private_key_path, root_
             "--start", "false"
         ]
 
-        print(f"Installing Greengrass (without auto-start)...")
-        print(f"Command: {' '.join(install_cmd)}")
+        if already_installed:
+            print("✓ Greengrass installer already completed; skipping")
+            report.end(phase, 'skipped')
+        else:
+            print(f"Installing Greengrass (without auto-start)...")
+            print(f"Command: {' '.join(install_cmd)}")
 
-        result = subprocess.run(install_cmd, capture_output=True, text=True, timeout=120, env=env)
+            install_start = time.monotonic()
+            result = subprocess.run(install_cmd, capture_output=True, text=True, timeout=120, env=env)
+            record_appcds_timing(cds_dir, 'installer', cds_mode, time.monotonic() - install_start)
+            report.end(phase, 'ok' if result.returncode == 0 else 'failed', exitCode=result.returncode)
 
-        print(f"Installation completed with return code: {result.returncode}")
-        if result.stdout:
-            print(f"STDOUT: {result.stdout}")
-        if result.stderr:
-            print(f"STDERR: {result.stderr}")
+            print(f"Installation completed with return code: {result.returncode}")
+            if result.stdout:
+                print(f"STDOUT: {result.stdout}")
+            if result.stderr:
+                print(f"STDERR: {result.stderr}")
 
         # Check if installation created necessary files
-        nucleus_jar = f"{greengrass_root}/alts/current/distro/lib/Greengrass.jar"
         if os.path.exists(nucleus_jar):
             print("✓ Greengrass installation completed successfully")
+            if journal and not already_installed:
+                journal.record('install', {'configSha256': config_hash})
+            # Lets the daemon's readiness check know the install is usable
+            open(f"{greengrass_root}/.install-complete", 'w').close()
+
+            component_cache = get_component_cache(component_cache)
+            if component_cache:
+                print("\n=== Seeding components ===")
+                seed_components(component_cache, greengrass_root, report)
 
             # Start Greengrass with debugging
             print("\n=== Starting Greengrass Nucleus ===")
-            start_result = start_greengrass_with_debugging(greengrass_root, java_path, env)
+            with report.phase('nucleus_start') as start_phase:
+                start_result = start_greengrass_with_debugging(greengrass_root, java_path, env,
+                                                               startup_timeout, jvm_options,
+                                                               logs_dir)
+                if not start_result:
+                    report.end(start_phase, 'failed')
 
             if start_result:
                 print("✓ Greengrass v2 is running")
-                print(f"✓ Monitor logs: tail -f {greengrass_root}/logs/greengrass.log")
+                print(f"✓ Monitor logs: tail -f {logs_dir}/greengrass.log")
                 print(f"✓ Greengrass root: {greengrass_root}")
             else:
                 print("⚠ Greengrass installed but startup had issues")
@@ -424,69 +1008,167 @@ def install_greengrass_v2(thing_name, region, cert_path, private_key_path, root_
                 print(f"  cd {greengrass_root}")
                 print(f"  {java_path} -Droot={greengrass_root} -jar alts/current/distro/lib/Greengrass.jar")
 
+            for line in appcds_timing_report(cds_dir):
+                print(f"✓ {line}")
+
             return True
         else:
             print("⚠ Installation completed but Nucleus JAR not found")
             return False
 
     except subprocess.TimeoutExpired:
+        report.end(phase, 'timeout')
         print("⚠ Installation timed out after 2 minutes")
         return False
     except Exception as e:
+        if 'durationSeconds' not in phase:
+            report.end(phase, 'error', error=str(e))
         print(f"Error during Greengrass installation: {e}")
         return False
 
-def start_greengrass_with_debugging(greengrass_root, java_path, env=None):
-    """Start Greengrass with debugging output"""
+# Log lines that show the nucleus finished launching, or that it cannot start
+NUCLEUS_READY_PATTERNS = [
+    re.compile(r"Launched Nucleus successfully"),
+    re.compile(r"service-set-state.*serviceName=main.*newState=RUNNING"),
+]
+NUCLEUS_FATAL_PATTERNS = [
+    re.compile(r"Failed to launch Nucleus"),
+    re.compile(r"java\.lang\.OutOfMemoryError"),
+    re.compile(r"UnsupportedClassVersionError"),
+    re.compile(r"Could not find or load main class"),
+    re.compile(r"Error: Unable to access jarfile"),
+]
+
+def read_new_lines(path, offset, max_bytes=1024 * 1024):
+    """Return (lines, new_offset) for complete lines appended after offset
+
+    Reads at most max_bytes per call, and starts again from the beginning
+    if the file was truncated or replaced by a shorter one.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return [], 0
+
+    if size < offset:
+        offset = 0
+    if size == offset:
+        return [], offset
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(min(size - offset, max_bytes))
+
+    end = data.rfind(b'\n') + 1
+    if end == 0 and len(data) == max_bytes:
+        # A single line longer than max_bytes; consume it as-is
+        end = len(data)
+    return data[:end].decode('utf-8', 'replace').splitlines(), offset + end
+
+def tail_file(path, count=5, block_size=4096):
+    """Return the last count lines of a file by reading backwards from the end"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        while position > 0 and data.count(b'\n') <= count:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    return data.decode('utf-8', 'replace').splitlines()[-count:]
+
+def wait_for_nucleus_ready(process, watch_files, timeout, poll_interval=0.25):
+    """Follow the nucleus logs until it reports a launch, a fatal error or exits
+
+    watch_files maps each followed path to the offset to start reading
+    from.  Returns (ready, reason).
+    """
+    deadline = time.monotonic() + timeout
+    next_progress = time.monotonic() + 10
+
+    while True:
+        for path, offset in list(watch_files.items()):
+            lines, watch_files[path] = read_new_lines(path, offset)
+            for line in lines:
+                if any(pattern.search(line) for pattern in NUCLEUS_FATAL_PATTERNS):
+                    return False, line.strip()
+                if any(pattern.search(line) for pattern in NUCLEUS_READY_PATTERNS):
+                    return True, line.strip()
+
+        if process.poll() is not None:
+            return False, f"process exited with code {process.returncode}"
+
+        now = time.monotonic()
+        if now >= deadline:
+            return False, f"no launch message within {timeout}s"
+        if now >= next_progress:
+            print(f"  Waiting for nucleus launch (PID: {process.pid})...")
+            next_progress = now + 10
+
+        time.sleep(poll_interval)
+
+def start_greengrass_with_debugging(greengrass_root, java_path, env=None, timeout=90,
+                                    jvm_options=(), logs_dir=None):
+    """Start Greengrass and wait until the nucleus reports it has launched"""
     if env is None:
         env = os.environ.copy()
 
     try:
         nucleus_jar = f"{greengrass_root}/alts/current/distro/lib/Greengrass.jar"
+        cds_dir = f"{greengrass_root}/cds"
+        nucleus_jar, cds_options, cds_mode = get_appcds_options(java_path, nucleus_jar, cds_dir, env)
 
         start_cmd = [
             java_path,
             "-Droot=" + greengrass_root,
             "-Dlog.store=FILE",
+            *jvm_options,
+            *cds_options,
             "-jar", nucleus_jar
         ]
 
+        logs_dir = logs_dir or f"{greengrass_root}/logs"
+        os.makedirs(logs_dir, exist_ok=True)
+        log_file = f"{logs_dir}/greengrass.log"
+        console_file = f"{logs_dir}/nucleus-console.log"
+
+        # Only lines written after launch count towards readiness
+        watch_files = {}
+        for path in (log_file, console_file):
+            watch_files[path] = os.path.getsize(path) if os.path.exists(path) else 0
+
         print(f"Starting Greengrass: {' '.join(start_cmd)}")
-        print("Starting in background (monitoring for 15 seconds)...")
-
-        # Start as background process
-        process = subprocess.Popen(start_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env)
-
-        # Monitor startup for 15 seconds
-        for i in range(15):
-            time.sleep(1)
-            if process.poll() is not None:
-                stdout, stderr = process.communicate()
-                print(f"Process exited early with code: {process.returncode}")
-                if stdout:
-                    print(f"STDOUT: {stdout}")
-                if stderr:
-                    print(f"STDERR: {stderr}")
-                return False
-
-            print(f"  Startup check {i+1}/15 - Process running (PID: {process.pid})")
-
-        print("✓ Greengrass appears to be running successfully")
+        print(f"Waiting up to {timeout}s for the nucleus to launch...")
+
+        # Child output goes to a file so the JVM can never block on a full pipe
+        start = time.monotonic()
+        with open(console_file, 'ab') as console:
+            process = subprocess.Popen(start_cmd, stdout=console, stderr=subprocess.STDOUT, env=env)
+
+        ready, reason = wait_for_nucleus_ready(process, watch_files, timeout)
+        elapsed = time.monotonic() - start
+
+        if not ready:
+            print(f"⚠ Nucleus did not launch: {reason}")
+            if process.poll() is None:
+                print(f"  Process is still running (PID: {process.pid})")
+            if os.path.exists(console_file):
+                print(f"Recent console output ({console_file}):")
+                for line in tail_file(console_file):
+                    print(f"  {line}")
+            return False
+
+        record_appcds_timing(cds_dir, 'nucleus', cds_mode, elapsed)
+        print(f"✓ Nucleus launched in {elapsed:.1f}s: {reason}")
         print(f"✓ Process ID: {process.pid}")
+        print(f"✓ Console output: {console_file}")
 
-        # Check if log file exists and show recent entries
-        log_file = f"{greengrass_root}/logs/greengrass.log"
+        # Show recent entries without reading the whole log
         if os.path.exists(log_file):
-            print(f"✓ Log file created: {log_file}")
-            try:
-                with open(log_file, 'r') as f:
-                    lines = f.readlines()
-                    if lines:
-                        print("Recent log entries:")
-                        for line in lines[-5:]:  # Show last 5 lines
-                            print(f"  {line.strip()}")
-            except:
-                pass
+            print("Recent log entries:")
+            for line in tail_file(log_file):
+                print(f"  {line.strip()}")
 
         return True
 
@@ -494,8 +1176,326 @@ def start_greengrass_with_debugging(greengrass_root, java_path, env=None):
         print(f"Error starting Greengrass: {e}")
         return False
 
+def load_device_manifest(manifest_path):
+    """Load device names and thing attributes from a CSV or YAML manifest
+
+    CSV manifests need a header row with a 'deviceName' (or 'name') column;
+    every other non-empty column becomes a thing attribute.  YAML manifests
+    are either a list of devices or a mapping with a 'devices' list, where
+    each entry is a device name or a mapping with 'deviceName' and an
+    optional 'attributes' mapping.
+    """
+    import yaml
+
+    devices = []
+
+    if manifest_path.lower().endswith('.csv'):
+        with open(manifest_path, newline='') as f:
+            for row in csv.DictReader(f):
+                name = (row.pop('deviceName', None) or row.pop('name', None) or '').strip()
+                if not name:
+                    continue
+                attributes = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+                devices.append({'deviceName': name, 'attributes': attributes})
+    else:
+        with open(manifest_path, 'r') as f:
+            data = yaml.safe_load(f) or []
+        if isinstance(data, dict):
+            data = data.get('devices', [])
+        for entry in data:
+            if isinstance(entry, str):
+                entry = {'deviceName': entry}
+            name = str(entry.get('deviceName') or entry.get('name') or '').strip()
+            if not name:
+                continue
+            attributes = {str(k): str(v) for k, v in (entry.get('attributes') or {}).items()}
+            devices.append({'deviceName': name, 'attributes': attributes})
+
+    names = [d['deviceName'] for d in devices]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate device names in manifest: {', '.join(duplicates)}")
+
+    return devices
+
+def provision_device_bundle(iot_client, device, thing_type_name, region, account_id,
+                            iot_data_endpoint, iot_cred_endpoint, root_ca_pem, output_dir, cache=None,
+                            logging_settings=None):
+    """Provision one device and write its cert/key/config bundle
+
+    The bundle mirrors the on-device $SNAP_COMMON layout, so the generated
+    config.yaml references the paths the files will have on the device.
+    """
+    import yaml
+
+    device_name = device['deviceName']
+    start = time.monotonic()
+    result = {'deviceName': device_name, 'status': 'failed'}
+
+    try:
+        bundle_dir = f"{output_dir}/{device_name}"
+        bundle_certs_dir = f"{bundle_dir}/certs"
+        os.makedirs(bundle_certs_dir, exist_ok=True)
+
+        create_iot_thing(iot_client, device_name, thing_type_name, device.get('attributes'))
+
+        cert_arn, cert_id, _, _ = create_device_certificate(iot_client, device_name, bundle_certs_dir)
+        if not cert_arn:
+            raise RuntimeError("failed to create device certificate")
+
+        policy_name = f"{device_name}-GreengrassV2IoTThingPolicy"
+        create_greengrass_policy(iot_client, policy_name, region, account_id, cache)
+        if not attach_policy_to_certificate(iot_client, policy_name, cert_arn):
+            raise RuntimeError(f"failed to attach policy {policy_name}")
+
+        with open(f"{bundle_certs_dir}/AmazonRootCA1.pem", 'w') as f:
+            f.write(root_ca_pem)
+
+        device_common = "/var/snap/aws-iot-greengrass/common"
+        config = build_greengrass_config(
+            device_name, region,
+            f"{device_common}/certs/{device_name}.cert.pem",
+            f"{device_common}/certs/{device_name}.private.key",
+            f"{device_common}/certs/AmazonRootCA1.pem",
+            f"{device_common}/greengrass/v2",
+            iot_data_endpoint, iot_cred_endpoint,
+            logging_settings=logging_settings
+        )
+        with open(f"{bundle_dir}/config.yaml", 'w') as f:
+            yaml.dump(config, f, default_flow_style=False)
+        if logging_settings:
+            write_logging_file(f"{bundle_dir}/logging.env", logging_settings,
+                               f"{device_common}/greengrass/v2")
+
+        result.update({
+            'status': 'success',
+            'certificateId': cert_id,
+            'certificateArn': cert_arn,
+            'policyName': policy_name,
+            'bundleDir': bundle_dir
+        })
+    except Exception as e:
+        result['error'] = str(e)
+
+    result['latencySeconds'] = round(time.monotonic() - start, 3)
+    return result
+
+def run_batch_provisioning(manifest_path, workers, output_dir, cache_ttl, report, api_rates=None,
+                           default_api_rate=DEFAULT_API_RATE, logging_settings=None):
+    """Provision every device in a manifest over one shared session"""
+    print(f"AWS IoT Core and Greengrass Batch Setup")
+    print("=" * 40)
+
+    try:
+        devices = load_device_manifest(manifest_path)
+    except Exception as e:
+        print(f"Error loading device manifest: {e}")
+        sys.exit(1)
+
+    if not devices:
+        print(f"Error: No devices found in manifest {manifest_path}")
+        sys.exit(1)
+
+    print(f"✓ Loaded {len(devices)} devices from {manifest_path}")
+
+    access_key, secret_key, region = get_aws_credentials()
+    if not all([access_key, secret_key, region]):
+        sys.exit(1)
+
+    governor = ApiRateGovernor(get_rate_state_path(), region, access_key, api_rates,
+                               default_api_rate)
+    with report.phase('aws_clients'):
+        iot_client, iam_client, sts_client = create_aws_clients(access_key, secret_key, region,
+                                                               max_pool_connections=max(workers, 10),
+                                                               governor=governor)
+    if not iot_client:
+        sys.exit(1)
+
+    print("\n=== Discovering account resources ===")
+    cache = DiscoveryCache(get_cache_path(), region, access_key, cache_ttl)
+    thing_type_name = "GreengrassCore"
+    scheduler = StepScheduler(report=report)
+    add_discovery_steps(scheduler, iot_client, sts_client, thing_type_name, cache)
+    try:
+        discovered = scheduler.run()
+    except Exception as e:
+        print(f"Error discovering account resources: {e}")
+        sys.exit(1)
+    finally:
+        cache.save()
+
+    account_id = discovered['account_id']
+    iot_data_endpoint = discovered['data_endpoint']
+    iot_cred_endpoint = discovered['cred_endpoint']
+    root_ca_path = discovered['root_ca']
+    with open(root_ca_path, 'r') as f:
+        root_ca_pem = f.read()
+
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"\n=== Provisioning {len(devices)} devices with {workers} workers ===")
+
+    results = []
+    batch_start = time.monotonic()
+    batch_phase = report.begin('batch_provisioning', devices=len(devices), workers=workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(provision_device_bundle, iot_client, device, thing_type_name, region,
+                            account_id, iot_data_endpoint, iot_cred_endpoint, root_ca_pem, output_dir,
+                            cache, logging_settings)
+            for device in devices
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            report.event('device_result', deviceName=result['deviceName'], status=result['status'],
+                         latencySeconds=result['latencySeconds'], error=result.get('error'))
+            if result['status'] == 'success':
+                print(f"✓ {result['deviceName']} provisioned in {result['latencySeconds']:.2f}s")
+            else:
+                print(f"⚠ {result['deviceName']} failed after {result['latencySeconds']:.2f}s: {result['error']}")
+    elapsed = time.monotonic() - batch_start
+    cache.save()
+
+    results.sort(key=lambda r: r['deviceName'])
+    succeeded = [r for r in results if r['status'] == 'success']
+    failed = [r for r in results if r['status'] != 'success']
+    latencies = sorted(r['latencySeconds'] for r in results)
+    report.end(batch_phase, 'ok' if not failed else 'failed',
+               succeeded=len(succeeded), failedDevices=len(failed))
+    print_api_summary(governor, report)
+
+    batch_report = {
+        'manifest': manifest_path,
+        'region': region,
+        'workers': workers,
+        'total': len(results),
+        'succeeded': len(succeeded),
+        'failed': len(failed),
+        'elapsedSeconds': round(elapsed, 3),
+        'devicesPerMinute': round(len(results) / elapsed * 60, 2) if elapsed else None,
+        'latencySeconds': {
+            'min': latencies[0],
+            'median': statistics.median(latencies),
+            'max': latencies[-1]
+        },
+        'apiCalls': governor.summary(),
+        'devices': results
+    }
+    batch_report_path = f"{output_dir}/batch-report.json"
+    with open(batch_report_path, 'w') as f:
+        json.dump(batch_report, f, indent=2)
+
+    print("\n" + "=" * 50)
+    print(f"Provisioned {len(succeeded)}/{len(results)} devices in {elapsed:.1f}s")
+    print(f"Bundles: {output_dir}")
+    print(f"Report: {batch_report_path}")
+    for r in failed:
+        print(f"  ⚠ {r['deviceName']}: {r['error']}")
+    print("=" * 50)
+
+    if failed:
+        sys.exit(1)
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="AWS IoT Core and Greengrass Setup")
+    parser.add_argument('--manifest',
+                        help="CSV or YAML device manifest; provisions every device in batch mode")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Number of devices provisioned concurrently in batch mode (default: 8)")
+    parser.add_argument('--output-dir',
+                        help="Directory for per-device bundles in batch mode "
+                             "(default: $SNAP_COMMON/batch)")
+    parser.add_argument('--cache-ttl', type=int, default=86400,
+                        help="Seconds to trust cached account ID, endpoints and known "
+                             "thing types/policies; 0 disables the cache (default: 86400)")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="Delete the discovery cache and exit")
+    parser.add_argument('--appcds', action='store_true',
+                        help="Enable an AppCDS class-data-sharing archive for the Greengrass "
+                             "JVMs (also used by the daemon)")
+    parser.add_argument('--startup-timeout', type=int, default=90,
+                        help="Seconds to wait for the nucleus to log a successful launch "
+                             "(default: 90)")
+    parser.add_argument('--jvm-profile', default='auto',
+                        choices=['auto', *JVM_PROFILES, 'none'],
+                        help="Nucleus JVM sizing; auto picks a profile from RAM and CPU count "
+                             "(default: auto)")
+    parser.add_argument('--component-cache', metavar='PATH',
+                        help="Directory or .tar/.tar.gz of component recipes and artifacts to "
+                             "seed into the nucleus store before it starts "
+                             "(default: $SNAP_COMMON/component-cache if present)")
+    parser.add_argument('--log-level', type=str.upper, choices=LOG_LEVELS,
+                        help=f"Nucleus log level (default: {LOGGING_DEFAULTS['level']})")
+    parser.add_argument('--log-format', type=str.upper, choices=LOG_FORMATS,
+                        help=f"Nucleus log format (default: {LOGGING_DEFAULTS['format']})")
+    parser.add_argument('--log-file-size-kb', type=int,
+                        help=f"Size at which each log file is rotated "
+                             f"(default: {LOGGING_DEFAULTS['fileSizeKB']})")
+    parser.add_argument('--log-total-size-kb', type=int,
+                        help=f"Most space kept for each log and its rotated files "
+                             f"(default: {LOGGING_DEFAULTS['totalLogsSizeKB']})")
+    parser.add_argument('--ram-logs', action='store_true', default=None,
+                        help="Write nucleus logs to a RAM directory and copy them to disk "
+                             "periodically, to reduce flash wear")
+    parser.add_argument('--api-rate', action='append', default=[], metavar='API=TPS',
+                        help="Sustained calls per second for one AWS API, e.g. CreateThing=5; "
+                             "may be repeated")
+    parser.add_argument('--api-rate-default', type=float, default=DEFAULT_API_RATE,
+                        help=f"Calls per second for APIs without their own limit "
+                             f"(default: {DEFAULT_API_RATE})")
+    parser.add_argument('--fresh', action='store_true',
+                        help="Discard the provisioning journal and start from the first step, "
+                             "creating a new certificate")
+    parser.add_argument('--report',
+                        help="Write a JSON report of phase timings, outcomes and exit codes to this file")
+    parser.add_argument('--events',
+                        help="Append phase start/end events as JSON lines to this file")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    api_rates = {}
+    for item in args.api_rate:
+        api, _, rate = item.partition('=')
+        try:
+            api_rates[api.strip()] = float(rate)
+        except ValueError:
+            parser.error(f"--api-rate expects API=TPS, got '{item}'")
+        if api_rates[api.strip()] <= 0:
+            parser.error(f"--api-rate for {api.strip()} must be positive")
+    if args.api_rate_default <= 0:
+        parser.error("--api-rate-default must be positive")
+    args.api_rate = api_rates
+    return args
+
 def main():
     """Main setup function"""
+    args = parse_args()
+
+    if args.clear_cache:
+        clear_discovery_cache()
+        return
+
+    # Written on every exit path, including sys.exit on failure
+    report = RunReport('configure-batch' if args.manifest else 'configure', args.report, args.events)
+    atexit.register(report.write)
+
+    preload_modules('boto3', 'yaml')
+
+    logging_settings = select_logging({
+        'level': args.log_level,
+        'format': args.log_format,
+        'fileSizeKB': args.log_file_size_kb,
+        'totalLogsSizeKB': args.log_total_size_kb,
+        'ramDirectory': args.ram_logs,
+    })
+
+    if args.manifest:
+        output_dir = args.output_dir or f"{os.environ.get('SNAP_COMMON', '/tmp')}/batch"
+        run_batch_provisioning(args.manifest, args.workers, output_dir, args.cache_ttl, report,
+                               args.api_rate, args.api_rate_default, logging_settings)
+        report.outcome = 'success'
+        return
 
     print(f"AWS IoT Core and Greengrass Setup")
     print("=" * 40)
@@ -514,49 +1514,82 @@ def main():
     if not device_name:
         sys.exit(1)
 
+    report.details.update(deviceName=device_name, region=region)
+
     # Create AWS clients
-    iot_client, iam_client, account_id = create_aws_clients(access_key, secret_key, region)
+    governor = ApiRateGovernor(get_rate_state_path(), region, access_key, args.api_rate,
+                               args.api_rate_default)
+    with report.phase('aws_clients'):
+        iot_client, iam_client, sts_client = create_aws_clients(access_key, secret_key, region,
+                                                               governor=governor)
     if not iot_client:
         sys.exit(1)
 
     print(f"\n=== Configuring Greengrass Core: {device_name} ===")
 
-    try:
-        # Get IoT endpoints
-        iot_core_endpoint, iot_data_endpoint, iot_cred_endpoint = get_iot_endpoints(iot_client)
-        if not all([iot_core_endpoint, iot_data_endpoint, iot_cred_endpoint]):
-            print("Failed to get IoT endpoints")
-            sys.exit(1)
-
-        # Create IoT thing type
-        thing_type_name = "GreengrassCore"
-        create_iot_thing_type(iot_client, thing_type_name)
-
-        # Create IoT thing
-        create_iot_thing(iot_client, device_name, thing_type_name)
+    cache = DiscoveryCache(get_cache_path(), region, access_key, args.cache_ttl)
 
-        # Create device certificate
-        cert_arn, cert_id, cert_path, key_path = create_device_certificate(iot_client, device_name)
-        if not cert_arn:
-            print("Failed to create device certificate")
-            sys.exit(1)
+    journal = open_journal(device_name, region, args.fresh)
 
-        # Create and attach policy
+    try:
+        thing_type_name = "GreengrassCore"
         policy_name = f"{device_name}-GreengrassV2IoTThingPolicy"
-        create_greengrass_policy(iot_client, policy_name, region, account_id)
-        attach_policy_to_certificate(iot_client, policy_name, cert_arn)
 
-        # Download Root CA
-        root_ca_path = download_root_ca()
-        if not root_ca_path:
-            print("Failed to download Root CA")
-            sys.exit(1)
+        def create_certificate_step(results):
+            certificate = create_device_certificate(iot_client, device_name, attach_to_thing=False)
+            if not certificate[0]:
+                raise RuntimeError("failed to create device certificate")
+            return list(certificate)
+
+        # Independent control-plane calls run concurrently; the thing,
+        # certificate and policy branches only join at the attach steps.
+        # Re-running after a failure must not mint another certificate, so
+        # every device-specific step goes through the journal
+        scheduler = StepScheduler(report=report)
+        add_discovery_steps(scheduler, iot_client, sts_client, thing_type_name, cache)
+        scheduler.add('thing',
+                      journal.wrap('thing', lambda r: create_iot_thing(iot_client, device_name,
+                                                                       thing_type_name)),
+                      depends_on=['thing_type'])
+        scheduler.add('certificate',
+                      journal.wrap('certificate', create_certificate_step, keep_result=True,
+                                   is_valid=certificate_files_exist))
+        scheduler.add('policy',
+                      journal.wrap('policy', lambda r: create_greengrass_policy(
+                          iot_client, policy_name, region, r['account_id'], cache)),
+                      depends_on=['account_id'])
+        scheduler.add('thing_principal',
+                      journal.wrap('thing_principal', lambda r: attach_certificate_to_thing(
+                          iot_client, device_name, r['certificate'][0])),
+                      depends_on=['thing', 'certificate'])
+        scheduler.add('policy_attachment',
+                      journal.wrap('policy_attachment', lambda r: require(
+                          attach_policy_to_certificate(iot_client, policy_name, r['certificate'][0]),
+                          f"failed to attach policy {policy_name}")),
+                      depends_on=['policy', 'certificate'])
+        steps_start = time.monotonic()
+        try:
+            results = scheduler.run()
+        finally:
+            cache.save()
+            print_api_summary(governor, report)
+        print(f"✓ AWS provisioning steps completed in {time.monotonic() - steps_start:.1f}s")
+
+        iot_data_endpoint = results['data_endpoint']
+        iot_cred_endpoint = results['cred_endpoint']
+        # Use data endpoint as core endpoint (they're the same for ATS)
+        iot_core_endpoint = iot_data_endpoint
+        cert_arn, cert_id, cert_path, key_path = results['certificate']
+        root_ca_path = results['root_ca']
 
         # Install Greengrass v2
         success = install_greengrass_v2(device_name, region, cert_path, key_path, root_ca_path,
-                                      iot_core_endpoint, iot_data_endpoint, iot_cred_endpoint)
+                                      iot_core_endpoint, iot_data_endpoint, iot_cred_endpoint,
+                                      journal, args.appcds, args.startup_timeout, report,
+                                      args.jvm_profile, logging_settings, args.component_cache)
 
         if success:
+            report.outcome = 'success'
             print("\n" + "=" * 50)
             print("✓ AWS IoT Greengrass v2 setup completed successfully!")
             print("=" * 50)
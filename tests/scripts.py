@@ -0,0 +1,17 @@
+"""Import the hyphenated local-scripts as modules for the unit tests"""
+import os
+import sys
+import importlib.util
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'local-scripts')
+# The snap runs each script from its own directory, next to its helpers
+sys.path.insert(0, SCRIPTS_DIR)
+
+def load_script(name):
+    """Import one of the hyphenated local-scripts as a module"""
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'),
+                                                  f"{SCRIPTS_DIR}/{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
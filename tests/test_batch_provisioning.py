@@ -0,0 +1,135 @@
+import os
+import io
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import yaml
+
+from scripts import load_script
+
+setup = load_script('iot-greengrass-setup')
+
+class FakeIotClient:
+    """Records the IoT calls provision_device_bundle makes"""
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.calls.append((name, kwargs))
+            if name == self.fail:
+                raise RuntimeError(f"{name} failed")
+            if name == 'create_keys_and_certificate':
+                return {'certificateArn': 'arn:aws:iot:us-east-1:123456789012:cert/abc',
+                        'certificateId': 'abc', 'certificatePem': 'CERT',
+                        'keyPair': {'PrivateKey': 'KEY'}}
+            return {}
+        return call
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_csv(self):
+        path = self.write('devices.csv', "deviceName,site,line\n"
+                                         "gg-001,Leeds, 4 \n"
+                                         "gg-002,,\n"
+                                         ",York,1\n")
+        self.assertEqual(setup.load_device_manifest(path), [
+            {'deviceName': 'gg-001', 'attributes': {'site': 'Leeds', 'line': '4'}},
+            {'deviceName': 'gg-002', 'attributes': {}},
+        ])
+
+    def test_csv_name_column(self):
+        path = self.write('devices.CSV', "name\ngg-001\n")
+        self.assertEqual(setup.load_device_manifest(path),
+                         [{'deviceName': 'gg-001', 'attributes': {}}])
+
+    def test_yaml_list(self):
+        path = self.write('devices.yaml', "- gg-001\n"
+                                          "- deviceName: gg-002\n"
+                                          "  attributes: {line: 4}\n"
+                                          "- name: gg-003\n")
+        self.assertEqual(setup.load_device_manifest(path), [
+            {'deviceName': 'gg-001', 'attributes': {}},
+            {'deviceName': 'gg-002', 'attributes': {'line': '4'}},
+            {'deviceName': 'gg-003', 'attributes': {}},
+        ])
+
+    def test_yaml_devices_mapping(self):
+        path = self.write('devices.yml', "devices:\n  - gg-001\n  - gg-002\n")
+        self.assertEqual([d['deviceName'] for d in setup.load_device_manifest(path)],
+                         ['gg-001', 'gg-002'])
+
+    def test_empty_yaml(self):
+        self.assertEqual(setup.load_device_manifest(self.write('devices.yaml', "")), [])
+
+    def test_duplicates_are_rejected(self):
+        path = self.write('devices.csv', "deviceName\ngg-001\ngg-002\ngg-001\n")
+        with self.assertRaisesRegex(ValueError, 'gg-001'):
+            setup.load_device_manifest(path)
+
+class ProvisionDeviceBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def provision(self, client, logging_settings=None):
+        device = {'deviceName': 'gg-001', 'attributes': {'site': 'Leeds'}}
+        with redirect_stdout(io.StringIO()):
+            return setup.provision_device_bundle(
+                client, device, 'GreengrassCoreType', 'us-east-1', '123456789012',
+                'abc-ats.iot.us-east-1.amazonaws.com', 'abc.credentials.iot.us-east-1.amazonaws.com',
+                'ROOT CA', self.dir, logging_settings=logging_settings)
+
+    def test_bundle(self):
+        client = FakeIotClient()
+        result = self.provision(client, setup.select_logging())
+        bundle_dir = os.path.join(self.dir, 'gg-001')
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['certificateId'], 'abc')
+        self.assertEqual(result['policyName'], 'gg-001-GreengrassV2IoTThingPolicy')
+        self.assertEqual(result['bundleDir'], bundle_dir)
+        self.assertEqual([name for name, _ in client.calls],
+                         ['create_thing', 'create_keys_and_certificate', 'attach_thing_principal',
+                          'create_policy', 'attach_principal_policy'])
+        self.assertEqual(client.calls[0][1]['attributePayload'], {'attributes': {'site': 'Leeds'}})
+
+        certs_dir = os.path.join(bundle_dir, 'certs')
+        self.assertEqual(sorted(os.listdir(certs_dir)),
+                         ['AmazonRootCA1.pem', 'gg-001.cert.pem', 'gg-001.private.key'])
+        self.assertEqual(os.stat(os.path.join(certs_dir, 'gg-001.private.key')).st_mode & 0o777,
+                         0o600)
+        self.assertTrue(os.path.isfile(os.path.join(bundle_dir, 'logging.env')))
+
+        # Paths in the config are where the files will be on the device
+        with open(os.path.join(bundle_dir, 'config.yaml'), 'r') as f:
+            config = yaml.safe_load(f)
+        nucleus = config['services']['aws.greengrass.Nucleus']['configuration']
+        self.assertEqual(nucleus['awsRegion'], 'us-east-1')
+        self.assertEqual(config['system']['certificateFilePath'],
+                         '/var/snap/aws-iot-greengrass/common/certs/gg-001.cert.pem')
+        self.assertEqual(config['system']['thingName'], 'gg-001')
+
+    def test_failed_step_is_reported(self):
+        result = self.provision(FakeIotClient(fail='attach_principal_policy'))
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('gg-001-GreengrassV2IoTThingPolicy', result['error'])
+        self.assertIn('latencySeconds', result)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import io
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+from contextlib import redirect_stdout
+
+from scripts import SCRIPTS_DIR, load_script
+
+setup = load_script('iot-greengrass-setup')
+
+class FakeStsClient:
+    def __init__(self):
+        self.calls = 0
+
+    def get_caller_identity(self):
+        self.calls += 1
+        return {'Account': '123456789012'}
+
+class DiscoveryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache', 'aws-discovery.json')
+        self.now = 1000000.0
+        patcher = mock.patch.object(setup.time, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self, region='us-east-1', access_key='AKIAEXAMPLE', ttl=3600):
+        return setup.DiscoveryCache(self.path, region, access_key, ttl)
+
+    def test_values_survive_a_save(self):
+        cache = self.cache()
+        cache.set('accountId', '123456789012')
+        cache.remember('policy', 'GreengrassPolicy')
+        cache.save()
+        cache = self.cache()
+        self.assertEqual(cache.get('accountId'), '123456789012')
+        self.assertTrue(cache.is_known('policy', 'GreengrassPolicy'))
+        self.assertFalse(cache.is_known('policy', 'OtherPolicy'))
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_entries_expire(self):
+        cache = self.cache(ttl=3600)
+        cache.set('accountId', '123456789012')
+        self.now += 3599
+        self.assertEqual(cache.get('accountId'), '123456789012')
+        self.now += 1
+        self.assertIsNone(cache.get('accountId'))
+
+    def test_key_is_region_and_access_key_hash(self):
+        cache = self.cache()
+        cache.set('accountId', '123456789012')
+        cache.save()
+        with open(self.path, 'r') as f:
+            keys = list(json.load(f))
+        self.assertEqual(len(keys), 1)
+        region, digest = keys[0].split(':')
+        self.assertEqual(region, 'us-east-1')
+        self.assertEqual(len(digest), 16)
+        self.assertNotIn('AKIAEXAMPLE', keys[0])
+
+        self.assertIsNone(self.cache(region='eu-west-1').get('accountId'))
+        self.assertIsNone(self.cache(access_key='AKIAOTHER').get('accountId'))
+        self.assertEqual(self.cache().get('accountId'), '123456789012')
+
+    def test_zero_ttl_disables_the_cache(self):
+        cache = self.cache(ttl=0)
+        cache.set('accountId', '123456789012')
+        cache.save()
+        self.assertIsNone(cache.get('accountId'))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_unreadable_file_is_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        with redirect_stdout(io.StringIO()):
+            cache = self.cache()
+        self.assertIsNone(cache.get('accountId'))
+
+    def test_cached_account_skips_the_api(self):
+        sts = FakeStsClient()
+        cache = self.cache()
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(setup.get_account_id(sts, cache), '123456789012')
+            self.assertEqual(setup.get_account_id(sts, cache), '123456789012')
+        self.assertEqual(sts.calls, 1)
+
+class ClearCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def configure(self, *args):
+        env = dict(os.environ, SNAP_COMMON=self.dir)
+        return subprocess.run([sys.executable, f"{SCRIPTS_DIR}/iot-greengrass-setup.py", *args],
+                              capture_output=True, text=True, stdin=subprocess.DEVNULL,
+                              env=env, timeout=60)
+
+    def test_clear_cache_removes_the_file_and_exits(self):
+        path = os.path.join(self.dir, 'cache', 'aws-discovery.json')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('{}')
+        result = self.configure('--clear-cache')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertFalse(os.path.exists(path))
+        self.assertIn('Removed discovery cache', result.stdout)
+        # It exits before asking for credentials
+        self.assertNotIn('AWS Access Key', result.stdout)
+
+    def test_clear_cache_without_a_cache(self):
+        result = self.configure('--clear-cache')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('No discovery cache', result.stdout)
+
+if __name__ == '__main__':
+    unittest.main()
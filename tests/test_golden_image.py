@@ -0,0 +1,99 @@
+import io
+import os
+import json
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from scripts import load_script
+
+bootstrap = load_script('iot-greengrass-bootstrap')
+
+STAGING_ROOT = '/staging/greengrass-image-test'
+
+class ApplyImageArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.device_root = os.path.join(self.dir, 'device')
+        self.outside = os.path.join(self.dir, 'outside')
+        os.makedirs(self.device_root)
+        os.makedirs(self.outside)
+        self.image = os.path.join(self.dir, 'image.tar')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def build(self, *members):
+        """Write an image archive from (kind, name, value) members after the manifest"""
+        with tarfile.open(self.image, 'w') as tar:
+            manifest = json.dumps({'stagingRoot': STAGING_ROOT}).encode()
+            info = tarfile.TarInfo(bootstrap.IMAGE_MANIFEST)
+            info.size = len(manifest)
+            tar.addfile(info, io.BytesIO(manifest))
+            for kind, name, value in members:
+                info = tarfile.TarInfo(name)
+                if kind == 'dir':
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                elif kind == 'file':
+                    info.size = len(value)
+                    info.mode = 0o644
+                    tar.addfile(info, io.BytesIO(value))
+                else:
+                    info.type = tarfile.SYMTYPE if kind == 'symlink' else tarfile.LNKTYPE
+                    info.linkname = value
+                    tar.addfile(info)
+
+    def apply(self):
+        stats = {'symlinks': 0, 'bytesWritten': 0}
+        bootstrap.apply_image_archive(self.image, self.device_root, stats)
+        return stats
+
+    def test_valid_image(self):
+        self.build(('dir', 'root', None),
+                   ('dir', 'root/alts/init', None),
+                   ('file', 'root/alts/init/Greengrass.jar', b'jar'),
+                   ('symlink', 'root/alts/current', f"{STAGING_ROOT}/alts/init"),
+                   ('symlink', 'root/alts/previous', 'init'),
+                   ('hardlink', 'root/alts/init/copy.jar', 'root/alts/init/Greengrass.jar'))
+        stats = self.apply()
+        self.assertEqual(os.readlink(f"{self.device_root}/alts/current"),
+                         f"{self.device_root}/alts/init")
+        with open(f"{self.device_root}/alts/current/copy.jar", 'rb') as f:
+            self.assertEqual(f.read(), b'jar')
+        self.assertEqual((stats['symlinks'], stats['hardlink'], stats['copy']), (2, 1, 1))
+
+    def test_file_through_symlink_is_refused(self):
+        self.build(('symlink', 'root/x', self.outside),
+                   ('file', 'root/x/foo', b'escaped'))
+        with self.assertRaises(ValueError):
+            self.apply()
+        self.assertFalse(os.path.exists(f"{self.outside}/foo"))
+
+    def test_relative_symlink_out_of_tree_is_refused(self):
+        self.build(('symlink', 'root/x', '../outside'))
+        with self.assertRaises(ValueError):
+            self.apply()
+
+    def test_absolute_symlink_out_of_tree_is_refused(self):
+        self.build(('symlink', 'root/x', '/etc'))
+        with self.assertRaises(ValueError):
+            self.apply()
+
+    def test_hardlink_out_of_tree_is_refused(self):
+        with open(f"{self.outside}/secret", 'w') as f:
+            f.write('secret')
+        self.build(('hardlink', 'root/secret', 'root/../../outside/secret'))
+        with self.assertRaises(ValueError):
+            self.apply()
+        self.assertFalse(os.path.exists(f"{self.device_root}/secret"))
+
+    def test_path_traversal_is_refused(self):
+        self.build(('file', 'root/../outside/foo', b'escaped'))
+        with self.assertRaises(ValueError):
+            self.apply()
+        self.assertFalse(os.path.exists(f"{self.outside}/foo"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import shutil
+import argparse
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from scripts import load_script
+
+history = load_script('greengrass-history')
+
+def record(time, pid=100, cpu=0, rss=1000):
+    """Record values in RECORD order, with cpu in tenths of a percent"""
+    return (time, pid, cpu, rss, 10, 20, 50, 500000, 25)
+
+class HistoryFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'history.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, times, capacity=4):
+        history_file = history.HistoryFile(self.path, capacity, 1.0)
+        history_file.open_for_writing()
+        for time in times:
+            history_file.append(record(time))
+        history_file.close()
+        return history_file
+
+    def test_file_size_is_fixed(self):
+        self.write(range(10))
+        self.assertEqual(os.path.getsize(self.path),
+                         history.HEADER_SIZE + 4 * history.RECORD.size)
+
+    def test_partial_buffer_is_in_order(self):
+        self.write([1, 2, 3])
+        self.assertEqual([s['time'] for s in history.HistoryFile(self.path).read()], [1, 2, 3])
+
+    def test_wrap_around_keeps_newest_oldest_first(self):
+        self.write(range(1, 11))
+        self.assertEqual([s['time'] for s in history.HistoryFile(self.path).read()],
+                         [7, 8, 9, 10])
+
+    def test_reopen_continues_after_last_record(self):
+        self.write([1, 2, 3])
+        self.write([4, 5])
+        self.assertEqual([s['time'] for s in history.HistoryFile(self.path).read()],
+                         [2, 3, 4, 5])
+
+    def test_capacity_change_starts_new_history(self):
+        self.write([1, 2, 3])
+        self.write([4], capacity=8)
+        self.assertEqual([s['time'] for s in history.HistoryFile(self.path).read()], [4])
+
+    def test_scaled_fields(self):
+        self.write([1])
+        sample = history.HistoryFile(self.path).read()[0]
+        self.assertEqual((sample['systemCpuPercent'], sample['load1']), (5.0, 0.25))
+
+class SummarizeTest(unittest.TestCase):
+    def samples(self, values, pid=100):
+        return [{'time': 60 * i, 'pid': pid, 'cpuPercent': value, 'rssKb': 1000, 'threads': 10,
+                 'openFds': 20, 'systemCpuPercent': 5.0, 'memAvailableKb': 500000,
+                 'load1': 0.25} for i, value in enumerate(values)]
+
+    def test_percentile_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual([history.percentile(values, f) for f in (0.5, 0.9, 0.99)], [50, 90, 99])
+        self.assertEqual(history.percentile(list(range(1, 11)), 0.9), 9)
+        self.assertEqual(history.percentile([7], 0.99), 7)
+
+    def test_percentiles(self):
+        summary = history.summarize(self.samples(reversed(range(1, 101))))
+        cpu = summary['fields']['cpuPercent']
+        self.assertEqual((cpu['min'], cpu['p50'], cpu['p90'], cpu['p99'], cpu['max']),
+                         (1, 50, 90, 99, 100))
+        self.assertEqual(summary['samples'], 100)
+
+    def test_trend(self):
+        summary = history.summarize(self.samples(range(0, 100)))
+        # One percentage point per minute
+        self.assertAlmostEqual(summary['fields']['cpuPercent']['trendPerHour'], 60.0)
+        self.assertEqual(summary['fields']['rssKb']['trendPerHour'], 0.0)
+
+    def test_restarts_and_down_samples(self):
+        samples = self.samples([1] * 6)
+        samples[2]['pid'] = 0
+        for sample in samples[3:]:
+            sample['pid'] = 200
+        summary = history.summarize(samples)
+        self.assertEqual((summary['nucleusRestarts'], summary['nucleusDownSamples']), (1, 1))
+
+class ArgumentTest(unittest.TestCase):
+    def test_env_file(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'history.env')
+        with open(path, 'w') as f:
+            f.write("# HISTORY_INTERVAL=10\nHISTORY_INTERVAL=30\nHISTORY_CAPACITY='2880'\nEMPTY=\n")
+        self.assertEqual(history.read_env_file(path),
+                         {'HISTORY_INTERVAL': '30', 'HISTORY_CAPACITY': '2880', 'EMPTY': ''})
+        self.assertEqual(history.read_env_file(os.path.join(tmp, 'missing.env')), {})
+
+    def test_settings_from_env_file(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with open(os.path.join(tmp, 'history.env'), 'w') as f:
+            f.write("HISTORY_INTERVAL=30\n")
+        previous = os.environ.get('SNAP_COMMON')
+        os.environ['SNAP_COMMON'] = tmp
+        try:
+            args = history.parse_args([])
+        finally:
+            if previous is None:
+                del os.environ['SNAP_COMMON']
+            else:
+                os.environ['SNAP_COMMON'] = previous
+        self.assertEqual((args.interval, args.capacity), (30.0, 10080))
+
+    def test_relative_time(self):
+        expected = datetime.now(timezone.utc) - timedelta(hours=2)
+        self.assertAlmostEqual(history.parse_time_arg('2h'), expected, delta=timedelta(seconds=5))
+
+    def test_iso_time(self):
+        self.assertEqual(history.parse_time_arg('2024-01-01T00:00:00Z').timestamp(), 1704067200)
+        self.assertEqual(history.parse_time_arg('2024-01-01T00:00:00').timestamp(), 1704067200)
+
+    def test_invalid_time(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            history.parse_time_arg('yesterday')
+
+if __name__ == '__main__':
+    unittest.main()
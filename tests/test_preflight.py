@@ -0,0 +1,227 @@
+import io
+import ssl
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+from contextlib import redirect_stdout
+
+from scripts import load_script
+
+bootstrap = load_script('iot-greengrass-bootstrap')
+
+def valid_config(certs_dir='/nonexistent'):
+    """A bootstrap-config.yaml with every required setting filled in"""
+    return {
+        'awsRegion': 'us-east-1',
+        'deviceName': 'gg-001',
+        'provisioningTemplate': 'GreengrassFleetTemplate',
+        'iotDataEndpoint': 'abc123-ats.iot.us-east-1.amazonaws.com',
+        'iotCredEndpoint': 'abc123.credentials.iot.us-east-1.amazonaws.com',
+        'claimCertificatePath': f"{certs_dir}/claim.pem.crt",
+        'claimPrivateKeyPath': f"{certs_dir}/claim.private.key",
+        'templateParameters': {'ThingName': 'gg-001'},
+    }
+
+def problems(check, config):
+    preflight = bootstrap.Preflight()
+    check(config, preflight)
+    return ([message for _, message in preflight.errors],
+            [message for _, message in preflight.warnings])
+
+class ConfigSchemaTest(unittest.TestCase):
+    def test_valid_config(self):
+        self.assertEqual(problems(bootstrap.check_config_schema, valid_config()), ([], []))
+
+    def test_required_keys(self):
+        config = valid_config()
+        del config['awsRegion']
+        config['provisioningTemplate'] = ''
+        errors, _ = problems(bootstrap.check_config_schema, config)
+        self.assertEqual(errors, ['awsRegion is required', 'provisioningTemplate is required'])
+
+    def test_types(self):
+        config = valid_config()
+        config['templateParameters'] = 'ThingName=gg-001'
+        config['serialNumber'] = True
+        errors, _ = problems(bootstrap.check_config_schema, config)
+        self.assertEqual(len(errors), 2)
+        self.assertIn("serialNumber must be a string or number, not True", errors)
+        self.assertIn("templateParameters must be a mapping, not 'ThingName=gg-001'", errors)
+
+    def test_template_placeholder(self):
+        config = valid_config()
+        config['iotDataEndpoint'] = 'your-iot-data-endpoint'
+        errors, _ = problems(bootstrap.check_config_schema, config)
+        self.assertEqual(errors, ["iotDataEndpoint is still the template placeholder "
+                                  "'your-iot-data-endpoint'"])
+
+    def test_unknown_key_warns(self):
+        config = valid_config()
+        config['awsregion'] = 'us-east-1'
+        self.assertEqual(problems(bootstrap.check_config_schema, config),
+                         ([], ["Unknown setting 'awsregion' is ignored"]))
+
+    def test_values(self):
+        config = valid_config()
+        config.update(awsRegion='US East 1', deviceName='gg 001', nucleusVersion='2.16')
+        errors, _ = problems(bootstrap.check_config_schema, config)
+        self.assertEqual([error.split(' ', 1)[0] for error in errors],
+                         ['awsRegion', 'deviceName', 'nucleusVersion'])
+
+    def test_prompt_device_name(self):
+        config = valid_config()
+        config['deviceName'] = 'PROMPT'
+        self.assertEqual(problems(bootstrap.check_config_schema, config), ([], []))
+
+class EndpointTest(unittest.TestCase):
+    def test_valid_endpoints(self):
+        self.assertEqual(problems(bootstrap.check_endpoints, valid_config()), ([], []))
+
+    def test_url_instead_of_hostname(self):
+        config = valid_config()
+        config['iotDataEndpoint'] = 'https://abc123-ats.iot.us-east-1.amazonaws.com:8443'
+        errors, _ = problems(bootstrap.check_endpoints, config)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('without https:// or a port', errors[0])
+
+    def test_swapped_endpoints(self):
+        config = valid_config()
+        config['iotDataEndpoint'], config['iotCredEndpoint'] = \
+            config['iotCredEndpoint'], config['iotDataEndpoint']
+        errors, _ = problems(bootstrap.check_endpoints, config)
+        self.assertEqual(len(errors), 2)
+
+    def test_region_mismatch(self):
+        config = valid_config()
+        config['awsRegion'] = 'eu-west-1'
+        errors, _ = problems(bootstrap.check_endpoints, config)
+        self.assertEqual(errors, ['iotDataEndpoint is in us-east-1, but awsRegion is eu-west-1',
+                                  'iotCredEndpoint is in us-east-1, but awsRegion is eu-west-1'])
+
+    def test_legacy_endpoint_warns(self):
+        config = valid_config()
+        config['iotDataEndpoint'] = 'abc123.iot.us-east-1.amazonaws.com'
+        errors, warnings = problems(bootstrap.check_endpoints, config)
+        self.assertEqual(errors, [])
+        self.assertIn('legacy endpoint', warnings[0])
+
+    def test_china_endpoint(self):
+        config = valid_config()
+        config.update(awsRegion='cn-north-1',
+                      iotDataEndpoint='abc123-ats.iot.cn-north-1.amazonaws.com.cn',
+                      iotCredEndpoint='abc123.credentials.iot.cn-north-1.amazonaws.com.cn')
+        self.assertEqual(problems(bootstrap.check_endpoints, config), ([], []))
+
+@unittest.skipUnless(shutil.which('openssl'), "needs the openssl command")
+class ClaimCertificateTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.make_pair('claim', 365)
+        cls.make_pair('other', 365)
+        # Dates after 2049 are GeneralizedTime rather than UTCTime
+        cls.make_pair('long', 20000)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def make_pair(cls, name, days):
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt',
+                        'ec_paramgen_curve:prime256v1', '-nodes', '-days', str(days), '-subj',
+                        f"/CN={name}", '-keyout', f"{cls.dir}/{name}.private.key",
+                        '-out', f"{cls.dir}/{name}.pem.crt"], check=True, capture_output=True)
+
+    def validity(self, name):
+        with open(f"{self.dir}/{name}.pem.crt", 'r') as f:
+            return bootstrap.certificate_validity(ssl.PEM_cert_to_DER_cert(f.read()))
+
+    def check(self, cert='claim', key='claim', now=None):
+        config = valid_config()
+        config['claimCertificatePath'] = f"{self.dir}/{cert}.pem.crt"
+        config['claimPrivateKeyPath'] = f"{self.dir}/{key}.private.key"
+        if now is None:
+            return problems(bootstrap.check_claim_certificates, config)
+        with mock.patch.object(bootstrap.time, 'time', lambda: now):
+            return problems(bootstrap.check_claim_certificates, config)
+
+    def test_validity_dates(self):
+        not_before, not_after = self.validity('claim')
+        self.assertLess(abs(not_before - time.time()), 3600)
+        self.assertEqual(not_after - not_before, 365 * 86400)
+
+    def test_generalized_time(self):
+        not_before, not_after = self.validity('long')
+        self.assertEqual(not_after - not_before, 20000 * 86400)
+
+    def test_valid_pair(self):
+        self.assertEqual(self.check(), ([], []))
+
+    def test_mismatched_key(self):
+        errors, _ = self.check(key='other')
+        self.assertEqual(len(errors), 1)
+        self.assertIn('does not belong to', errors[0])
+
+    def test_expired(self):
+        _, not_after = self.validity('claim')
+        errors, _ = self.check(now=not_after + 60)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('Claim certificate expired on', errors[0])
+
+    def test_expiring_soon_warns(self):
+        _, not_after = self.validity('claim')
+        self.assertEqual(self.check(now=not_after - 86400),
+                         ([], [f"Claim certificate expires on "
+                               f"{time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(not_after))}"]))
+
+    def test_clock_behind_warns(self):
+        not_before, _ = self.validity('claim')
+        errors, warnings = self.check(now=not_before - 86400)
+        self.assertEqual(errors, [])
+        self.assertIn('not valid yet', warnings[0])
+
+    def test_missing_files(self):
+        errors, _ = self.check(cert='missing', key='missing')
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(all('not found' in error for error in errors))
+
+    def test_not_a_certificate(self):
+        with open(f"{self.dir}/junk.pem.crt", 'w') as f:
+            f.write("not a certificate\n")
+        errors, _ = self.check(cert='junk')
+        self.assertEqual(len(errors), 1)
+        self.assertIn('is not a PEM certificate', errors[0])
+
+class RunPreflightTest(unittest.TestCase):
+    def run_preflight(self, config):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            passed = bootstrap.run_preflight(config, checks=('config', 'endpoint'))
+        return passed, output.getvalue()
+
+    def test_passes(self):
+        passed, output = self.run_preflight(valid_config())
+        self.assertTrue(passed)
+        self.assertIn('[OK] Preflight checks passed', output)
+
+    def test_every_problem_is_reported(self):
+        config = valid_config()
+        config['awsRegion'] = 'your-region'
+        config['iotCredEndpoint'] = 'credentials.example.com'
+        passed, output = self.run_preflight(config)
+        self.assertFalse(passed)
+        self.assertIn("[ERROR] config: awsRegion is still the template placeholder", output)
+        self.assertIn("[ERROR] endpoint: iotCredEndpoint 'credentials.example.com'", output)
+        self.assertIn("nothing was changed", output)
+
+    def test_config_must_be_a_mapping(self):
+        passed, output = self.run_preflight(['awsRegion'])
+        self.assertFalse(passed)
+        self.assertIn('must be a mapping', output)
+
+if __name__ == '__main__':
+    unittest.main()
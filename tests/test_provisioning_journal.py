@@ -0,0 +1,126 @@
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+
+from scripts import load_script
+
+setup = load_script('iot-greengrass-setup')
+
+class ProvisioningJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        patcher = mock.patch.dict(os.environ, {'SNAP_COMMON': self.dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.output = io.StringIO()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, device_name='gg-001', region='us-east-1', fresh=False):
+        with redirect_stdout(self.output):
+            return setup.open_journal(device_name, region, fresh)
+
+    def step(self, name, value=None, error=None):
+        """A step function that records each time it really runs"""
+        def run(results):
+            self.calls.append(name)
+            if error:
+                raise error
+            return value
+        return run
+
+    def run_step(self, journal, name, func, **kwargs):
+        with redirect_stdout(self.output):
+            return journal.wrap(name, func, **kwargs)({})
+
+    def certificate(self, create_files=True):
+        """A journaled certificate result: ARN, ID, cert path and key path"""
+        certs_dir = os.path.join(self.dir, 'certs')
+        os.makedirs(certs_dir, exist_ok=True)
+        paths = [os.path.join(certs_dir, 'gg-001.cert.pem'),
+                 os.path.join(certs_dir, 'gg-001.private.key')]
+        if create_files:
+            for path in paths:
+                with open(path, 'w') as f:
+                    f.write('PEM')
+        return ['arn:aws:iot:us-east-1:123456789012:cert/abc', 'abc', *paths]
+
+    def test_resume_after_a_partial_run(self):
+        journal = self.open()
+        self.run_step(journal, 'thing', self.step('thing'))
+        with self.assertRaises(RuntimeError):
+            self.run_step(journal, 'policy', self.step('policy', error=RuntimeError('throttled')))
+
+        journal = self.open()
+        self.assertIn('Resuming provisioning of gg-001; completed steps: thing',
+                      self.output.getvalue())
+        self.run_step(journal, 'thing', self.step('thing'))
+        self.run_step(journal, 'policy', self.step('policy'))
+        self.assertEqual(self.calls, ['thing', 'policy', 'policy'])
+        self.assertTrue(journal.is_done('policy'))
+
+    def test_journal_is_written_after_each_step(self):
+        journal = self.open()
+        self.run_step(journal, 'thing', self.step('thing'))
+        with open(setup.get_journal_path(), 'r') as f:
+            data = json.load(f)
+        self.assertEqual((data['deviceName'], data['region'], list(data['steps'])),
+                         ('gg-001', 'us-east-1', ['thing']))
+        self.assertEqual(os.stat(setup.get_journal_path()).st_mode & 0o777, 0o600)
+
+    def test_certificate_is_reused_while_its_files_exist(self):
+        certificate = self.certificate()
+        journal = self.open()
+        self.run_step(journal, 'certificate', self.step('certificate', certificate),
+                      keep_result=True, is_valid=setup.certificate_files_exist)
+
+        journal = self.open()
+        reused = self.run_step(journal, 'certificate', self.step('certificate', ['new']),
+                               keep_result=True, is_valid=setup.certificate_files_exist)
+        self.assertEqual(reused, certificate)
+        self.assertEqual(self.calls, ['certificate'])
+
+    def test_certificate_is_recreated_when_its_files_are_missing(self):
+        certificate = self.certificate()
+        journal = self.open()
+        self.run_step(journal, 'certificate', self.step('certificate', certificate),
+                      keep_result=True, is_valid=setup.certificate_files_exist)
+        os.remove(certificate[3])
+
+        replacement = self.certificate(create_files=False)
+        journal = self.open()
+        result = self.run_step(journal, 'certificate', self.step('certificate', replacement),
+                               keep_result=True, is_valid=setup.certificate_files_exist)
+        self.assertEqual(self.calls, ['certificate', 'certificate'])
+        self.assertEqual(result, replacement)
+        self.assertIn("no longer valid", self.output.getvalue())
+
+    def test_fresh_discards_the_journal(self):
+        journal = self.open()
+        self.run_step(journal, 'thing', self.step('thing'))
+
+        journal = self.open(fresh=True)
+        self.assertIn('Discarded provisioning journal', self.output.getvalue())
+        self.assertFalse(journal.is_done('thing'))
+        self.run_step(journal, 'thing', self.step('thing'))
+        self.assertEqual(self.calls, ['thing', 'thing'])
+
+    def test_other_device_starts_a_new_journal(self):
+        self.run_step(self.open(), 'thing', self.step('thing'))
+        self.assertFalse(self.open(device_name='gg-002').is_done('thing'))
+        self.assertFalse(self.open(region='eu-west-1').is_done('thing'))
+
+    def test_unreadable_journal_is_ignored(self):
+        with open(setup.get_journal_path(), 'w') as f:
+            f.write('{not json')
+        self.assertFalse(self.open().is_done('thing'))
+
+if __name__ == '__main__':
+    unittest.main()
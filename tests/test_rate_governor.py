@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from scripts import load_script
+
+setup = load_script('iot-greengrass-setup')
+
+class FakeClock:
+    """Stands in for the time module so waits advance a fake clock"""
+    def __init__(self, now=1000000.0):
+        self.now = now
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+def no_jitter(low, high):
+    """Backoffs take their upper bound and waits are not stretched"""
+    return high if low == 0 else low
+
+class ApiRateGovernorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache', 'api-rate-state.json')
+        self.clock = FakeClock()
+        patcher = mock.patch.object(setup, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(setup.random, 'uniform', no_jitter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def governor(self, **kwargs):
+        return setup.ApiRateGovernor(self.path, 'us-east-1', 'AKIAEXAMPLE',
+                                     rates={'CreateThing': 2}, **kwargs)
+
+    def saved(self):
+        with open(self.path, 'r') as f:
+            return next(iter(json.load(f).values()))
+
+    def test_bucket_allows_a_burst_then_waits(self):
+        governor = self.governor()
+        governor.acquire('CreateThing')
+        governor.acquire('CreateThing')
+        self.assertEqual(self.clock.slept, 0.0)
+        governor.acquire('CreateThing')
+        self.assertAlmostEqual(self.clock.slept, 0.5)
+        self.assertEqual(governor.summary()['CreateThing']['calls'], 3)
+
+    def test_backoff_grows_and_is_capped(self):
+        governor = self.governor(base_delay=0.25, max_delay=20.0)
+        self.assertEqual([governor.backoff(attempt) for attempt in range(1, 5)],
+                         [0.5, 1.0, 2.0, 4.0])
+        self.assertEqual(governor.backoff(10), 20.0)
+
+    def test_throttle_halves_the_rate_and_is_saved(self):
+        governor = self.governor()
+        governor.record_throttle('CreateThing')
+        self.assertEqual(governor.buckets['CreateThing']['rate'], 1.0)
+        self.assertEqual(self.saved(), {'CreateThing': {'rate': 1.0, 'throttled': self.clock.now}})
+        self.assertEqual(governor.summary()['CreateThing']['throttles'], 1)
+
+    def test_other_runs_adopt_a_recent_throttle(self):
+        self.governor().record_throttle('CreateThing')
+        self.clock.now += 10
+        other = self.governor()
+        self.assertEqual(other.buckets['CreateThing']['rate'], 1.0)
+
+    def test_rate_recovers_after_a_quiet_period(self):
+        governor = self.governor(recovery_seconds=300)
+        governor.record_throttle('CreateThing')
+        governor.record_throttle('CreateThing')
+        self.clock.now += 299
+        governor.acquire('CreateThing')
+        self.assertEqual(governor.buckets['CreateThing']['rate'], 0.5)
+        self.clock.now += 1
+        governor.acquire('CreateThing')
+        self.assertEqual(governor.buckets['CreateThing']['rate'], 2.0)
+
+    def test_saved_rate_expires(self):
+        self.governor(recovery_seconds=300).record_throttle('CreateThing')
+        self.clock.now += 300
+        other = self.governor(recovery_seconds=300)
+        self.assertNotIn('CreateThing', other.buckets)
+        self.assertEqual(self.saved(), {})
+
+    def test_successes_raise_the_rate(self):
+        governor = self.governor()
+        governor.record_throttle('CreateThing')
+        for _ in range(5):
+            governor.record_success('CreateThing')
+        self.assertAlmostEqual(governor.buckets['CreateThing']['rate'], 1.5)
+        for _ in range(20):
+            governor.record_success('CreateThing')
+        self.assertEqual(governor.buckets['CreateThing']['rate'], 2.0)
+
+    def test_state_is_flushed_periodically(self):
+        governor = self.governor(flush_seconds=5)
+        with mock.patch.object(governor, '_sync') as sync:
+            governor.acquire('CreateThing')
+            sync.assert_not_called()
+            self.clock.now += 5
+            governor.acquire('CreateThing')
+            sync.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import copy
+import unittest
+
+from scripts import load_script
+
+bootstrap = load_script('iot-greengrass-bootstrap')
+
+def installed_config():
+    """An effective config with both services bootstrap installs"""
+    return {'services': {
+        'aws.greengrass.Nucleus': {'configuration': {
+            'awsRegion': 'us-east-1',
+            'iotRoleAlias': 'GreengrassV2TokenExchangeRoleAlias',
+            'iotDataEndpoint': 'abc-ats.iot.us-east-1.amazonaws.com',
+            'iotCredEndpoint': 'abc.credentials.iot.us-east-1.amazonaws.com',
+        }},
+        'aws.greengrass.FleetProvisioningByClaim': {'configuration': {
+            'provisioningTemplate': 'Template',
+            'iotDataEndpoint': 'abc-ats.iot.us-east-1.amazonaws.com',
+        }},
+    }}
+
+class DiffGreengrassConfigTest(unittest.TestCase):
+    def test_no_changes(self):
+        self.assertEqual(bootstrap.diff_greengrass_config(installed_config(), installed_config()), [])
+
+    def test_nucleus_key(self):
+        desired = installed_config()
+        desired['services']['aws.greengrass.Nucleus']['configuration']['iotRoleAlias'] = 'Other'
+        changes = bootstrap.diff_greengrass_config(installed_config(), desired)
+        self.assertEqual(changes, [(bootstrap.NUCLEUS + ('configuration', 'iotRoleAlias'),
+                                    'GreengrassV2TokenExchangeRoleAlias', 'Other')])
+
+    def test_provisioning_key(self):
+        desired = installed_config()
+        desired['services']['aws.greengrass.FleetProvisioningByClaim']['configuration'][
+            'provisioningTemplate'] = 'NewTemplate'
+        changes = bootstrap.diff_greengrass_config(installed_config(), desired)
+        self.assertEqual([(path[-1], old, new) for path, old, new in changes],
+                         [('provisioningTemplate', 'Template', 'NewTemplate')])
+
+    def test_added_and_removed_keys(self):
+        desired = installed_config()
+        nucleus = desired['services']['aws.greengrass.Nucleus']['configuration']
+        nucleus['jvmOptions'] = '-Xmx64m'
+        del desired['services']['aws.greengrass.FleetProvisioningByClaim']['configuration'][
+            'iotDataEndpoint']
+        changes = bootstrap.diff_greengrass_config(installed_config(), desired)
+        self.assertEqual(sorted((path[1], path[-1], old, new) for path, old, new in changes),
+                         [('aws.greengrass.FleetProvisioningByClaim', 'iotDataEndpoint',
+                           'abc-ats.iot.us-east-1.amazonaws.com', None),
+                          ('aws.greengrass.Nucleus', 'jvmOptions', None, '-Xmx64m')])
+
+    def test_service_not_installed_is_left_alone(self):
+        current = installed_config()
+        del current['services']['aws.greengrass.FleetProvisioningByClaim']
+        desired = installed_config()
+        desired['services']['aws.greengrass.FleetProvisioningByClaim']['configuration'][
+            'provisioningTemplate'] = 'NewTemplate'
+        self.assertEqual(bootstrap.diff_greengrass_config(current, desired), [])
+
+    def test_keys_cover_both_services(self):
+        services = {path[:2] for path in bootstrap.RECONFIGURE_KEYS}
+        self.assertEqual(services, {bootstrap.NUCLEUS, bootstrap.PROVISIONING})
+        self.assertIn(bootstrap.NUCLEUS + ('configuration', 'logging'), bootstrap.RECONFIGURE_KEYS)
+
+    def test_diff_does_not_modify_inputs(self):
+        current, desired = installed_config(), installed_config()
+        desired['services']['aws.greengrass.Nucleus']['configuration']['awsRegion'] = 'eu-west-1'
+        snapshot = copy.deepcopy(current)
+        bootstrap.diff_greengrass_config(current, desired)
+        self.assertEqual(current, snapshot)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import time
+import threading
+import unittest
+
+from scripts import load_script
+
+setup = load_script('iot-greengrass-setup')
+
+class StepSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = setup.StepScheduler(max_workers=4)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def step(self, name, value=None, delay=0.0, error=None):
+        """A step that records when it ran and what it could see"""
+        def run(results):
+            with self.lock:
+                self.events.append(('start', name, sorted(results)))
+            time.sleep(delay)
+            if error:
+                raise error
+            with self.lock:
+                self.events.append(('end', name))
+            return value if value is not None else name
+        return run
+
+    def started(self):
+        return [event[1] for event in self.events if event[0] == 'start']
+
+    def test_dependencies_run_first(self):
+        self.scheduler.add('thing', self.step('thing'), depends_on=['thing_type'])
+        self.scheduler.add('attach', self.step('attach'), depends_on=['thing', 'certificate'])
+        self.scheduler.add('thing_type', self.step('thing_type', delay=0.02))
+        self.scheduler.add('certificate', self.step('certificate'))
+        results = self.scheduler.run()
+
+        self.assertEqual(results, {name: name for name in
+                                   ('thing', 'attach', 'thing_type', 'certificate')})
+        seen = {event[1]: event[2] for event in self.events if event[0] == 'start'}
+        self.assertEqual(seen['thing'], ['certificate', 'thing_type'])
+        self.assertEqual(seen['attach'], ['certificate', 'thing', 'thing_type'])
+        self.assertEqual(self.started()[-1], 'attach')
+
+    def test_independent_steps_overlap(self):
+        # Each step waits for the other, so this only finishes if both run at once
+        barrier = threading.Barrier(2, timeout=5)
+        self.scheduler.add('policy', lambda results: barrier.wait())
+        self.scheduler.add('endpoint', lambda results: barrier.wait())
+        self.assertEqual(sorted(self.scheduler.run()), ['endpoint', 'policy'])
+
+    def test_failing_step_stops_its_dependents(self):
+        self.scheduler.add('certificate', self.step('certificate', error=ValueError('denied')))
+        self.scheduler.add('endpoint', self.step('endpoint', delay=0.05))
+        self.scheduler.add('attach', self.step('attach'), depends_on=['certificate'])
+        self.scheduler.add('config', self.step('config'), depends_on=['attach', 'endpoint'])
+
+        with self.assertRaisesRegex(RuntimeError, "step 'certificate' failed: denied") as raised:
+            self.scheduler.run()
+        self.assertIsInstance(raised.exception.__cause__, ValueError)
+        self.assertNotIn('attach', self.started())
+        self.assertNotIn('config', self.started())
+        # The step already in flight is allowed to finish
+        self.assertIn(('end', 'endpoint'), self.events)
+
+    def test_unknown_dependency(self):
+        self.scheduler.add('thing', self.step('thing'), depends_on=['thing_type'])
+        with self.assertRaisesRegex(ValueError, 'thing_type'):
+            self.scheduler.run()
+        self.assertEqual(self.events, [])
+
+    def test_circular_dependencies(self):
+        self.scheduler.add('a', self.step('a'), depends_on=['b'])
+        self.scheduler.add('b', self.step('b'), depends_on=['a'])
+        with self.assertRaisesRegex(ValueError, 'Circular'):
+            self.scheduler.run()
+
+    def test_steps_are_timed(self):
+        report = setup.RunReport('steps')
+        scheduler = setup.StepScheduler(report=report)
+        scheduler.add('thing', self.step('thing'))
+        scheduler.run()
+        self.assertIn('aws.thing', [phase['name'] for phase in report.phases])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import json
+import tempfile
+import unittest
+
+from scripts import load_script
+
+supervisor = load_script('greengrass-supervisor')
+
+class BackoffTest(unittest.TestCase):
+    def test_first_restart_is_immediate(self):
+        self.assertEqual(supervisor.backoff_delay(1, 5, 300), 0.0)
+
+    def test_delay_doubles(self):
+        self.assertEqual([supervisor.backoff_delay(n, 5, 300) for n in range(2, 6)],
+                         [5, 10, 20, 40])
+
+    def test_cap_applies(self):
+        self.assertEqual(supervisor.backoff_delay(8, 5, 300), 300)
+        self.assertEqual(supervisor.backoff_delay(50, 5, 300), 300)
+
+    def test_count_resets_after_stable_run(self):
+        consecutive = 0
+        for _ in range(3):
+            consecutive = supervisor.count_crash(consecutive, 1.0, 600)
+        self.assertEqual(consecutive, 3)
+        self.assertEqual(supervisor.count_crash(consecutive, 600, 600), 1)
+        self.assertEqual(supervisor.backoff_delay(supervisor.count_crash(4, 900, 600), 5, 300), 0.0)
+
+class SignalNameTest(unittest.TestCase):
+    def test_known_signal(self):
+        self.assertEqual(supervisor.signal_name(-9), 'SIGKILL')
+
+    def test_unknown_signal(self):
+        self.assertEqual(supervisor.signal_name(-200), '200')
+
+class AppendHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'launch-history.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self):
+        with open(self.path, 'r') as f:
+            return [json.loads(line) for line in f]
+
+    def test_records_are_numbered(self):
+        for _ in range(3):
+            supervisor.append_history(self.path, {'time': 0}, 'launch')
+        self.assertEqual([entry['launch'] for entry in self.read()], [1, 2, 3])
+
+    def test_count_survives_trimming(self):
+        padding = 'x' * 1024
+        for _ in range(100):
+            supervisor.append_history(self.path, {'padding': padding}, 'launch')
+        entries = self.read()
+        self.assertLess(len(entries), 100)
+        self.assertEqual(entries[-1]['launch'], 100)
+        self.assertEqual([entry['launch'] for entry in entries],
+                         list(range(101 - len(entries), 101)))
+
+if __name__ == '__main__':
+    unittest.main()